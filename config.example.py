@@ -107,8 +107,11 @@ SMTP_PASSWORD = '***'
 
 
 # The maximum number of files an item can contain
-# until the site says "Too many files to display."
+# until its file list is no longer rendered inline on the item page.
+# Larger file lists are browsed one directory at a time instead,
+# loading FILELIST_PAGE_SIZE entries per request
 MAX_FILES_VIEW = 1000
+FILELIST_PAGE_SIZE = 200
 
 #############
 ## Account ##
@@ -145,9 +148,97 @@ ROOT_FOLDER = 'storage'
 # Item storage folder
 ITEM_FOLDER = 'items'
 
+# How item directories are laid out in ITEM_FOLDER:
+#   'flat'    - ITEM_FOLDER/<slug>
+#   'sharded' - ITEM_FOLDER/ab/cd/<slug>, fanned out by the first characters of the slug,
+#               which keeps directories small enough for fast lookups and backups
+# Items are found in either layout, but items that aren't in the configured one yet
+# cost an extra lookup until they're moved there. So when switching to 'sharded', run
+# ./item_storage.py migrate-layout afterwards (it can run while the site is up, and be
+# resumed). With 'sharded', a front-end server can't map /items/<slug>/ to ITEM_FOLDER
+# by itself; use DOWNLOAD_OFFLOAD instead.
+ITEM_DIRECTORY_LAYOUT = 'flat'
+
+# Uploaded files are stored once per content in this folder (below ROOT_FOLDER), named after
+# their SHA-256, and item directories link to them. Re-uploads take no extra space.
+# It has to be on the same filesystem as ITEM_FOLDER.
+BLOB_FOLDER = 'blobs'
+# How item directories share files with the blob folder:
+#   'reflink'  - copy-on-write clones (btrfs, XFS with reflink=1), else hardlinks
+#   'hardlink' - hardlinks, else copies (when the folders are on different filesystems)
+#   None       - no blob folder, every upload is stored in its item directory
+# Blobs no item links to anymore are deleted by ./item_storage.py prune-blobs
+BLOB_LINK_MODE = 'hardlink'
+
 # Should flask serve items or not? Normally you don't want Flask to do this, it's a dev feature.
+# (Unless DOWNLOAD_OFFLOAD is set, see below.)
 FLASK_SERVE_ITEMS = False
 
+# When Flask serves items, it can still let the front-end web server move the bytes:
+# Flask looks up the item, checks permissions and only then hands the file over.
+#   None         - Flask sends the file itself
+#   'x-accel'    - nginx, responds with X-Accel-Redirect to DOWNLOAD_ACCEL_PREFIX/<item path>/<path>
+#                  (<item path> is the item directory in its layout, ab/cd/<slug> or <slug>)
+#                  which should be an `internal` location aliased to ROOT_FOLDER/ITEM_FOLDER
+#   'x-sendfile' - Apache (mod_xsendfile) or lighttpd, responds with X-Sendfile: <file path>
+DOWNLOAD_OFFLOAD = None
+DOWNLOAD_ACCEL_PREFIX = '/internal-items'
+
+# Directory listings under /items/ are cached per directory (and its mtime) for this many seconds
+DIRECTORY_LISTING_CACHE_TIMEOUT = 300
+# Listings with more entries than this are streamed to the client instead of rendered at once
+DIRECTORY_LISTING_STREAM_THRESHOLD = 2000
+
+# Allow downloading whole items (or folders in them) as a single uncompressed ZIP or TAR
+# from /archive/<slug>.zip and /archive/<slug>.tar. Archives are always sent by Flask.
+ALLOW_ARCHIVE_DOWNLOADS = True
+
+# Downloads are counted in memory and written to the database in batches
+# every DOWNLOAD_COUNT_FLUSH_INTERVAL seconds (by each worker process).
+DOWNLOAD_COUNT_FLUSH_INTERVAL = 30
+# Set this to gather the counts of all workers in redis instead,
+# so they survive worker restarts
+# DOWNLOAD_COUNT_REDIS_URL = 'redis://127.0.0.1:6379/0'
+DOWNLOAD_COUNT_REDIS_URL = None
+
+# Users' last login IPs are written in batches every LOGIN_IP_FLUSH_INTERVAL seconds
+LOGIN_IP_FLUSH_INTERVAL = 30
+
+# Copies, moves and deletes in the file manager run as background jobs, in this many
+# threads per worker process (OS threads, also under gevent). Set to 0 to run them in a
+# separate process instead, with ./item_storage.py run-jobs
+FILE_JOB_WORKERS = 1
+# Seconds between checks for jobs queued by other processes
+FILE_JOB_POLL_INTERVAL = 5
+# Workers touch the jobs they run every this many seconds, even in the middle of a file
+FILE_JOB_HEARTBEAT_INTERVAL = 30
+# A running job that hasn't been touched in this many seconds is assumed to belong to a
+# dead worker and is run again. Has to be a few heartbeat intervals long.
+FILE_JOB_STALE_TIMEOUT = 600
+
+# Every item has a manifest of its files' hashes, updated by a file job after its files
+# change. Only new and modified files are hashed, in a pool of MANIFEST_HASH_WORKERS
+# processes (0 hashes in the job's thread). 'sha256' or 'blake2b'; changing it rehashes
+# every item on its next update. Fill in the manifests of existing items with
+# ./item_storage.py update-manifests
+MANIFEST_HASH_ALGORITHM = 'sha256'
+MANIFEST_HASH_WORKERS = 2
+
+# Uploads are streamed to disk in chunks of this many bytes.
+# This bounds the memory used per upload, regardless of the size of the file.
+UPLOAD_CHUNK_SIZE = 1024 * 1024
+
+# Uploads from the upload form and the file manager are sent in resumable chunks of
+# CHUNKED_UPLOAD_CHUNK_SIZE bytes (they have to fit in MAX_CONTENT_LENGTH, if it's set).
+# Uploads that haven't received a chunk in CHUNKED_UPLOAD_EXPIRY seconds are deleted by
+# ./item_storage.py prune-uploads
+CHUNKED_UPLOAD_CHUNK_SIZE = 8 * 1024 * 1024
+CHUNKED_UPLOAD_EXPIRY = 24 * 60 * 60
+
+# Number of threads used to scan the subdirectories of an item when rebuilding its file list.
+# Helps wide items on network storage. 0 scans in the request thread.
+FILE_SCAN_WORKERS = 0
+
 ############
 ## Search ##
 ############
@@ -155,15 +246,34 @@ FLASK_SERVE_ITEMS = False
 # How many results should a page contain. Applies to RSS as well.
 RESULTS_PER_PAGE = 75
 
-# How many pages we'll return at most
+# How many numbered (OFFSET) pages we'll return at most. Results past the last one
+# are still reachable through keyset pages (?after=<token>), which aren't limited
+# since they cost the same however deep they are. Set to 0 to disable.
 MAX_PAGES = 100
 
 # How long and how many entries to cache for count queries
 COUNT_CACHE_SIZE = 256
 COUNT_CACHE_DURATION = 30
 
-# Use baked queries for database search
-USE_BAKED_SEARCH = False
+# How result totals (for the page numbers) are counted:
+# 'exact'       runs a COUNT over the matching items for every search
+# 'counters'    sums the item_counts table for listings without a search term. It is
+#               kept up to date on upload, delete and flag changes; on an existing
+#               database fill it once with ./item_storage.py rebuild-counts
+# 'approximate' same as 'counters', and uses the query planner's row estimate for
+#               searches with a term (MySQL and PostgreSQL, exact COUNT elsewhere)
+SEARCH_COUNT_MODE = 'counters'
+
+# Searches cache their compiled queries per shape (which filters, sort and paging they
+# use), up to this many. Shape hit and miss counts are at /admin/search-plans
+SEARCH_PLAN_CACHE_SIZE = 1000
+# Compile the queries of the common listings when the app starts
+SEARCH_PLAN_WARMUP = True
+
+# Search item names and descriptions with an SQLite FTS5 index when not using MySQL,
+# ranked by relevance (BM25). On an existing database, create the index once with
+# ./item_storage.py rebuild-fulltext
+SQLITE_FULLTEXT_SEARCH = True
 
 ################
 ## Commenting ##
@@ -206,6 +316,24 @@ CACHE_THRESHOLD = 8192
 # CACHE_REDIS_HOST = "127.0.0.1"
 # CACHE_KEY_PREFIX = "catcache_"
 
+# Every worker process keeps logged in users and the IP ban list in memory for this many seconds.
+# Changes to users and bans are picked up right away by every worker sharing the cache above
+# (so use a shared one like redis when running more than one process).
+USER_CACHE_TTL = 30
+BAN_CACHE_TTL = 300
+RANGEBAN_CACHE_TTL = 300
+# Range bans added with `rangeban.py ban --temp` stop applying after this many seconds
+# (`rangeban.py prune` deletes them)
+RANGEBAN_TEMP_DURATION = 7 * 24 * 60 * 60
+
+# Rendered search result rows are cached for this many seconds, keyed by everything they
+# show, so edited items never show stale rows. Set to 0 to disable.
+ROW_CACHE_TIMEOUT = 3600
+# The first pages of listings and the RSS feeds are cached for anonymous visitors for this
+# many seconds, or until an item is uploaded, edited or deleted. Seeder, leecher and download
+# counts can lag behind by as much. Set to 0 to disable.
+RESPONSE_CACHE_TIMEOUT = 60
+
 
 ###############
 ## Ratelimit ##
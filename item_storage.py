@@ -0,0 +1,142 @@
+#!/usr/bin/env python3
+
+import click
+
+from tsuu import (backend, blobstore, chunked_uploads, create_app, file_index, fulltext,
+                  item_counts, jobs, listings, models)
+
+
+@click.group()
+def item_storage():
+    global app
+    app = create_app('config')
+
+
+@item_storage.command('migrate-filelists')
+@click.option('--batch-size', default=500, show_default=True,
+              help='Number of file lists to convert per transaction.')
+def migrate_filelists(batch_size):
+    '''Re-encodes legacy JSON file lists in the binary format.'''
+    with app.app_context():
+        total = 0
+        for last_id, converted in backend.migrate_legacy_filelists(batch_size):
+            total += converted
+            click.echo('Converted {} file lists (up to item #{}).'.format(converted, last_id))
+        click.echo('Done, converted {} file lists in total.'.format(total))
+
+
+@item_storage.command('migrate-layout')
+@click.option('--layout', type=click.Choice(['flat', 'sharded']), default=None,
+              help='Layout to move item directories into. [default: ITEM_DIRECTORY_LAYOUT]')
+@click.option('--batch-size', default=100, show_default=True,
+              help='Number of items to move per batch.')
+@click.option('--delay', default=1.0, show_default=True,
+              help='Seconds to pause after every batch.')
+@click.option('--after-id', default=0, show_default=True,
+              help='Resume after this item id.')
+def migrate_layout(layout, batch_size, delay, after_id):
+    '''Moves item directories into the flat or sharded layout, while the site is up.'''
+    with app.app_context():
+        layout = layout or app.config.get('ITEM_DIRECTORY_LAYOUT', 'flat')
+        total = 0
+        for last_id, moved in backend.migrate_layout(layout, batch_size, delay, after_id):
+            total += moved
+            click.echo('Moved {} item directories (up to item #{}).'.format(moved, last_id))
+        click.echo('Done, moved {} item directories to the {} layout.'.format(total, layout))
+
+
+@item_storage.command('rebuild-counts')
+def rebuild_counts():
+    '''Recounts the item counters used for search result totals.'''
+    with app.app_context():
+        item_counts.rebuild()
+        click.echo('Item counters rebuilt.')
+
+
+@item_storage.command('rebuild-listings')
+def rebuild_listings():
+    '''Copies all items into the listings table that searches read.'''
+    with app.app_context():
+        listings.rebuild()
+        click.echo('Listings rebuilt.')
+
+
+@item_storage.command('rebuild-fulltext')
+def rebuild_fulltext():
+    '''Creates the SQLite FTS5 search index if needed and reindexes all items.'''
+    with app.app_context():
+        fulltext.rebuild()
+        click.echo('Full-text index rebuilt.')
+
+
+@item_storage.command('rebuild-file-index')
+@click.option('--batch-size', default=500, show_default=True,
+              help='Number of items to index per transaction.')
+def rebuild_file_index(batch_size):
+    '''Rebuilds the file name search index from the stored file lists.'''
+    with app.app_context():
+        total = 0
+        for last_id, indexed in file_index.rebuild(batch_size):
+            total += indexed
+            click.echo('Indexed {} items (up to item #{}).'.format(indexed, last_id))
+        click.echo('Done, indexed {} items in total.'.format(total))
+
+
+@item_storage.command('prune-blobs')
+@click.option('--dry-run', is_flag=True, help='Only list the blobs that would be deleted.')
+def prune_blobs(dry_run):
+    '''Recounts the links to stored blobs and deletes the unused ones.'''
+    with app.app_context():
+        count = size = 0
+        for digest, blob_size in blobstore.prune(dry_run):
+            count += 1
+            size += blob_size
+            click.echo(digest)
+        click.echo('{} {} unused blobs ({} bytes).'.format(
+            'Found' if dry_run else 'Deleted', count, size))
+
+
+@item_storage.command('prune-uploads')
+@click.option('--dry-run', is_flag=True, help='Only list the uploads that would be deleted.')
+def prune_uploads(dry_run):
+    '''Deletes resumable uploads that haven't received a chunk in a while.'''
+    with app.app_context():
+        expiry = app.config.get('CHUNKED_UPLOAD_EXPIRY', 24 * 60 * 60)
+        count = 0
+        for token in chunked_uploads.prune(expiry, dry_run):
+            count += 1
+            click.echo(token)
+        click.echo('{} {} expired uploads.'.format('Found' if dry_run else 'Deleted', count))
+
+
+@item_storage.command('update-manifests')
+@click.option('--after-id', default=0, show_default=True,
+              help='Resume after this item id.')
+def update_manifests(after_id):
+    '''Hashes the new and changed files of every item into its manifest.'''
+    with app.app_context():
+        total = 0
+        last_id = after_id
+        while True:
+            batch = models.Item.query.filter(models.Item.id > last_id) \
+                .order_by(models.Item.id.asc()).limit(100).all()
+            if not batch:
+                break
+            for item in batch:
+                hashed = jobs.update_manifest(item)
+                total += hashed
+                if hashed:
+                    click.echo('Hashed {} files of item #{}.'.format(hashed, item.id))
+            last_id = batch[-1].id
+        click.echo('Done, hashed {} files in total.'.format(total))
+
+
+@item_storage.command('run-jobs')
+def run_jobs():
+    '''Runs the file manager's copy, move and delete jobs until interrupted.'''
+    click.echo('Waiting for file jobs.')
+    jobs.job_runner.run_forever()
+
+
+if __name__ == '__main__':
+    item_storage()
@@ -1,28 +1,25 @@
 #!/usr/bin/env python3
 
 from datetime import datetime
-from ipaddress import ip_address
+from ipaddress import ip_network
 import sys
 
 import click
 
 from tsuu import create_app, models
+from tsuu.auth_cache import range_ban_cache
 from tsuu.extensions import db
 
 
 def is_cidr_valid(c):
-    '''Checks whether a CIDR range string is valid.'''
-    try:
-        subnet, mask = c.split('/')
-    except ValueError:
-        return False
-    if int(mask) < 1 or int(mask) > 32:
+    '''Checks whether an IPv4 or IPv6 CIDR range string is valid.'''
+    if '/' not in c:
         return False
     try:
-        ip = ip_address(subnet)
+        network = ip_network(c, strict=False)
     except ValueError:
         return False
-    return True
+    return network.prefixlen >= 1
 
 
 def check_str(b):
@@ -42,7 +39,7 @@ def rangeban():
 @click.argument('cidrrange')
 def ban(temp, cidrrange):
     if not is_cidr_valid(cidrrange):
-        click.secho('{} is not of the format xxx.xxx.xxx.xxx/xx.'
+        click.secho('{} is not of the format xxx.xxx.xxx.xxx/xx or xxxx:xxxx::/xx.'
                     .format(cidrrange), err=True, fg='red')
         sys.exit(1)
     with app.app_context():
@@ -57,7 +54,7 @@ def ban(temp, cidrrange):
 @click.argument('cidrrange')
 def unban(cidrrange):
     if not is_cidr_valid(cidrrange):
-        click.secho('{} is not of the format xxx.xxx.xxx.xxx/xx.'
+        click.secho('{} is not of the format xxx.xxx.xxx.xxx/xx or xxxx:xxxx::/xx.'
                     .format(cidrrange), err=True, fg='red')
         sys.exit(1)
     with app.app_context():
@@ -80,9 +77,10 @@ def list():
         if len(bans) == 0:
             click.echo('No bans.')
         else:
-            click.secho('ID     CIDR Range         Enabled Temp', bold=True)
+            click.secho('ID     CIDR Range                                  Enabled Temp',
+                        bold=True)
             for b in bans:
-                click.echo('{0: <6} {1: <18} {2: <7} {3: <4}'
+                click.echo('{0: <6} {1: <43} {2: <7} {3: <4}'
                            .format(b.id, b.cidr_string,
                                    check_str(b.enabled),
                                    check_str(b.temp is not None)))
@@ -114,6 +112,18 @@ def enabled(banid, status):
                                              banid, ban._cidr_string))
 
 
+@rangeban.command()
+def prune():
+    '''Deletes temporary bans that have expired (see RANGEBAN_TEMP_DURATION).'''
+    with app.app_context():
+        cutoff = datetime.utcnow() - range_ban_cache.temp_duration
+        bans = models.RangeBan.query.filter(models.RangeBan.temp < cutoff).all()
+        # One by one, so that the workers drop them from their range ban tries
+        for b in bans:
+            db.session.delete(b)
+        db.session.commit()
+        click.echo('Deleted {} expired temp bans.'.format(len(bans)))
+
 
 if __name__ == '__main__':
     rangeban()
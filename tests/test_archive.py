@@ -0,0 +1,83 @@
+import io
+import os
+import tarfile
+import tempfile
+import unittest
+import zipfile
+from datetime import datetime
+
+from tsuu import archive, filetree
+
+
+class TestArchive(unittest.TestCase):
+
+    def setUp(self):
+        self.tempdir = tempfile.TemporaryDirectory()
+        self.root = self.tempdir.name
+        self.files = {
+            'video.mkv': os.urandom(3000),
+            'extras/nced.mkv': os.urandom(700),
+            'extras/scans/ぼくのぴこ.png': b'',
+            'a' * 120 + '.txt': b'long name',
+        }
+        os.makedirs(os.path.join(self.root, 'extras', 'scans'))
+        os.makedirs(os.path.join(self.root, 'empty'))
+        for path, data in self.files.items():
+            with open(os.path.join(self.root, path), 'wb') as f:
+                f.write(data)
+        self.tree, _ = filetree.scan_tree(self.root)
+        self.mtime = datetime(2020, 5, 17, 12, 30, 10)
+
+    def tearDown(self):
+        self.tempdir.cleanup()
+
+    def _check_ranges(self, built):
+        data = b''.join(built.iter_range())
+        self.assertEqual(len(data), built.size)
+        for start, stop in ((0, 1), (100, 2000), (built.size - 50, built.size), (3100, 3101)):
+            self.assertEqual(b''.join(built.iter_range(start, stop)), data[start:stop])
+        return data
+
+    def test_zip(self):
+        built = archive.zip_archive(self.root, self.tree, 'abc123', self.mtime)
+        data = self._check_ranges(built)
+
+        with zipfile.ZipFile(io.BytesIO(data)) as zf:
+            self.assertIsNone(zf.testzip())
+            for path, contents in self.files.items():
+                self.assertEqual(zf.read('abc123/' + path), contents)
+            self.assertIn('abc123/empty/', zf.namelist())
+            self.assertEqual(zf.getinfo('abc123/video.mkv').date_time, (2020, 5, 17, 12, 30, 10))
+
+    def test_zip_central_directory_only(self):
+        # Resuming inside the central directory needs CRCs of files that weren't streamed
+        built = archive.zip_archive(self.root, self.tree, 'abc123', self.mtime)
+        data = b''.join(archive.zip_archive(self.root, self.tree, 'abc123',
+                                            self.mtime).iter_range())
+        self.assertEqual(b''.join(built.iter_range(built.size - 200)), data[-200:])
+
+    def test_tar(self):
+        built = archive.tar_archive(self.root, self.tree, 'abc123', self.mtime)
+        data = self._check_ranges(built)
+
+        with tarfile.open(fileobj=io.BytesIO(data)) as tf:
+            for path, contents in self.files.items():
+                self.assertEqual(tf.extractfile('abc123/' + path).read(), contents)
+            self.assertTrue(tf.getmember('abc123/empty').isdir())
+
+    def test_single_file(self):
+        path = os.path.join(self.root, 'video.mkv')
+        built = archive.tar_archive(path, 3000, 'video.mkv', self.mtime)
+        with tarfile.open(fileobj=io.BytesIO(b''.join(built.iter_range()))) as tf:
+            self.assertEqual(tf.getnames(), ['video.mkv'])
+
+    def test_changed_file(self):
+        built = archive.zip_archive(self.root, self.tree, 'abc123', self.mtime)
+        with open(os.path.join(self.root, 'video.mkv'), 'wb') as f:
+            f.write(b'short')
+        with self.assertRaises(archive.ArchiveError):
+            b''.join(built.iter_range())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,3 +1,4 @@
+import os
 import unittest
 
 from tsuu import backend
@@ -47,6 +48,13 @@ class TestBackend(unittest.TestCase):
         self.assertEqual(backend.sanitize_string('ayy\x08\x08lmao'), 'ayy\uFFFD\uFFFDlmao')
         self.assertEqual(backend.sanitize_string('ぼくのぴこ'), 'ぼくのぴこ')
 
+    def test_layout_relpath(self):
+        self.assertEqual(backend.layout_relpath('abcdef', 'flat'), 'abcdef')
+        self.assertEqual(backend.layout_relpath('abcdef', 'sharded'),
+                         os.path.join('ab', 'cd', 'abcdef'))
+        # Too short to fan out
+        self.assertEqual(backend.layout_relpath('abc', 'sharded'), 'abc')
+
     @unittest.skip('Not yet implemented')
     def test_handle_torrent_upload(self):
         pass
@@ -0,0 +1,74 @@
+import os
+import shutil
+import stat
+import tempfile
+import unittest
+
+from tsuu import blobstore
+
+
+class TestBlobStore(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.blob = self._write('blob', b'shared data')
+        os.chmod(self.blob, stat.S_IRUSR)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def _write(self, name, data):
+        path = os.path.join(self.directory, name)
+        with open(path, 'wb') as f:
+            f.write(data)
+        return path
+
+    def _read(self, path):
+        with open(path, 'rb') as f:
+            return f.read()
+
+    def test_blob_relpath(self):
+        digest = 'abcdef' + '0' * 58
+        self.assertEqual(blobstore.blob_relpath(digest), os.path.join('ab', 'cd', digest))
+
+    def test_hardlink(self):
+        dest = os.path.join(self.directory, 'linked')
+        self.assertEqual(blobstore.link_file(self.blob, dest, 'hardlink'), 'hardlink')
+        self.assertTrue(os.path.samefile(self.blob, dest))
+        self.assertEqual(os.stat(self.blob).st_nlink, 2)
+
+    def test_reflink_falls_back(self):
+        dest = os.path.join(self.directory, 'cloned')
+        self.assertIn(blobstore.link_file(self.blob, dest, 'reflink'), ('reflink', 'hardlink'))
+        self.assertEqual(self._read(dest), b'shared data')
+
+    def test_copy(self):
+        dest = os.path.join(self.directory, 'copied')
+        self.assertEqual(blobstore.link_file(self.blob, dest, 'copy'), 'copy')
+        self.assertFalse(os.path.samefile(self.blob, dest))
+
+    def test_replace_with_link(self):
+        dest = self._write('existing', b'old data')
+        blobstore.replace_with_link(self.blob, dest, 'hardlink')
+        self.assertTrue(os.path.samefile(self.blob, dest))
+        self.assertEqual(sorted(os.listdir(self.directory)), ['blob', 'existing'])
+
+    def test_copy_file_never_writes_to_links(self):
+        linked = os.path.join(self.directory, 'linked')
+        blobstore.link_file(self.blob, linked, 'hardlink')
+        other = self._write('other', b'other data')
+
+        # Replacing a linked file leaves the blob alone
+        blobstore.copy_file(other, linked)
+        self.assertEqual(self._read(linked), b'other data')
+        self.assertEqual(self._read(self.blob), b'shared data')
+
+        # Copies of linked files are linked again
+        relinked = os.path.join(self.directory, 'relinked')
+        blobstore.link_file(self.blob, linked + '2', 'hardlink')
+        blobstore.copy_file(linked + '2', relinked)
+        self.assertTrue(os.path.samefile(self.blob, relinked))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,94 @@
+import hashlib
+import io
+import os
+import shutil
+import tempfile
+import unittest
+
+from tsuu import chunked_uploads
+
+
+class TestChunkedUploads(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'upload')
+        open(self.path, 'wb').close()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def _write(self, offset, data, size=10, checksum=None):
+        return chunked_uploads.write_chunk(self.path, offset, io.BytesIO(data), size, checksum,
+                                           chunk_size=3)
+
+    def _read(self):
+        with open(self.path, 'rb') as f:
+            return f.read()
+
+    def test_parse_checksum(self):
+        self.assertIsNone(chunked_uploads.parse_checksum(None))
+        self.assertEqual(chunked_uploads.parse_checksum('SHA256 ABCD'), ('sha256', 'abcd'))
+        with self.assertRaises(chunked_uploads.UploadError):
+            chunked_uploads.parse_checksum('crc32 abcd')
+
+    def test_parse_content_range(self):
+        self.assertEqual(chunked_uploads.parse_content_range(None), 0)
+        self.assertEqual(chunked_uploads.parse_content_range('bytes 4096-8191/10000'), 4096)
+        with self.assertRaises(chunked_uploads.UploadError):
+            chunked_uploads.parse_content_range('bytes */10000')
+
+    def test_chunks_in_order(self):
+        self.assertEqual(self._write(0, b'01234'), (5, False))
+        self.assertEqual(self._write(5, b'56789'), (10, True))
+        self.assertEqual(self._read(), b'0123456789')
+
+    def test_chunk_sent_again(self):
+        self._write(0, b'01234')
+        # The response of the last chunk got lost, the client sends it again
+        self.assertEqual(self._write(3, b'3456'), (7, False))
+        self.assertEqual(self._write(0, b'0123'), (7, False))
+        self.assertEqual(self._read(), b'0123456')
+
+    def test_offset_past_the_end(self):
+        self._write(0, b'012')
+        with self.assertRaises(chunked_uploads.OffsetMismatch) as context:
+            self._write(5, b'56789')
+        self.assertEqual(context.exception.offset, 3)
+        self.assertEqual(self._read(), b'012')
+
+    def test_checksum(self):
+        good = ('sha256', hashlib.sha256(b'01234').hexdigest())
+        with self.assertRaises(chunked_uploads.ChecksumMismatch):
+            self._write(0, b'01x34', checksum=good)
+        self.assertEqual(self._read(), b'')
+
+        self.assertEqual(self._write(0, b'01234', checksum=good), (5, False))
+
+    def test_chunk_past_the_size(self):
+        self._write(0, b'01234')
+        with self.assertRaises(chunked_uploads.UploadError):
+            self._write(5, b'56789abc')
+        self.assertEqual(self._read(), b'01234')
+
+    def test_one_chunk_at_a_time(self):
+        with open(self.path, 'r+b') as other, chunked_uploads._locked(other, 10):
+            with self.assertRaises(chunked_uploads.UploadBusy):
+                self._write(0, b'01234')
+        self.assertEqual(self._write(0, b'01234'), (5, False))
+
+    def test_disconnect_keeps_the_data(self):
+        class Disconnecting(io.BytesIO):
+            def read(self, size=-1):
+                data = super().read(size)
+                if not data:
+                    raise IOError('Client disconnected')
+                return data
+
+        with self.assertRaises(IOError):
+            chunked_uploads.write_chunk(self.path, 0, Disconnecting(b'0123'), 10, chunk_size=3)
+        self.assertEqual(self._read(), b'0123')
+
+
+if __name__ == '__main__':
+    unittest.main()
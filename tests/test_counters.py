@@ -0,0 +1,59 @@
+import unittest
+from unittest import mock
+
+from tsuu import counters
+
+
+class TestDownloadCounter(unittest.TestCase):
+
+    def test_group_increments(self):
+        groups = counters.group_increments({1: 3, 2: 1, 3: 3, 4: 0})
+        self.assertEqual(dict(groups), {3: [1, 3], 1: [2]})
+
+    def test_take_pending(self):
+        counter = counters.DownloadCounter()
+        counter._ensure_flusher = lambda: None
+        counter.record(1)
+        counter.record(1)
+        counter.record(2, count=5)
+
+        self.assertEqual(counter._take_pending(), {1: 2, 2: 5})
+        self.assertEqual(counter._take_pending(), {})
+
+    def test_failed_flush_keeps_the_counts(self):
+        counter = counters.DownloadCounter()
+        counter._ensure_flusher = lambda: None
+        counter.record(1)
+        counter.record(2, count=5)
+
+        with mock.patch.object(counters, 'db') as db:
+            db.session.execute.side_effect = RuntimeError('Deadlock found')
+            with self.assertRaises(RuntimeError):
+                counter.flush()
+            db.session.rollback.assert_called_once_with()
+
+        counter.record(1)
+        self.assertEqual(counter._take_pending(), {1: 2, 2: 5})
+
+
+class TestLoginIpWriter(unittest.TestCase):
+
+    def test_failed_flush_keeps_the_ips(self):
+        writer = counters.LoginIpWriter()
+        writer._ensure_flusher = lambda: None
+        writer.record(1, b'old')
+        writer.record(2, b'two')
+
+        with mock.patch.object(counters, 'db') as db:
+            db.session.commit.side_effect = RuntimeError('Lost connection')
+            # User 1 comes back from another address while the flush runs
+            db.session.execute.side_effect = lambda *args: writer.record(1, b'new')
+            with self.assertRaises(RuntimeError):
+                writer.flush()
+            db.session.rollback.assert_called_once_with()
+
+        self.assertEqual(writer._pending, {1: b'new', 2: b'two'})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,64 @@
+import unittest
+
+from tsuu import file_index, models
+
+
+class TestFileIndex(unittest.TestCase):
+
+    def test_name_terms(self):
+        self.assertEqual(file_index.name_terms('[Group] Show - 01 (1080p).MKV'),
+                         {'group', 'show', '01', '1080p', 'mkv', '.mkv'})
+        self.assertEqual(file_index.name_terms('Extras'), {'extras'})
+
+    def test_pattern_terms(self):
+        self.assertEqual(file_index.pattern_terms('*.flac'), {'.flac'})
+        self.assertEqual(file_index.pattern_terms('.FLAC'), {'.flac'})
+        self.assertEqual(file_index.pattern_terms('Show 01.mkv'), {'show', '01', 'mkv'})
+
+    def test_split_file_patterns(self):
+        rest, patterns = file_index.split_file_patterns('show file:"ncop 01" -bad FILE:*.mkv')
+        self.assertEqual(rest, 'show -bad')
+        self.assertEqual(patterns, [{'ncop', '01'}, {'.mkv'}])
+        self.assertEqual(file_index.split_file_patterns('profile:x'), ('profile:x', []))
+
+    def test_index_rows(self):
+        rows = list(file_index.index_rows(7, {'Extras': {'NCOP.mkv': 10}}))
+        self.assertEqual(sorted((row['path'], row['term']) for row in rows), [
+            ('Extras/', 'extras'),
+            ('Extras/NCOP.mkv', '.mkv'),
+            ('Extras/NCOP.mkv', 'mkv'),
+            ('Extras/NCOP.mkv', 'ncop'),
+        ])
+        self.assertTrue(all(row['item_id'] == 7 for row in rows))
+
+    def test_index_rows_below(self):
+        rows = file_index.index_rows(7, {'NCOP.mkv': 10}, ['Extras'])
+        self.assertEqual(set(row['path'] for row in rows), {'Extras/NCOP.mkv'})
+
+    def test_long_paths(self):
+        # Deep items with long names, like many torrents have
+        tree = node = {}
+        for depth in range(6):
+            node['Disc {} '.format(depth) + 'x' * 200] = node = {}
+        node['Episode 01.mkv'] = 10
+
+        longest = max((row['path'] for row in file_index.index_rows(7, tree)), key=len)
+        self.assertGreater(len(longest), 1024)
+        self.assertTrue(longest.endswith('/Episode 01.mkv'))
+        # The path column doesn't cut them off (or reject them, on MySQL)
+        length = models.FileTerm.__table__.c.path.type.length
+        self.assertTrue(length is None or length >= len(longest))
+
+    def test_touched_roots(self):
+        roots, parents = file_index.touched_roots([
+            (['Extras'], None),
+            (['Extras', 'NCOP.mkv'], None),
+            (['Specials', 'OVA', 'OVA 01.mkv'], 10),
+            (['Specials', 'OVA', 'OVA 01.mkv'], 10),
+        ])
+        self.assertEqual(roots, {('Extras',): None, ('Specials', 'OVA', 'OVA 01.mkv'): 10})
+        self.assertEqual(parents, {('Specials',), ('Specials', 'OVA')})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,93 @@
+import os
+import tempfile
+import unittest
+
+from werkzeug.test import Client
+from werkzeug.wrappers import BaseResponse
+
+from tsuu import file_serving
+
+
+class TestFileServing(unittest.TestCase):
+
+    def setUp(self):
+        fd, self.path = tempfile.mkstemp()
+        self.data = bytes(range(256)) * 4
+        with os.fdopen(fd, 'wb') as f:
+            f.write(self.data)
+        self.etag = file_serving.file_etag(os.stat(self.path))
+
+        def app(environ, start_response):
+            return file_serving.send_file(environ, self.path)(environ, start_response)
+        self.client = Client(app, BaseResponse)
+
+    def tearDown(self):
+        os.unlink(self.path)
+
+    def test_full_response(self):
+        rv = self.client.get('/')
+        self.assertEqual(rv.status_code, 200)
+        self.assertEqual(rv.data, self.data)
+        self.assertEqual(rv.headers['ETag'], '"{}"'.format(self.etag))
+        self.assertEqual(rv.headers['Accept-Ranges'], 'bytes')
+        self.assertEqual(rv.headers['Content-Length'], str(len(self.data)))
+
+    def test_head(self):
+        rv = self.client.head('/')
+        self.assertEqual(rv.status_code, 200)
+        self.assertEqual(rv.data, b'')
+        self.assertEqual(rv.headers['Content-Length'], str(len(self.data)))
+
+    def test_not_modified(self):
+        rv = self.client.get('/', headers={'If-None-Match': '"{}"'.format(self.etag)})
+        self.assertEqual(rv.status_code, 304)
+        self.assertEqual(rv.data, b'')
+
+        last_modified = self.client.get('/').headers['Last-Modified']
+        rv = self.client.get('/', headers={'If-Modified-Since': last_modified})
+        self.assertEqual(rv.status_code, 304)
+
+        rv = self.client.get('/', headers={'If-None-Match': '"something-else"'})
+        self.assertEqual(rv.status_code, 200)
+
+    def test_range(self):
+        rv = self.client.get('/', headers={'Range': 'bytes=100-199'})
+        self.assertEqual(rv.status_code, 206)
+        self.assertEqual(rv.data, self.data[100:200])
+        self.assertEqual(rv.headers['Content-Range'], 'bytes 100-199/1024')
+
+        rv = self.client.get('/', headers={'Range': 'bytes=-24'})
+        self.assertEqual(rv.status_code, 206)
+        self.assertEqual(rv.data, self.data[-24:])
+
+    def test_unsatisfiable_range(self):
+        rv = self.client.get('/', headers={'Range': 'bytes=5000-'})
+        self.assertEqual(rv.status_code, 416)
+        self.assertEqual(rv.headers['Content-Range'], 'bytes */1024')
+
+    def test_if_range(self):
+        headers = {'Range': 'bytes=0-9', 'If-Range': '"{}"'.format(self.etag)}
+        rv = self.client.get('/', headers=headers)
+        self.assertEqual(rv.status_code, 206)
+        self.assertEqual(rv.data, self.data[:10])
+
+        # A stale validator gets the whole (changed) file instead
+        headers['If-Range'] = '"stale"'
+        rv = self.client.get('/', headers=headers)
+        self.assertEqual(rv.status_code, 200)
+        self.assertEqual(rv.data, self.data)
+
+    def test_offload(self):
+        rv = file_serving.offload_file('x-accel', self.path, '/internal/abc123/ä b.mkv')
+        self.assertEqual(rv.headers['X-Accel-Redirect'], '/internal/abc123/%C3%A4%20b.mkv')
+        self.assertEqual(rv.get_data(), b'')
+
+        rv = file_serving.offload_file('x-sendfile', self.path, None)
+        self.assertEqual(rv.headers['X-Sendfile'], os.path.abspath(self.path))
+
+        with self.assertRaises(ValueError):
+            file_serving.offload_file('carrier-pigeon', self.path, None)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,76 @@
+import json
+import unittest
+
+from tsuu import filelist
+
+
+class TestFilelist(unittest.TestCase):
+
+    def setUp(self):
+        self.tree = {
+            'abc123': {
+                'video.mkv': 1000,
+                'Extras': {
+                    'nced.mkv': 200,
+                    'scans': {
+                        'cover.png': 50,
+                        'back.png': 30,
+                    },
+                    'empty': {},
+                },
+                'ぼくのぴこ.txt': 7,
+            },
+        }
+
+    def test_round_trip(self):
+        blob = filelist.encode(self.tree)
+        self.assertTrue(filelist.is_binary(blob))
+        self.assertEqual(filelist.decode(blob), self.tree)
+
+    def test_legacy_json(self):
+        blob = json.dumps(self.tree, separators=(',', ':')).encode('utf8')
+        self.assertFalse(filelist.is_binary(blob))
+        self.assertEqual(filelist.decode(blob), self.tree)
+        self.assertEqual(len(filelist.FilelistReader(blob)), 5)
+
+    def test_listdir(self):
+        reader = filelist.FilelistReader(filelist.encode(self.tree))
+        self.assertEqual(reader.file_count, 5)
+        # Directories first, then files, sorted by name
+        self.assertEqual(reader.listdir(['abc123']), [
+            ('Extras', True, 280),
+            ('video.mkv', False, 1000),
+            ('ぼくのぴこ.txt', False, 7),
+        ])
+        self.assertEqual(reader.listdir(['abc123', 'Extras'], offset=1, limit=1),
+                         [('scans', True, 80)])
+        self.assertEqual(reader.count_children(['abc123', 'Extras']), 3)
+        self.assertIsNone(reader.listdir(['abc123', 'video.mkv']))
+        self.assertIsNone(reader.listdir(['abc123', 'missing']))
+
+    def test_find(self):
+        reader = filelist.FilelistReader(filelist.encode(self.tree))
+        for parts in (['abc123', 'Extras', 'scans', 'back.png'], ['abc123', 'ぼくのぴこ.txt'],
+                      ['abc123', 'Extras', 'empty']):
+            self.assertEqual(reader.node(reader.find(parts))[0], parts[-1])
+        self.assertIsNone(reader.find(['abc123', 'video.mkv', 'nope']))
+
+    def test_partial_decode(self):
+        reader = filelist.FilelistReader(filelist.encode(self.tree))
+        self.assertEqual(reader.to_dict(['abc123', 'Extras', 'scans']),
+                         {'back.png': 30, 'cover.png': 50})
+        self.assertEqual(reader.to_dict(['abc123'], limit=2), {
+            'Extras': {
+                'empty': {},
+                'scans': {'back.png': 30, 'cover.png': 50},
+            },
+        })
+
+    def test_truncated(self):
+        blob = filelist.encode(self.tree)
+        with self.assertRaises(filelist.FilelistFormatError):
+            filelist.FilelistReader(blob[:-1])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,120 @@
+import os
+import tempfile
+import unittest
+
+from tsuu import filetree
+
+
+class TestFileTree(unittest.TestCase):
+
+    def setUp(self):
+        self.tree = {
+            'video.mkv': 1000,
+            'extras': {
+                'nced.mkv': 200,
+                'scans': {
+                    'cover.png': 50,
+                },
+            },
+        }
+
+    def test_split_path(self):
+        self.assertEqual(filetree.split_path('extras//scans/./cover.png'),
+                         ['extras', 'scans', 'cover.png'])
+        self.assertEqual(filetree.split_path('.'), [])
+        with self.assertRaises(filetree.FileTreeError):
+            filetree.split_path('extras/../../etc')
+
+    def test_tree_size(self):
+        self.assertEqual(filetree.tree_size(self.tree), 1250)
+        self.assertEqual(filetree.tree_size({}), 0)
+
+    def test_walk_tree(self):
+        paths = [('/'.join(parts), isinstance(node, dict))
+                 for parts, node in filetree.walk_tree(self.tree)]
+        self.assertEqual(paths, [('video.mkv', False), ('extras', True),
+                                 ('extras/nced.mkv', False), ('extras/scans', True),
+                                 ('extras/scans/cover.png', False)])
+
+    def test_add_and_remove(self):
+        delta, touched = filetree.apply_changes(self.tree, [
+            ('add', 'new/folder/file.txt', 10),
+            ('remove', 'extras/scans'),
+        ])
+        self.assertEqual(delta, -40)
+        self.assertEqual(self.tree['new'], {'folder': {'file.txt': 10}})
+        self.assertNotIn('scans', self.tree['extras'])
+        self.assertIn((['extras', 'scans'], None), touched)
+
+    def test_replace_file(self):
+        delta, _ = filetree.apply_changes(self.tree, [('add', 'video.mkv', 1500)])
+        self.assertEqual(delta, 500)
+
+    def test_rename(self):
+        delta, touched = filetree.apply_changes(self.tree, [('rename', 'extras', 'bonus')])
+        self.assertEqual(delta, 0)
+        self.assertIn('bonus', self.tree)
+        self.assertNotIn('extras', self.tree)
+        self.assertEqual(touched, [(['extras'], None), (['bonus'], self.tree['bonus'])])
+
+    def test_copy_merges_directories(self):
+        self.tree['bonus'] = {'scans': {'back.png': 30}}
+        delta, _ = filetree.apply_changes(self.tree, [('copy', 'extras', 'bonus')])
+        self.assertEqual(delta, 250)
+        self.assertEqual(self.tree['bonus'], {
+            'nced.mkv': 200,
+            'scans': {'back.png': 30, 'cover.png': 50},
+        })
+        # The source must not be shared with the copy
+        self.tree['bonus']['scans']['cover.png'] = 1
+        self.assertEqual(self.tree['extras']['scans']['cover.png'], 50)
+
+    def test_move_into_directory(self):
+        delta, touched = filetree.apply_changes(self.tree, [('move', 'video.mkv', 'extras')])
+        self.assertEqual(delta, 0)
+        self.assertEqual(self.tree['extras']['video.mkv'], 1000)
+        self.assertEqual(touched[-1], (['extras', 'video.mkv'], 1000))
+
+    def test_sync(self):
+        delta, touched = filetree.apply_changes(self.tree, [
+            ('sync', 'extras/scans', {'cover.png': 50, 'back.png': 30}),
+            ('sync', 'video.mkv', None),
+            ('sync', 'never/there', None),
+        ])
+        self.assertEqual(delta, -970)
+        self.assertEqual(self.tree, {'extras': {'nced.mkv': 200,
+                                                'scans': {'cover.png': 50, 'back.png': 30}}})
+        self.assertEqual(touched[1:], [(['video.mkv'], None), (['never', 'there'], None)])
+
+    def test_missing_path(self):
+        with self.assertRaises(filetree.FileTreeError):
+            filetree.apply_changes(self.tree, [('remove', 'nothing/here')])
+        with self.assertRaises(filetree.FileTreeError):
+            filetree.apply_changes(self.tree, [('copy', 'nothing', 'else')])
+
+    def test_scan_tree(self):
+        with tempfile.TemporaryDirectory() as root:
+            os.makedirs(os.path.join(root, 'extras', 'scans'))
+            os.makedirs(os.path.join(root, 'empty'))
+            for path, size in (('video.mkv', 1000), ('extras/nced.mkv', 200),
+                               ('extras/scans/cover.png', 50)):
+                with open(os.path.join(root, path), 'wb') as f:
+                    f.write(b'\0' * size)
+
+            expected = dict(self.tree, empty={})
+            self.assertEqual(filetree.scan_tree(root), (expected, 1250))
+            self.assertEqual(filetree.scan_tree(root, workers=2), (expected, 1250))
+            self.assertEqual(filetree.scan_tree(os.path.join(root, 'video.mkv')), (1000, 1000))
+
+            listing = filetree.list_directory(root)
+            self.assertEqual([entry[:3] for entry in listing], [
+                ('empty', True, None),
+                ('extras', True, None),
+                ('video.mkv', False, 1000),
+            ])
+            # Exact mtimes, for manifest lookups
+            self.assertEqual(listing[2][4], os.stat(os.path.join(root, 'video.mkv')).st_mtime_ns)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,43 @@
+import unittest
+from datetime import datetime
+from types import SimpleNamespace
+
+import flask
+
+from tsuu import fragments
+
+
+class TestRowKey(unittest.TestCase):
+
+    def setUp(self):
+        self.app = flask.Flask(__name__)
+        self.app.config['COMMIT_HASH'] = 'abc123'
+        self.item = SimpleNamespace(id=1, updated_time=datetime(2020, 1, 1), flags=0,
+                                    comment_count=0, seed_count=0, leech_count=0,
+                                    download_count=0)
+
+    def test_changes_with_everything_shown(self):
+        changes = {
+            'updated_time': datetime(2020, 1, 1, 0, 0, 1),
+            'flags': 32,
+            'comment_count': 1,
+            'seed_count': 2,
+            'leech_count': 3,
+            'download_count': 4,
+        }
+        with self.app.app_context():
+            key = fragments._row_key(self.item)
+            self.assertEqual(fragments._row_key(SimpleNamespace(**vars(self.item))), key)
+            for name, value in changes.items():
+                changed = SimpleNamespace(**dict(vars(self.item), **{name: value}))
+                self.assertNotEqual(fragments._row_key(changed), key, name)
+
+    def test_changes_with_deploy(self):
+        with self.app.app_context():
+            key = fragments._row_key(self.item)
+            self.app.config['COMMIT_HASH'] = 'def456'
+            self.assertNotEqual(fragments._row_key(self.item), key)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,26 @@
+import unittest
+
+from tsuu.fulltext import match_expression
+
+
+class TestFulltext(unittest.TestCase):
+
+    def test_words(self):
+        self.assertEqual(match_expression('zero season'), '"zero" AND "season"')
+        self.assertEqual(match_expression('re:zero'), '"re:zero"')
+
+    def test_phrases_and_prefixes(self):
+        self.assertEqual(match_expression('"season 2" zer*'), '"season 2" AND "zer"*')
+        self.assertEqual(match_expression('say "hi""'), '"say" AND "hi"')
+
+    def test_excluded(self):
+        self.assertEqual(match_expression('zero -two -"season 2"'),
+                         '("zero") NOT "two" NOT "season 2"')
+
+    def test_nothing_to_search(self):
+        self.assertIsNone(match_expression(''))
+        self.assertIsNone(match_expression('*** -zero'))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,50 @@
+import unittest
+from ipaddress import ip_address
+
+from tsuu import iptrie
+
+
+class TestPrefixTrie(unittest.TestCase):
+
+    def setUp(self):
+        self.trie = iptrie.PrefixTrie()
+        self.trie.add('10.0.0.0/8', 1)
+        self.trie.add('10.1.2.0/24', 2, 'temp')
+        self.trie.add('192.168.1.7/32', 3)
+        self.trie.add('2001:db8::/32', 4)
+
+    def keys(self, address):
+        return [key for key, _ in self.trie.matches(address)]
+
+    def test_ipv4(self):
+        self.assertEqual(self.keys('10.1.2.3'), [1, 2])
+        self.assertEqual(self.keys('10.200.0.1'), [1])
+        self.assertEqual(self.keys(ip_address('192.168.1.7').packed), [3])
+        self.assertEqual(self.keys('192.168.1.8'), [])
+        self.assertEqual(dict(self.trie.matches('10.1.2.3'))[2], 'temp')
+
+    def test_ipv6(self):
+        self.assertEqual(self.keys('2001:db8:1::1'), [4])
+        self.assertEqual(self.keys(ip_address('2001:db9::1').packed), [])
+        # IPv4 networks never match IPv6 addresses
+        self.assertEqual(self.keys('::a00:1'), [])
+
+    def test_remove(self):
+        self.assertEqual(len(self.trie), 4)
+        self.assertTrue(self.trie.remove('10.1.2.0/24', 2))
+        self.assertFalse(self.trie.remove('10.1.2.0/24', 2))
+        self.assertFalse(self.trie.remove('172.16.0.0/12', 1))
+        self.assertEqual(self.keys('10.1.2.3'), [1])
+        self.assertEqual(len(self.trie), 3)
+
+    def test_host_bits_are_ignored(self):
+        self.trie.add('172.16.5.4/12', 5)
+        self.assertEqual(self.keys('172.31.255.255'), [5])
+
+    def test_match_all(self):
+        self.trie.add('0.0.0.0/0', 6)
+        self.assertEqual(self.keys('8.8.8.8'), [6])
+
+
+if __name__ == '__main__':
+    unittest.main()
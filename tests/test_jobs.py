@@ -0,0 +1,154 @@
+import logging
+import os
+import shutil
+import tempfile
+import time
+import unittest
+from datetime import datetime, timedelta
+from unittest import mock
+
+import sqlalchemy
+from sqlalchemy.pool import StaticPool
+from tsuu import jobs, models
+
+
+class CountingProgress(object):
+
+    def __init__(self):
+        self.done = 0
+
+    def add(self, count=1):
+        self.done += count
+
+
+class TestFileJobs(unittest.TestCase):
+
+    def setUp(self):
+        self.base_dir = tempfile.mkdtemp()
+        os.makedirs(os.path.join(self.base_dir, 'dir', 'sub'))
+        for path in ('a.txt', 'dir/b.txt', 'dir/sub/c.txt'):
+            with open(os.path.join(self.base_dir, path), 'w') as f:
+                f.write(path)
+
+    def tearDown(self):
+        shutil.rmtree(self.base_dir)
+
+    def _path(self, path):
+        return os.path.join(self.base_dir, path)
+
+    def test_count_files(self):
+        self.assertEqual(jobs.count_files(self._path('a.txt')), 1)
+        self.assertEqual(jobs.count_files(self._path('dir')), 2)
+
+    def test_resolve_rejects_escapes(self):
+        self.assertEqual(jobs.resolve(self.base_dir, 'dir/b.txt'), self._path('dir/b.txt'))
+        with self.assertRaises(jobs.FileJobError):
+            jobs.resolve(self.base_dir, '../outside')
+
+    def test_copy(self):
+        progress = CountingProgress()
+        changes = jobs._run_operations('copy', self.base_dir,
+                                       [('dir', 'copy'), ('a.txt', 'copy/a.txt')], progress)
+        self.assertEqual(changes, [('copy', 'dir', 'copy'), ('copy', 'a.txt', 'copy/a.txt')])
+        self.assertTrue(os.path.isfile(self._path('copy/sub/c.txt')))
+        self.assertTrue(os.path.isfile(self._path('copy/a.txt')))
+        self.assertTrue(os.path.isfile(self._path('a.txt')))
+        self.assertEqual(progress.done, 3)
+
+    def test_move(self):
+        progress = CountingProgress()
+        changes = jobs._run_operations('move', self.base_dir, [('dir', 'moved')], progress)
+        self.assertEqual(changes, [('move', 'dir', 'moved')])
+        self.assertFalse(os.path.exists(self._path('dir')))
+        self.assertTrue(os.path.isfile(self._path('moved/sub/c.txt')))
+        self.assertEqual(progress.done, 2)
+
+    def test_remove(self):
+        progress = CountingProgress()
+        changes = jobs._run_operations('remove', self.base_dir,
+                                       [('dir', None), ('a.txt', None)], progress)
+        self.assertEqual(changes, [('remove', 'dir'), ('remove', 'a.txt')])
+        self.assertEqual(os.listdir(self.base_dir), [])
+        self.assertEqual(progress.done, 3)
+
+    def test_batch(self):
+        progress = CountingProgress()
+        changes, results = jobs._run_batch(self.base_dir, [
+            ('rename', 'a.txt', 'renamed.txt'),
+            ('rename', 'renamed.txt', 'dir'),
+            ('copy', 'missing.txt', 'copy.txt'),
+            ('move', 'dir/b.txt', 'b.txt'),
+            ('remove', 'dir/sub', None),
+        ], progress)
+        # The paths of failed operations are read from disk again, after the whole batch
+        self.assertEqual(changes, [('rename', 'a.txt', 'renamed.txt'),
+                                   ('move', 'dir/b.txt', 'b.txt'),
+                                   ('remove', 'dir/sub'),
+                                   ('sync', 'renamed.txt', 5),
+                                   ('sync', 'dir', {}),
+                                   ('sync', 'missing.txt', None),
+                                   ('sync', 'copy.txt', None)])
+        # Failed operations don't stop the batch
+        self.assertEqual([result['status'] for result in results],
+                         ['done', 'failed', 'failed', 'done', 'done'])
+        self.assertEqual(sorted(os.listdir(self.base_dir)), ['b.txt', 'dir', 'renamed.txt'])
+        self.assertEqual(os.listdir(self._path('dir')), [])
+        self.assertEqual(progress.done, 5)
+
+
+class TestHeartbeat(unittest.TestCase):
+
+    def setUp(self):
+        # One connection, shared with the heartbeat thread
+        self.engine = sqlalchemy.create_engine('sqlite://', poolclass=StaticPool,
+                                               connect_args={'check_same_thread': False})
+        self.table = models.FileJob.__table__
+        self.table.create(self.engine)
+        self.long_ago = datetime.utcnow() - timedelta(hours=1)
+        self.engine.execute(self.table.insert(), [
+            dict(id=1, item_id=1, action='copy', operations='[]', updated_time=self.long_ago,
+                 status=models.FileJobStatus.RUNNING),
+            dict(id=2, item_id=1, action='copy', operations='[]', updated_time=self.long_ago,
+                 status=models.FileJobStatus.DONE)])
+
+    def tearDown(self):
+        self.engine.dispose()
+
+    def _updated_time(self, job_id):
+        return self.engine.execute(sqlalchemy.select([self.table.c.updated_time])
+                                   .where(self.table.c.id == job_id)).scalar()
+
+    def test_touches_running_jobs(self):
+        logger = logging.getLogger(__name__)
+        for job_id in (1, 2):
+            with jobs._Heartbeat(self.engine, job_id, 0.01, logger):
+                # A file that takes long to copy
+                time.sleep(0.1)
+
+        self.assertGreater(self._updated_time(1), self.long_ago)
+        self.assertEqual(self._updated_time(2), self.long_ago)
+
+    def test_touched_during_a_slow_copy(self):
+        base_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, base_dir)
+        with open(os.path.join(base_dir, 'big.mkv'), 'wb') as f:
+            f.write(b'big')
+
+        touched = []
+
+        def slow_copy(src, dest):
+            # Blocks without yielding, like copying one big file
+            time.sleep(0.2)
+            touched.append(self._updated_time(1))
+            return shutil.copyfile(src, dest)
+
+        with mock.patch.object(jobs.blobstore, 'copy_file', slow_copy):
+            with jobs._Heartbeat(self.engine, 1, 0.01, logging.getLogger(__name__)):
+                jobs._run_operations('copy', base_dir, [('big.mkv', 'copy.mkv')],
+                                     CountingProgress())
+
+        self.assertGreater(touched[0], self.long_ago)
+
+
+if __name__ == '__main__':
+    unittest.main()
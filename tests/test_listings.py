@@ -0,0 +1,20 @@
+import unittest
+
+from tsuu import listings, models
+
+
+class TestListingColumns(unittest.TestCase):
+
+    def test_copies_every_column(self):
+        copied = {'id'} | set(listings.ITEM_COLUMNS) | set(listings.STATISTIC_COLUMNS)
+        self.assertEqual(set(models.Listing.__table__.columns.keys()), copied)
+
+    def test_columns_exist_on_sources(self):
+        for name in listings.ITEM_COLUMNS:
+            self.assertIn(name, models.Item.__table__.columns)
+        for name in listings.STATISTIC_COLUMNS:
+            self.assertIn(name, models.Statistic.__table__.columns)
+
+
+if __name__ == '__main__':
+    unittest.main()
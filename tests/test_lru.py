@@ -0,0 +1,42 @@
+import time
+import unittest
+
+from tsuu.lru import LRUCache
+
+
+class TestLRUCache(unittest.TestCase):
+
+    def test_evicts_least_recently_used(self):
+        cache = LRUCache(max_entries=2)
+        cache.put('a', 1)
+        cache.put('b', 2)
+        self.assertEqual(cache.get('a'), 1)
+        cache.put('c', 3)
+
+        self.assertEqual(len(cache), 2)
+        self.assertIsNone(cache.get('b'))
+        self.assertEqual(cache.get('a'), 1)
+        self.assertEqual(cache.get('c'), 3)
+
+    def test_expiry(self):
+        cache = LRUCache(expiry=60)
+        cache.put('a', 1, expiry=0.01)
+        cache.put('b', 2)
+        time.sleep(0.02)
+
+        self.assertEqual(cache.get('a', 'missing'), 'missing')
+        self.assertEqual(cache.get('b'), 2)
+        self.assertEqual(len(cache), 1)
+
+    def test_pop_and_clear(self):
+        cache = LRUCache()
+        cache.put('a', 0)
+        cache.put('b', 2)
+        self.assertEqual(cache.pop('a'), 0)
+        self.assertIsNone(cache.pop('a'))
+        cache.clear()
+        self.assertEqual(len(cache), 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
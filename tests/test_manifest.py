@@ -0,0 +1,84 @@
+import hashlib
+import os
+import shutil
+import tempfile
+import time
+import unittest
+from concurrent.futures import ThreadPoolExecutor
+
+from tsuu import manifest
+
+
+class TestManifest(unittest.TestCase):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        os.makedirs(os.path.join(self.root, 'dir'))
+        self._write('a.txt', b'first')
+        self._write('dir/b.txt', b'second')
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def _write(self, path, data):
+        with open(os.path.join(self.root, *path.split('/')), 'wb') as f:
+            f.write(data)
+
+    def _build(self, previous=None):
+        entries, stale = manifest.plan(self.root, previous, 'sha256')
+        hashed = dict(manifest.hash_files(self.root, stale, 'sha256'))
+        entries.update(hashed)
+        return manifest.make('sha256', entries), sorted(hashed)
+
+    def test_hash_file(self):
+        self.assertEqual(manifest.hash_file(os.path.join(self.root, 'a.txt'), 'sha256'),
+                         hashlib.sha256(b'first').hexdigest())
+
+    def test_hash_files_in_pool(self):
+        entries, stale = manifest.plan(self.root, None, 'sha256')
+        waits = []
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            # Holds up the pool, the way hashing one big file would
+            executor.submit(time.sleep, 0.2)
+            hashed = dict(manifest.hash_files(self.root, stale, 'sha256', executor,
+                                              lambda: waits.append(True), 0.01))
+        self.assertEqual(hashed['a.txt'][2], hashlib.sha256(b'first').hexdigest())
+        self.assertEqual(sorted(hashed), ['a.txt', 'dir/b.txt'])
+        self.assertTrue(waits)
+
+    def test_stat_files(self):
+        files = manifest.stat_files(self.root)
+        self.assertEqual(sorted(files), ['a.txt', 'dir/b.txt'])
+        self.assertEqual(files['dir/b.txt'][0], 6)
+
+    def test_only_changed_files_are_hashed(self):
+        item_manifest, hashed = self._build()
+        self.assertEqual(hashed, ['a.txt', 'dir/b.txt'])
+
+        item_manifest, hashed = self._build(item_manifest)
+        self.assertEqual(hashed, [])
+
+        self._write('dir/b.txt', b'changed')
+        item_manifest, hashed = self._build(item_manifest)
+        self.assertEqual(hashed, ['dir/b.txt'])
+        self.assertEqual(item_manifest['files']['dir/b.txt'][2],
+                         hashlib.sha256(b'changed').hexdigest())
+
+    def test_algorithm_change_rehashes(self):
+        item_manifest, _ = self._build()
+        entries, stale = manifest.plan(self.root, item_manifest, 'blake2b')
+        self.assertEqual(entries, {})
+        self.assertEqual(sorted(stale), ['a.txt', 'dir/b.txt'])
+
+    def test_encode_and_lookup(self):
+        item_manifest = manifest.decode(manifest.encode(self._build()[0]))
+        size, mtime_ns, digest = item_manifest['files']['a.txt']
+        self.assertEqual(manifest.lookup(item_manifest, 'a.txt', size, mtime_ns), digest)
+        # Stale entries are never returned
+        self.assertIsNone(manifest.lookup(item_manifest, 'a.txt', size + 1, mtime_ns))
+        self.assertIsNone(manifest.lookup(item_manifest, 'missing', size, mtime_ns))
+        self.assertIsNone(manifest.lookup(None, 'a.txt', size, mtime_ns))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,91 @@
+import unittest
+from datetime import datetime
+
+import sqlalchemy
+from sqlalchemy.orm import Session
+from tsuu import models, search
+
+
+class TestSearchCursor(unittest.TestCase):
+
+    def test_cursor_round_trip(self):
+        token = search.encode_cursor('size', 'desc', 1 << 40, 12345)
+        self.assertNotIn('=', token)
+        self.assertEqual(search.decode_cursor(token, 'size', 'desc'), (1 << 40, 12345))
+
+    def test_cursor_for_other_ordering(self):
+        token = search.encode_cursor('id', 'desc', 10, 10)
+        with self.assertRaises(ValueError):
+            search.decode_cursor(token, 'id', 'asc')
+        with self.assertRaises(ValueError):
+            search.decode_cursor(token, 'seeders', 'desc')
+
+    def test_malformed_cursor(self):
+        for token in ('', '!!!', 'bm9wZQ', search.encode_cursor('id', 'desc', 'a', 1)):
+            with self.assertRaises(ValueError):
+                search.decode_cursor(token, 'id', 'desc')
+
+
+class TestSearchShapes(unittest.TestCase):
+
+    def test_common_shapes(self):
+        shapes = list(search.common_shapes())
+        self.assertEqual(len(shapes), len(set(shapes)))
+
+        for shape in shapes:
+            self.assertIn(shape.sort, search.SORT_KEYS)
+            self.assertIn(shape.quality_filter, search.FILTER_FLAGS)
+            self.assertFalse(shape.fts or shape.mysql_words or shape.file_patterns)
+            if shape.rss:
+                self.assertEqual((shape.sort, shape.order, shape.paging), ('id', 'desc', 'rss'))
+
+    def test_filter_shape_ignores_ordering(self):
+        shape = next(search.common_shapes())
+        self.assertEqual(search._filter_shape(shape._replace(sort='size', order='asc')),
+                         search._filter_shape(shape))
+
+
+class TestRssPaging(unittest.TestCase):
+
+    def setUp(self):
+        self.engine = sqlalchemy.create_engine('sqlite://')
+        models.Listing.__table__.create(self.engine)
+        now = datetime.utcnow()
+        self.engine.execute(models.Listing.__table__.insert(), [
+            dict(id=i, display_name='Item {}'.format(i), item_directory=str(i),
+                 main_category_id=1, sub_category_id=1, created_time=now, updated_time=now)
+            for i in range(1, 11)])
+        self.session = Session(bind=self.engine)
+
+    def tearDown(self):
+        self.session.close()
+        self.engine.dispose()
+
+    def _feed(self, after=None):
+        shape = next(shape for shape in search.common_shapes() if shape.rss)
+        shape = shape._replace(paging=search._paging(True, after))
+        query = search._paged(search._ordered(self.session.query(models.Listing), shape), shape)
+        params = {'limit': 3}
+        if after:
+            params['after_value'], params['after_id'] = search.decode_cursor(after, 'id', 'desc')
+        return [item.id for item in query.params(**params)]
+
+    def test_paging(self):
+        self.assertEqual(search._paging(True, None), 'rss')
+        self.assertEqual(search._paging(True, 'token'), 'rss_keyset')
+        self.assertEqual(search._paging(False, 'token'), 'keyset')
+        self.assertEqual(search._paging(False, None), 'page')
+
+    def test_second_page_starts_after_the_cursor(self):
+        first_page = self._feed()
+        self.assertEqual(first_page, [10, 9, 8])
+
+        # The rel="next" link of the feed, see views.main
+        after = search.encode_cursor('id', 'desc', first_page[-1], first_page[-1])
+        second_page = self._feed(after)
+        self.assertEqual(second_page, [7, 6, 5])
+        self.assertTrue(all(item_id < first_page[-1] for item_id in second_page))
+
+
+if __name__ == '__main__':
+    unittest.main()
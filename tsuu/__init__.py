@@ -5,8 +5,14 @@ import string
 import flask
 from flask_assets import Bundle  # noqa F401
 
+# Registers the mapper events that keep the listings table in sync
+from tsuu import listings  # noqa F401
 from tsuu.api_handler import api_blueprint
+from tsuu.auth_cache import ban_cache, range_ban_cache, user_cache
+from tsuu.counters import download_counter, login_ip_writer
 from tsuu.extensions import assets, cache, db, fix_paginate, limiter, toolbar
+from tsuu.jobs import job_runner
+from tsuu.search import warm_plan_cache
 from tsuu.template_utils import bp as template_utils_bp
 from tsuu.template_utils import caching_url_for
 from tsuu.utils import random_string
@@ -131,4 +137,20 @@ def create_app(config):
     # Rate Limiting, reads app.config itself
     limiter.init_app(app)
 
+    # Buffered download counts and login IPs
+    download_counter.init_app(app)
+    login_ip_writer.init_app(app)
+
+    # Background copies, moves and deletes from the file manager
+    job_runner.init_app(app)
+
+    # Per-process caches for the session user, IP bans and range bans
+    user_cache.init_app(app)
+    ban_cache.init_app(app)
+    range_ban_cache.init_app(app)
+
+    # Compile the queries of the common searches before the first request
+    if app.config.get('SEARCH_PLAN_WARMUP', True):
+        warm_plan_cache(app)
+
     return app
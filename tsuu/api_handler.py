@@ -5,7 +5,7 @@ import re
 
 import flask
 
-from tsuu import backend, forms, models
+from tsuu import backend, filelist, forms, manifest, models
 from tsuu.views.items import _create_upload_category_choices
 
 api_blueprint = flask.Blueprint('api', __name__, url_prefix='/api')
@@ -159,8 +159,15 @@ def v2_api_info(torrent_id_or_hash):
         submitter = torrent.user.username
 
     files = {}
+    file_hashes = {}
+    hash_algorithm = None
     if torrent.filelist:
-        files = json.loads(torrent.filelist.filelist_blob.decode('utf-8'))
+        files = filelist.decode(torrent.filelist.filelist_blob)
+        item_manifest = manifest.decode(torrent.filelist.manifest_blob)
+        if item_manifest:
+            # Paths inside the item directory; the manifest may lag behind recent changes
+            hash_algorithm = item_manifest['algorithm']
+            file_hashes = {path: entry[2] for path, entry in item_manifest['files'].items()}
 
     # Create a response dict with relevant data
     torrent_metadata = {
@@ -188,6 +195,8 @@ def v2_api_info(torrent_id_or_hash):
         },
         'filesize': torrent.filesize,
         'files': files,
+        'file_hashes': file_hashes,
+        'hash_algorithm': hash_algorithm,
 
         'is_trusted': torrent.trusted,
         'is_complete': torrent.complete,
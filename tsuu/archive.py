@@ -0,0 +1,237 @@
+''' Deterministic, uncompressed TAR and ZIP64 archives of item directories.
+
+    The layout of an archive only depends on the names and sizes in the stored
+    file list and a fixed modification time, so its total size and the offset of
+    every header and file are known before anything is read from disk. An archive
+    is a list of segments (headers, file contents, trailers) that are generated on
+    demand, which keeps memory use flat and lets any byte range be served on its own.
+
+    ZIP entries are stored (not compressed) and use data descriptors, so their CRC-32
+    is computed while the file is streamed. Ranges that need the CRC of a file that
+    was not streamed in the same response (e.g. resuming inside the central directory)
+    read that file once to compute it. '''
+import bisect
+import functools
+import os
+import struct
+import tarfile
+import zlib
+from datetime import datetime
+
+CHUNK_SIZE = 64 * 1024
+
+
+class ArchiveError(Exception):
+    ''' Raised when the files on disk don't match the file list anymore '''
+    pass
+
+
+def _read_file(path, size, start, stop, on_crc=None, chunk_size=CHUNK_SIZE):
+    ''' Yields bytes start..stop of a file that should be size bytes long.
+        If the whole file is read, on_crc is called with its CRC-32. '''
+    crc = 0
+    with open(path, 'rb') as f:
+        f.seek(start)
+        remaining = stop - start
+        while remaining > 0:
+            data = f.read(min(chunk_size, remaining))
+            if not data:
+                raise ArchiveError('{} is shorter than its file list entry'.format(path))
+            if on_crc:
+                crc = zlib.crc32(data, crc)
+            remaining -= len(data)
+            yield data
+
+    if on_crc and start == 0 and stop == size:
+        on_crc(crc)
+
+
+class Archive(object):
+    ''' An archive made out of segments of known length '''
+
+    def __init__(self, mimetype):
+        self.mimetype = mimetype
+        self.size = 0
+        self._offsets = []
+        self._segments = []
+
+    def _add(self, length, reader):
+        if length:
+            self._offsets.append(self.size)
+            self._segments.append((length, reader))
+            self.size += length
+
+    def add_bytes(self, data):
+        self._add(len(data), lambda start, stop: [data[start:stop]])
+
+    def add_lazy(self, length, build):
+        ''' Adds a segment of the given length whose bytes are only built when needed '''
+        self._add(length, lambda start, stop: [build()[start:stop]])
+
+    def add_file(self, path, size, on_crc=None):
+        self._add(size, functools.partial(_read_file, path, size, on_crc=on_crc))
+
+    def iter_range(self, start=0, stop=None):
+        ''' Yields bytes start..stop of the archive '''
+        if stop is None:
+            stop = self.size
+
+        index = max(bisect.bisect_right(self._offsets, start) - 1, 0)
+        while start < stop and index < len(self._offsets):
+            offset = self._offsets[index]
+            length, reader = self._segments[index]
+            segment_stop = min(stop - offset, length)
+            for data in reader(start - offset, segment_stop):
+                yield data
+            start = offset + segment_stop
+            index += 1
+
+
+def _walk(tree, name):
+    ''' Yields (archive path parts, path parts on disk, size) for a file tree,
+        parents before their children. size is None for directories. '''
+    if not isinstance(tree, dict):
+        yield [name], [], tree
+        return
+
+    yield [name], [], None
+    for child_name, value in sorted(tree.items()):
+        for archive_parts, disk_parts, size in _walk(value, child_name):
+            yield [name] + archive_parts, [child_name] + disk_parts, size
+
+
+def _encode_name(parts, is_dir=False):
+    return ('/'.join(parts) + ('/' if is_dir else '')).encode('utf-8', 'surrogateescape')
+
+
+# ####################################### TAR #######################################
+
+
+def _tar_header(arcname, size, mtime):
+    info = tarfile.TarInfo(arcname)
+    info.mtime = mtime
+    if size is None:
+        info.type = tarfile.DIRTYPE
+        info.mode = 0o755
+    else:
+        info.size = size
+        info.mode = 0o644
+    return info.tobuf(tarfile.PAX_FORMAT, 'utf-8', 'surrogateescape')
+
+
+def tar_archive(root, tree, name, mtime):
+    ''' Builds a PAX TAR archive of the file tree stored at root, named name.
+        Every entry gets mtime (a datetime) as its modification time. '''
+    archive = Archive('application/x-tar')
+    mtime = int((mtime - datetime(1970, 1, 1)).total_seconds())
+
+    for archive_parts, disk_parts, size in _walk(tree, name):
+        arcname = '/'.join(archive_parts)
+        header_length = len(_tar_header(arcname, size, mtime))
+        archive.add_lazy(header_length, functools.partial(_tar_header, arcname, size, mtime))
+
+        if size is not None:
+            archive.add_file(os.path.join(root, *disk_parts), size)
+            archive.add_bytes(b'\0' * (-size % tarfile.BLOCKSIZE))
+
+    archive.add_bytes(b'\0' * (2 * tarfile.BLOCKSIZE))
+    return archive
+
+
+# ####################################### ZIP #######################################
+
+_ZIP_VERSION = 45  # ZIP64
+_ZIP_FLAGS = 0x08 | 0x800  # Data descriptor, UTF-8 names
+_ZIP64_MARKER = 0xFFFFFFFF
+
+_LOCAL_HEADER = struct.Struct('<IHHHHHIIIHH')
+_LOCAL_ZIP64_EXTRA = struct.Struct('<HHQQ')
+_DATA_DESCRIPTOR = struct.Struct('<IIQQ')
+_CENTRAL_HEADER = struct.Struct('<IHHHHHHIIIHHHHHII')
+_CENTRAL_ZIP64_EXTRA = struct.Struct('<HHQQQ')
+_ZIP64_END_RECORD = struct.Struct('<IQHHIIQQQQ')
+_ZIP64_END_LOCATOR = struct.Struct('<IIQI')
+_END_RECORD = struct.Struct('<IHHHHIIH')
+
+
+def _dos_datetime(mtime):
+    mtime = max(mtime, datetime(1980, 1, 1))
+    dos_time = (mtime.hour << 11) | (mtime.minute << 5) | (mtime.second // 2)
+    dos_date = ((mtime.year - 1980) << 9) | (mtime.month << 5) | mtime.day
+    return dos_time, dos_date
+
+
+def zip_archive(root, tree, name, mtime):
+    ''' Builds a stored ZIP64 archive of the file tree stored at root, named name.
+        Every entry gets mtime (a datetime) as its modification time. '''
+    archive = Archive('application/zip')
+    dos_time, dos_date = _dos_datetime(mtime)
+
+    # (encoded name, size or None, local header offset, path on disk) per entry
+    entries = []
+    crcs = {}
+
+    def crc_of(index):
+        if index not in crcs:
+            _, size, _, path = entries[index]
+            for _ in _read_file(path, size, 0, size, on_crc=functools.partial(
+                    crcs.__setitem__, index)):
+                pass
+        return crcs[index]
+
+    def local_header(index):
+        encoded_name = entries[index][0]
+        return _LOCAL_HEADER.pack(
+            0x04034b50, _ZIP_VERSION, _ZIP_FLAGS, 0, dos_time, dos_date,
+            0, _ZIP64_MARKER, _ZIP64_MARKER,
+            len(encoded_name), _LOCAL_ZIP64_EXTRA.size) + \
+            encoded_name + _LOCAL_ZIP64_EXTRA.pack(1, 16, 0, 0)
+
+    def data_descriptor(index):
+        size = entries[index][1] or 0
+        return _DATA_DESCRIPTOR.pack(0x08074b50, crc_of(index), size, size)
+
+    def central_header(index):
+        encoded_name, size, offset, _ = entries[index]
+        if size is None:
+            external_attributes = (0o40755 << 16) | 0x10
+            size = 0
+        else:
+            external_attributes = 0o100644 << 16
+        return _CENTRAL_HEADER.pack(
+            0x02014b50, (3 << 8) | _ZIP_VERSION, _ZIP_VERSION, _ZIP_FLAGS, 0,
+            dos_time, dos_date, crc_of(index), _ZIP64_MARKER, _ZIP64_MARKER,
+            len(encoded_name), _CENTRAL_ZIP64_EXTRA.size, 0, 0, 0,
+            external_attributes, _ZIP64_MARKER) + \
+            encoded_name + _CENTRAL_ZIP64_EXTRA.pack(1, 24, size, size, offset)
+
+    for archive_parts, disk_parts, size in _walk(tree, name):
+        index = len(entries)
+        encoded_name = _encode_name(archive_parts, is_dir=size is None)
+        entries.append((encoded_name, size, archive.size, os.path.join(root, *disk_parts)))
+
+        archive.add_lazy(_LOCAL_HEADER.size + len(encoded_name) + _LOCAL_ZIP64_EXTRA.size,
+                         functools.partial(local_header, index))
+        if size is None:
+            crcs[index] = 0
+        else:
+            archive.add_file(entries[index][3], size,
+                             on_crc=functools.partial(crcs.__setitem__, index))
+        archive.add_lazy(_DATA_DESCRIPTOR.size, functools.partial(data_descriptor, index))
+
+    central_directory_offset = archive.size
+    for index, (encoded_name, _, _, _) in enumerate(entries):
+        archive.add_lazy(_CENTRAL_HEADER.size + len(encoded_name) + _CENTRAL_ZIP64_EXTRA.size,
+                         functools.partial(central_header, index))
+    central_directory_size = archive.size - central_directory_offset
+
+    zip64_end_offset = archive.size
+    archive.add_bytes(_ZIP64_END_RECORD.pack(
+        0x06064b50, _ZIP64_END_RECORD.size - 12, (3 << 8) | _ZIP_VERSION, _ZIP_VERSION, 0, 0,
+        len(entries), len(entries), central_directory_size, central_directory_offset))
+    archive.add_bytes(_ZIP64_END_LOCATOR.pack(0x07064b50, 0, zip64_end_offset, 1))
+    archive.add_bytes(_END_RECORD.pack(
+        0x06054b50, 0, 0, min(len(entries), 0xFFFF), min(len(entries), 0xFFFF),
+        min(central_directory_size, _ZIP64_MARKER), min(central_directory_offset, _ZIP64_MARKER),
+        0))
+    return archive
@@ -0,0 +1,295 @@
+''' In-process caches for the per-request authentication checks.
+
+    main.before_request needs the session user on every request and the IP ban
+    list on every POST. Both are cached per worker process:
+
+    - UserCache keeps a detached snapshot of recently seen users for USER_CACHE_TTL
+      seconds and merges it into the request's session without a query.
+    - BanCache keeps the set of banned (packed) IPs, reloaded after BAN_CACHE_TTL
+      seconds.
+    - RangeBanCache keeps enabled range bans in a prefix trie (see iptrie), rebuilt
+      after RANGEBAN_CACHE_TTL seconds.
+
+    They are dropped early whenever their generation key in the app cache changes.
+    The keys are bumped after any commit that updates or deletes a user (level,
+    status, ...) or adds or removes a ban. With a shared cache backend (e.g. redis)
+    this reaches every worker, otherwise the TTLs bound staleness.
+    Range bans are updated in the trie instead: RANGEBAN_ADDED_KEY makes workers load
+    the rows they haven't seen yet, and updated or deleted bans are logged under a
+    counter (RANGEBAN_CHANGED_KEY) so that workers remove them from the trie and load
+    the ones that are still enabled again. A change that has dropped out of the cache
+    rebuilds the trie. '''
+import threading
+import time
+import uuid
+from datetime import datetime, timedelta
+
+from sqlalchemy import event, inspect
+from sqlalchemy.orm import Session, make_transient_to_detached
+from sqlalchemy.orm.attributes import set_committed_value
+
+from tsuu import iptrie, models
+from tsuu.extensions import cache, db
+
+GENERATION_KEY = 'auth_generation'
+RANGEBAN_GENERATION_KEY = 'auth_rangeban_generation'
+RANGEBAN_ADDED_KEY = 'auth_rangeban_added'
+RANGEBAN_CHANGED_KEY = 'auth_rangeban_changed'
+RANGEBAN_CHANGE_KEY = 'auth_rangeban_change_{}'
+
+# Workers that missed more changes than this rebuild their trie
+RANGEBAN_MAX_CHANGES = 100
+
+
+def bump_generation(key=GENERATION_KEY):
+    # A fresh random value (rather than an increment) can't collide with an older one
+    # if the key is evicted, and needs no atomic increment from the cache backend
+    cache.set(key, uuid.uuid4().hex, timeout=0)
+
+
+class _GenerationCache(object):
+    ''' Common bookkeeping: clears itself when its generation key changes, with the
+        clear() every subclass implements '''
+
+    generation_key = GENERATION_KEY
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._generation = object()
+        self.ttl = 30
+
+    def init_app(self, app, ttl_config_key):
+        self.ttl = app.config.get(ttl_config_key, self.ttl)
+
+    def _check_generation(self):
+        generation = cache.get(self.generation_key)
+        if generation != self._generation:
+            with self._lock:
+                self.clear()
+                self._generation = generation
+
+
+def _snapshot(user):
+    ''' Copies a loaded user into a new detached instance that shares no state with it '''
+    mapper = inspect(user).mapper
+    snapshot = mapper.class_manager.new_instance()
+    for attribute in mapper.column_attrs:
+        set_committed_value(snapshot, attribute.key, getattr(user, attribute.key))
+    make_transient_to_detached(snapshot)
+    return snapshot
+
+
+class UserCache(_GenerationCache):
+
+    def __init__(self):
+        super().__init__()
+        self._users = {}
+
+    def init_app(self, app):
+        super().init_app(app, 'USER_CACHE_TTL')
+
+    def clear(self):
+        self._users = {}
+
+    def get(self, user_id):
+        ''' Returns the user attached to the current session, or None if it doesn't exist '''
+        self._check_generation()
+
+        cached = self._users.get(user_id)
+        if cached and cached[0] > time.monotonic():
+            # load=False attaches the snapshot's state without querying the database
+            return db.session.merge(cached[1], load=False)
+
+        user = models.User.by_id(user_id)
+        if user:
+            with self._lock:
+                self._users[user_id] = (time.monotonic() + self.ttl, _snapshot(user))
+        return user
+
+    def set_last_login_ip(self, user_id, ip):
+        ''' Updates the cached user's last_login_ip, which counters.login_ip_writer only
+            writes to the database later, so that it isn't recorded again every request '''
+        with self._lock:
+            cached = self._users.get(user_id)
+            if cached:
+                set_committed_value(cached[1], 'last_login_ip', ip)
+
+
+class BanCache(_GenerationCache):
+
+    def __init__(self):
+        super().__init__()
+        self._banned_ips = None
+        self._expires = 0
+
+    def init_app(self, app):
+        super().init_app(app, 'BAN_CACHE_TTL')
+
+    def clear(self):
+        self._banned_ips = None
+
+    def is_banned(self, ip):
+        ''' Returns True if the packed IP address has a ban '''
+        self._check_generation()
+
+        banned_ips = self._banned_ips
+        if banned_ips is None or self._expires < time.monotonic():
+            query = db.session.query(models.Ban.user_ip).filter(models.Ban.user_ip.isnot(None))
+            banned_ips = frozenset(bytes(row.user_ip) for row in query)
+            with self._lock:
+                self._banned_ips = banned_ips
+                self._expires = time.monotonic() + self.ttl
+        return ip in banned_ips
+
+
+class RangeBanCache(_GenerationCache):
+
+    generation_key = RANGEBAN_GENERATION_KEY
+
+    def __init__(self):
+        super().__init__()
+        self._trie = None
+        self._expires = 0
+        self._max_id = 0
+        self._networks = {}
+        self._added = None
+        self._changed = 0
+        self.temp_duration = timedelta(days=7)
+
+    def init_app(self, app):
+        super().init_app(app, 'RANGEBAN_CACHE_TTL')
+        self.temp_duration = timedelta(
+            seconds=app.config.get('RANGEBAN_TEMP_DURATION', self.temp_duration.total_seconds()))
+
+    def clear(self):
+        self._trie = None
+
+    def _add_bans(self, trie, bans):
+        for ban in bans:
+            trie.add(ban.network, ban.id, ban.expires(self.temp_duration))
+            self._networks[ban.id] = ban.network
+            self._max_id = max(self._max_id, ban.id)
+
+    def _changed_ids(self, changed):
+        ''' Returns the ids of the bans changed since the last change applied, or None if
+            some of them aren't in the cache anymore '''
+        if not self._changed < changed <= self._changed + RANGEBAN_MAX_CHANGES:
+            return None
+        keys = [RANGEBAN_CHANGE_KEY.format(n) for n in range(self._changed + 1, changed + 1)]
+        ids = set()
+        for change in cache.get_many(*keys):
+            if change is None:
+                return None
+            ids.update(change)
+        return ids
+
+    def _get_trie(self):
+        self._check_generation()
+        added = cache.get(RANGEBAN_ADDED_KEY)
+        changed = cache.get(RANGEBAN_CHANGED_KEY) or 0
+
+        with self._lock:
+            changed_ids = set()
+            if self._trie is not None and changed != self._changed:
+                changed_ids = self._changed_ids(changed)
+                if changed_ids is None:
+                    self._trie = None
+
+            if self._trie is None or self._expires < time.monotonic():
+                trie = iptrie.PrefixTrie()
+                self._max_id = 0
+                self._networks = {}
+                self._add_bans(trie, models.RangeBan.query.filter(models.RangeBan.enabled))
+                self._trie = trie
+                self._expires = time.monotonic() + self.ttl
+                self._added = added
+                self._changed = changed
+                return self._trie
+
+            if changed_ids:
+                # Updated or deleted, load the ones that are still enabled again
+                for ban_id in changed_ids:
+                    network = self._networks.pop(ban_id, None)
+                    if network is not None:
+                        self._trie.remove(network, ban_id)
+                self._add_bans(self._trie, models.RangeBan.query.filter(
+                    models.RangeBan.enabled, models.RangeBan.id.in_(changed_ids)))
+            self._changed = changed
+            if added != self._added:
+                # Only bans were added since, so just load the new rows
+                self._add_bans(self._trie, models.RangeBan.query.filter(
+                    models.RangeBan.enabled, models.RangeBan.id > self._max_id))
+                self._added = added
+            return self._trie
+
+    def is_rangebanned(self, ip):
+        ''' Returns True if the packed IPv4 or IPv6 address is in an active range ban.
+            Temporary bans stop applying RANGEBAN_TEMP_DURATION seconds after creation. '''
+        if len(ip) not in (4, 16):
+            raise ValueError("Not an IP address.")
+
+        now = datetime.utcnow()
+        for _, expires in self._get_trie().matches(ip):
+            if expires is None or expires > now:
+                return True
+        return False
+
+
+user_cache = UserCache()
+ban_cache = BanCache()
+range_ban_cache = RangeBanCache()
+
+
+# Bump the generations once the change is committed, so that no worker reloads
+# (and caches) the old rows in between
+def _marker(generation_key):
+    def mark(mapper, connection, target):
+        session = inspect(target).session
+        if session is not None:
+            session.info.setdefault('auth_generations', set()).add(generation_key)
+    return mark
+
+
+def _mark_rangeban_change(mapper, connection, target):
+    session = inspect(target).session
+    if session is not None:
+        session.info.setdefault('auth_rangeban_changes', set()).add(target.id)
+
+
+for _model, _events, _generation_key in (
+        (models.User, ('after_update', 'after_delete'), GENERATION_KEY),
+        (models.Ban, ('after_insert', 'after_update', 'after_delete'), GENERATION_KEY),
+        (models.RangeBan, ('after_insert',), RANGEBAN_ADDED_KEY)):
+    for _event_name in _events:
+        event.listen(_model, _event_name, _marker(_generation_key))
+
+for _event_name in ('after_update', 'after_delete'):
+    event.listen(models.RangeBan, _event_name, _mark_rangeban_change)
+
+
+def _log_rangeban_changes(ban_ids):
+    ''' Logs updated or deleted range bans for the workers' tries, see RangeBanCache '''
+    # Flask-Caching doesn't proxy inc, which is atomic in the backends that have it
+    change = cache.cache.inc(RANGEBAN_CHANGED_KEY)
+    if not change:
+        # No counters in this cache backend
+        bump_generation(RANGEBAN_GENERATION_KEY)
+        return
+    # Workers rebuild their trie at least every ttl seconds, older changes aren't needed
+    cache.set(RANGEBAN_CHANGE_KEY.format(change), sorted(ban_ids),
+              timeout=int(range_ban_cache.ttl) + 1)
+
+
+@event.listens_for(Session, 'after_commit')
+def _after_commit(session):
+    for generation_key in session.info.pop('auth_generations', ()):
+        bump_generation(generation_key)
+    rangeban_changes = session.info.pop('auth_rangeban_changes', None)
+    if rangeban_changes:
+        _log_rangeban_changes(rangeban_changes)
+
+
+@event.listens_for(Session, 'after_rollback')
+def _after_rollback(session):
+    session.info.pop('auth_generations', None)
+    session.info.pop('auth_rangeban_changes', None)
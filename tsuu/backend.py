@@ -1,8 +1,10 @@
 import hashlib
-from io import BytesIO
-import json
 import os
 import re
+import secrets
+import shutil
+import tempfile
+import time
 from datetime import datetime, timedelta
 from ipaddress import ip_address
 
@@ -12,7 +14,7 @@ from werkzeug import secure_filename
 import sqlalchemy
 from orderedset import OrderedSet
 
-from tsuu import models, utils
+from tsuu import blobstore, file_index, filelist, filetree, manifest, models, utils
 from tsuu.extensions import db
 
 app = flask.current_app
@@ -32,6 +34,9 @@ FILENAME_BLACKLIST = [
     'lpt0', 'lpt1', 'lpt2', 'lpt3', 'lpt4', 'lpt5', 'lpt6', 'lpt7', 'lpt8', 'lpt9',
 ]
 
+# Item directories are named with this many random bytes, in hex
+ITEM_DIRECTORY_BYTES = 8
+
 # Invalid RSS characters regex, used to sanitize some strings
 ILLEGAL_XML_CHARS_RE = re.compile(u'[\x00-\x08\x0b\x0c\x0e-\x1F\uD800-\uDFFF\uFFFE\uFFFF]')
 
@@ -40,42 +45,106 @@ def sanitize_string(string, replacement='\uFFFD'):
     ''' Simply replaces characters based on a regex '''
     return ILLEGAL_XML_CHARS_RE.sub(replacement, string)
 
-def calculate_short_hash(data):
+
+def item_storage_root():
+    ''' Returns the folder every item directory is stored in '''
+    return os.path.join(app.config['ROOT_FOLDER'], app.config['ITEM_FOLDER'])
+
+
+def layout_relpath(item_directory, layout):
+    ''' Returns the path of an item directory inside the item storage folder, in a layout:
+        'flat' (<name>) or 'sharded' (ab/cd/<name>, fanned out by its first characters) '''
+    if layout == 'sharded' and len(item_directory) >= 4:
+        return os.path.join(item_directory[:2], item_directory[2:4], item_directory)
+    return item_directory
+
+
+def item_path(item_directory):
+    ''' Returns the full path of an item directory. Items are looked up in the configured
+        layout (ITEM_DIRECTORY_LAYOUT) first and in the other one after that, so both can
+        be read while migrate_layout moves items. Paths for new items use the configured
+        layout. '''
+    root = item_storage_root()
+    layout = app.config.get('ITEM_DIRECTORY_LAYOUT', 'flat')
+    path = os.path.join(root, layout_relpath(item_directory, layout))
+    if os.path.isdir(path):
+        return path
+
+    other_layout = 'flat' if layout == 'sharded' else 'sharded'
+    other_path = os.path.join(root, layout_relpath(item_directory, other_layout))
+    if os.path.isdir(other_path):
+        return other_path
+    # Moved to the configured layout since the first check, or a new item
+    return path
+
+
+def stream_to_storage(stream, chunk_size=None):
+    ''' Copies a file-like stream into a temporary file inside the item storage volume,
+        hashing it along the way so the data is only read once.
+        Peak memory use is bounded by chunk_size (UPLOAD_CHUNK_SIZE by default).
+        Returns a tuple of (temporary file path, sha256 hexdigest, size in bytes). '''
+    chunk_size = chunk_size or app.config.get('UPLOAD_CHUNK_SIZE', 1024 * 1024)
+    storage_root = item_storage_root()
+    os.makedirs(storage_root, exist_ok=True)
+
     h = hashlib.sha256()
-    d = data.read()
-    h.update(d)
-    return h.hexdigest()[:6]
+    size = 0
+    # The temporary file lives next to the item directories, so the final rename is atomic
+    fd, temp_path = tempfile.mkstemp(prefix='.upload-', dir=storage_root)
+    try:
+        with os.fdopen(fd, 'wb') as out_file:
+            for chunk in iter(lambda: stream.read(chunk_size), b''):
+                h.update(chunk)
+                out_file.write(chunk)
+                size += len(chunk)
+    except BaseException:
+        os.remove(temp_path)
+        raise
+
+    return temp_path, h.hexdigest(), size
+
+
+def create_item_directory():
+    ''' Creates a new, empty item directory with a random name and returns the name.
+        Names are never reused: creating the directory fails if it exists already. '''
+    while True:
+        name = secrets.token_hex(ITEM_DIRECTORY_BYTES)
+        path = item_path(name)
+        if os.path.isdir(path):
+            continue  # Exists in the other layout
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        try:
+            os.mkdir(path)
+        except FileExistsError:
+            continue
+        return name
+
+
+def commit_to_storage(temp_path, digest, size, filename):
+    ''' Stores a file written by stream_to_storage in a new item directory, linked
+        from the blob store if it's enabled (see blobstore.place).
+        Returns the name of the item directory. '''
+    item_directory = create_item_directory()
+    target_dir = item_path(item_directory)
+    try:
+        blobstore.place(temp_path, digest, size, os.path.join(target_dir, filename))
+    except BaseException:
+        shutil.rmtree(target_dir, ignore_errors=True)
+        raise
+    return item_directory
+
 
 class ItemExtraValidationException(Exception):
     def __init__(self, errors={}):
         self.errors = errors
 
-# Recurse over the item directory to create the file list
+
+# Walk the item directory to create the file list
 # Returns 2 values: the file list and the total size of everything in the directory.
 def get_file_data(root):
-    def file_tree(path, d):
-        name = os.path.basename(path)
-
-        if os.path.isdir(path):
-            d[name] = {}
-            for x in os.listdir(path):
-                file_tree(os.path.join(path,x), d[name])
-        else:
-            # Path is a file; save it
-            d[name] = os.path.getsize(path)
-        return d
-
-    def filesize(path, s):
-        name = os.path.basename(path)
-
-        if os.path.isdir(path):
-            for x in os.listdir(path):
-                filesize(os.path.join(path, x), s)
-        else:
-            s.append(os.path.getsize(path))
-        return s
+    file_tree, total_size = filetree.scan_tree(root, app.config.get('FILE_SCAN_WORKERS', 0))
+    return {os.path.basename(root): file_tree}, total_size
 
-    return file_tree(root, dict()), sum(filesize(root, []))
 
 @utils.cached_function
 def get_category_id_map():
@@ -121,7 +190,7 @@ def _recursive_dict_iterator(source):
 def _validate_item_filenames(item):
     ''' Checks path parts of a item's filetree against blacklisted characters
         and filenames, returning False on rejection '''
-    file_tree = json.loads(item.filelist.filelist_blob.decode('utf-8'))
+    file_tree = _decode_file_tree(item.filelist)
 
     for path_part, value in _recursive_dict_iterator(file_tree):
         if path_part.rsplit('.', 1)[0].lower() in FILENAME_BLACKLIST:
@@ -196,31 +265,170 @@ def check_uploader_ratelimit(user):
     return now, item_count, next_allowed_time
 
 
-def handle_item_change(item_id):
+def _encode_file_tree(file_tree):
+    return filelist.encode(file_tree)
+
+
+def _decode_file_tree(item_filelist):
+    if not item_filelist or not item_filelist.filelist_blob:
+        return None
+    return filelist.decode(item_filelist.filelist_blob)
+
+
+def migrate_legacy_filelists(batch_size=500):
+    ''' Re-encodes legacy JSON file lists in the binary format, one batch at a time.
+        Yields (last item id, number of file lists converted) after every batch. '''
+    last_id = 0
+    while True:
+        batch = models.Filelist.query \
+            .filter(models.Filelist.item_id > last_id) \
+            .order_by(models.Filelist.item_id.asc()) \
+            .limit(batch_size).all()
+        if not batch:
+            return
+
+        converted = 0
+        for item_filelist in batch:
+            blob = item_filelist.filelist_blob
+            if blob and not filelist.is_binary(blob):
+                item_filelist.filelist_blob = filelist.encode(filelist.decode(blob))
+                converted += 1
+        db.session.commit()
+
+        last_id = batch[-1].item_id
+        yield last_id, converted
+
+
+def _remove_empty_shards(directory, root):
+    # Removes the ab/cd/ directories a flat item directory was moved out of, if empty
+    while os.path.abspath(directory) != os.path.abspath(root):
+        try:
+            os.rmdir(directory)
+        except OSError:
+            return
+        directory = os.path.dirname(directory)
+
+
+def migrate_layout(layout, batch_size=500, delay=0, after_id=0):
+    ''' Moves item directories into a layout (see layout_relpath), one batch of items
+        at a time with a pause of `delay` seconds after every batch. Every move is a
+        single rename, so item_path finds the directory in one layout or the other the
+        whole time. Items already in the layout are skipped, which makes an interrupted
+        migration safe to start again, or to resume after the last item id it reported.
+        Yields (last item id, number of item directories moved) after every batch. '''
+    root = item_storage_root()
+    other_layout = 'flat' if layout == 'sharded' else 'sharded'
+    last_id = after_id
+    while True:
+        batch = db.session.query(models.Item.id, models.Item.item_directory) \
+            .filter(models.Item.id > last_id) \
+            .order_by(models.Item.id.asc()) \
+            .limit(batch_size).all()
+        # Don't hold a transaction open while sleeping
+        db.session.commit()
+        if not batch:
+            return
+
+        moved = 0
+        for item_id, item_directory in batch:
+            source = os.path.join(root, layout_relpath(item_directory, other_layout))
+            target = os.path.join(root, layout_relpath(item_directory, layout))
+            if source == target or not os.path.isdir(source) or os.path.lexists(target):
+                continue
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+            os.rename(source, target)
+            _remove_empty_shards(os.path.dirname(source), root)
+            moved += 1
+
+        last_id = batch[-1].id
+        yield last_id, moved
+        if delay:
+            time.sleep(delay)
+
+
+def _disk_matches(base_dir, touched):
+    ''' Cheap consistency check: compares the paths an incremental change touched
+        against the disk, returning False if the stored tree has drifted. '''
+    for parts, node in touched:
+        path = os.path.join(base_dir, *parts)
+        if node is None:
+            if os.path.lexists(path):
+                return False
+        elif isinstance(node, dict):
+            if not os.path.isdir(path):
+                return False
+        else:
+            try:
+                if os.path.isdir(path) or os.path.getsize(path) != node:
+                    return False
+            except OSError:
+                return False
+    return True
+
+
+def handle_item_change(item_id, changes=None):
     """This function handles an item change.
-    
-    Specifically, it rebuilds the item list for a given item ID."""
+
+    Without changes, it rebuilds the file list for a given item ID from disk.
+    With a list of changes (see filetree.apply_changes), it applies only those
+    to the stored file list and adjusts the item size by the difference.
+    It falls back to a full rescan if the stored file list doesn't match."""
     item = models.Item.by_id(item_id)
 
-    base_dir = f"{app.config['ROOT_FOLDER']}/{app.config['ITEM_FOLDER']}/{item.item_directory}"
-    parsed_file_tree, filesize = get_file_data(base_dir)
-    json_bytes = json.dumps(parsed_file_tree, separators=(',', ':')).encode('utf8')
-    item.filelist = models.Filelist(filelist_blob=json_bytes)
+    base_dir = item_path(item.item_directory)
+
+    file_tree = None
+    touched = None
+    if changes is not None:
+        file_tree = _decode_file_tree(item.filelist)
+        try:
+            if not file_tree or item.item_directory not in file_tree:
+                raise filetree.FileTreeError('Missing stored file list')
+            delta, touched = filetree.apply_changes(file_tree[item.item_directory], changes)
+            if not _disk_matches(base_dir, touched):
+                raise filetree.FileTreeError('Stored file list does not match the disk')
+        except filetree.FileTreeError as e:
+            app.logger.info('Rescanning item #%d: %s', item.id, e)
+            file_tree = touched = None
+        else:
+            filesize = item.filesize + delta
+
+    if file_tree is None:
+        file_tree, filesize = get_file_data(base_dir)
+
+    # Updated in place, which keeps the manifest to compare the changed files with
+    if item.filelist is None:
+        item.filelist = models.Filelist()
+    item.filelist.filelist_blob = _encode_file_tree(file_tree)
     item.filesize = filesize
 
     db.session.merge(item)
     db.session.flush()
+    if touched is None:
+        file_index.reindex_item(item.id, file_tree)
+    else:
+        file_index.reindex_paths(item.id, file_tree[item.item_directory], touched)
+
+    from tsuu import jobs
+    jobs.schedule_manifest(item.id)
     db.session.commit()
+    jobs.job_runner.notify()
+
+
+def _upload_manifest(item_directory, filename, digest):
+    ''' The manifest of a new item, from the SHA-256 taken while it was uploaded '''
+    if manifest.algorithm() != 'sha256':
+        return None
+    stat_result = os.stat(os.path.join(item_path(item_directory), filename))
+    return manifest.encode(manifest.make('sha256', {
+        filename: [stat_result.st_size, stat_result.st_mtime_ns, digest]}))
+
 
 def handle_item_upload(upload_form, uploading_user=None, fromAPI=False):
     ''' Stores an item to the database.
         May throw ItemExtraValidationException if the form/item fails
         post-WTForm validation! Exception messages will also be added to their
         relevant fields on the given form. '''
-    print("Handling upload")
-    item_data = BytesIO()
-    upload_form.submission_file.data.save(item_data)
-
     # Anonymous uploaders and non-trusted uploaders
     no_or_new_account = (not uploading_user
                          or (uploading_user.age < app.config['RATELIMIT_ACCOUNT_AGE']
@@ -253,30 +461,33 @@ def handle_item_upload(upload_form, uploading_user=None, fromAPI=False):
     information = sanitize_string(information)
     description = sanitize_string(description)
 
-    item_data.seek(0, os.SEEK_END)
-    item_filesize = item_data.tell()
-    item_data.seek(0)
+    if upload_form.upload_token.data:
+        # Sent in chunks before the form, see chunked_uploads
+        from tsuu import chunked_uploads
+        upload = chunked_uploads.get(upload_form.upload_token.data, uploading_user)
+        if upload is None or chunked_uploads.offset(upload) != upload.size:
+            upload_form.submission_file.errors = ['The upload of the file did not finish, '
+                                                  'please choose it again.']
+            raise ItemExtraValidationException()
+        filename = os.path.basename(upload.filename)
+        temp_path, item_hash, item_filesize = chunked_uploads.claim(upload)
+    else:
+        # Stream the upload to disk, hashing it on the way, instead of buffering it in memory
+        submission_file = upload_form.submission_file.data
+        temp_path, item_hash, item_filesize = stream_to_storage(submission_file.stream)
+        filename = os.path.basename(submission_file.filename)
 
-    item_id = calculate_short_hash(item_data)
-    item_data.seek(0)
+    # Store file
+    item_directory = commit_to_storage(temp_path, item_hash, item_filesize, filename)
 
     item = models.Item(display_name=display_name,
-                            item_directory=item_id,
+                            item_directory=item_directory,
                             information=information,
                             description=description,
                             filesize=item_filesize,
                             user=uploading_user,
                             uploader_ip=ip_address(flask.request.remote_addr).packed)
 
-    # Store file
-    item_directory = f"{app.config['ROOT_FOLDER']}/{app.config['ITEM_FOLDER']}/{item.item_directory}"
-    filename = upload_form.submission_file.data.filename
-    os.makedirs(item_directory, exist_ok=True)
-
-    with open(os.path.join(item_directory, filename), 'wb') as out_file:
-        out_file.write(item_data.getbuffer())
-    print("stored file")
-
     item.stats = models.Statistic()
 
     # Fields with default value will be None before first commit, so set .flags
@@ -299,14 +510,19 @@ def handle_item_upload(upload_form, uploading_user=None, fromAPI=False):
     item.main_category_id, item.sub_category_id = \
         upload_form.category.parsed_data.get_category_ids()
 
-    parsed_file_tree, item_filesize = get_file_data(item_directory)
+    parsed_file_tree, item_filesize = get_file_data(item_path(item_directory))
     item.filesize = item_filesize
 
-    json_bytes = json.dumps(parsed_file_tree, separators=(',', ':')).encode('utf8')
-    item.filelist = models.Filelist(filelist_blob=json_bytes)
+    item.filelist = models.Filelist(filelist_blob=_encode_file_tree(parsed_file_tree),
+                                    manifest_blob=_upload_manifest(item_directory, filename,
+                                                                   item_hash))
 
     db.session.add(item)
     db.session.flush()
+    file_index.reindex_item(item.id, parsed_file_tree)
+    if item.filelist.manifest_blob is None:
+        from tsuu import jobs
+        jobs.schedule_manifest(item.id)
     db.session.commit()
 
     return item
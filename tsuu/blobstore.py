@@ -0,0 +1,193 @@
+''' Content-addressed storage of uploaded files.
+
+    Every uploaded file is stored once, under ROOT_FOLDER/BLOB_FOLDER/ab/cd/<sha256>,
+    and item directories get a link to it: a reflink (a copy-on-write clone, on btrfs
+    and XFS) or a hardlink, depending on BLOB_LINK_MODE. Re-uploads of the same file
+    take no extra space. The blobs table counts the links made to every blob.
+
+    Blob files are read-only, because writing to a hardlink writes to every item
+    sharing it: anything that replaces a file in an item directory writes a new file
+    and renames it over the old one (see place and copy_file). Links removed from item
+    directories are only noticed by prune, which recounts the hardlinks of every blob
+    and deletes the blobs no item uses anymore. '''
+import errno
+import os
+import shutil
+import stat
+import time
+import uuid
+
+import flask
+
+from sqlalchemy import bindparam
+from sqlalchemy.exc import IntegrityError
+from tsuu import models
+from tsuu.extensions import db
+
+app = flask.current_app
+
+LINK_MODES = ('reflink', 'hardlink', 'copy')
+
+# ioctl(dest, FICLONE, src) clones a whole file on Linux
+FICLONE = 0x40049409
+
+# A blob without links is only pruned this long (in seconds) after it was stored,
+# so that an upload between storing and linking its blob doesn't lose it
+PRUNE_GRACE_PERIOD = 60 * 60
+
+# Errors after which a hardlink is made as a copy instead
+_LINK_FALLBACK_ERRNOS = (errno.EXDEV, errno.EMLINK, errno.EPERM, errno.EOPNOTSUPP)
+
+_READ_ONLY = stat.S_IRUSR | stat.S_IRGRP | stat.S_IROTH
+
+
+def blob_relpath(digest):
+    ''' Returns the path of a blob inside the blob folder, fanned out by its first bytes '''
+    return os.path.join(digest[:2], digest[2:4], digest)
+
+
+def blob_root():
+    return os.path.join(app.config['ROOT_FOLDER'], app.config.get('BLOB_FOLDER', 'blobs'))
+
+
+def blob_path(digest):
+    return os.path.join(blob_root(), blob_relpath(digest))
+
+
+def enabled():
+    return bool(app.config.get('BLOB_LINK_MODE'))
+
+
+def _reflink(src, dest):
+    # Not on Windows, where link_file falls back to hardlinks
+    import fcntl
+    with open(src, 'rb') as src_file, open(dest, 'xb') as dest_file:
+        try:
+            fcntl.ioctl(dest_file.fileno(), FICLONE, src_file.fileno())
+        except OSError:
+            os.remove(dest)
+            raise
+
+
+def link_file(src, dest, mode):
+    ''' Makes dest share src's data, with a reflink or hardlink (mode). Falls back
+        from reflinks to hardlinks and from hardlinks to copies where the filesystem
+        can't make them. dest must not exist. Returns the mode used. '''
+    if mode == 'reflink':
+        try:
+            _reflink(src, dest)
+            return 'reflink'
+        except (ImportError, OSError):
+            pass
+        mode = 'hardlink'
+
+    if mode == 'hardlink':
+        try:
+            os.link(src, dest)
+            return 'hardlink'
+        except OSError as e:
+            if e.errno not in _LINK_FALLBACK_ERRNOS:
+                raise
+
+    shutil.copyfile(src, dest)
+    return 'copy'
+
+
+def _temp_name(dest):
+    directory, name = os.path.split(dest)
+    return os.path.join(directory, '.{}.{}'.format(name, uuid.uuid4().hex))
+
+
+def replace_with_link(src, dest, mode):
+    ''' Like link_file, but atomically replaces dest if it exists '''
+    temp_path = _temp_name(dest)
+    used_mode = link_file(src, temp_path, mode)
+    os.replace(temp_path, dest)
+    return used_mode
+
+
+def copy_file(src, dest):
+    ''' Copies src to dest, replacing dest without writing to it. Files linked to a blob
+        are linked again instead of copied. For shutil.copytree's copy_function. '''
+    src_stat = os.stat(src)
+    temp_path = _temp_name(dest)
+    try:
+        if src_stat.st_nlink > 1 and not src_stat.st_mode & stat.S_IWUSR:
+            link_file(src, temp_path, 'hardlink')
+        else:
+            shutil.copy2(src, temp_path)
+        os.replace(temp_path, dest)
+    except BaseException:
+        if os.path.lexists(temp_path):
+            os.remove(temp_path)
+        raise
+    return dest
+
+
+def store(temp_path, digest, size):
+    ''' Moves a file hashed by backend.stream_to_storage into the blob store, or drops it
+        if the blob is stored already. Returns the path of the blob. '''
+    path = blob_path(digest)
+    if os.path.exists(path):
+        os.remove(temp_path)
+    else:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        os.chmod(temp_path, _READ_ONLY)
+        shutil.move(temp_path, path)
+
+    if models.Blob.by_digest(digest) is None:
+        try:
+            with db.session.begin_nested():
+                db.session.add(models.Blob(digest=digest, size=size, ref_count=0))
+        except IntegrityError:
+            pass  # Stored by a concurrent upload
+    return path
+
+
+def place(temp_path, digest, size, dest):
+    ''' Stores a file written by backend.stream_to_storage as dest, in an item directory.
+        With the blob store enabled dest links to its blob, otherwise the file is moved.
+        Replaces dest if it exists. Doesn't commit. '''
+    if not enabled():
+        os.replace(temp_path, dest)
+        return
+
+    path = store(temp_path, digest, size)
+    replace_with_link(path, dest, app.config['BLOB_LINK_MODE'])
+    blobs = models.Blob.__table__
+    db.session.execute(blobs.update().where(blobs.c.digest == digest)
+                       .values(ref_count=blobs.c.ref_count + 1))
+
+
+def prune(dry_run=False, batch_size=500):
+    ''' Recounts the links to every blob from its hardlink count and deletes the blobs
+        that no item directory links to anymore. Blobs shared by reflinks or copies have
+        no hardlinks, so they're deleted too; the items keep their own data.
+        Yields (digest, size) of every deleted blob. '''
+    blobs = models.Blob.__table__
+    cutoff = time.time() - PRUNE_GRACE_PERIOD
+    counts = []
+
+    def write_counts():
+        if counts and not dry_run:
+            db.session.execute(blobs.update().where(blobs.c.digest == bindparam('_digest'))
+                               .values(ref_count=bindparam('_links')), counts)
+            db.session.commit()
+        del counts[:]
+
+    for directory, _, names in os.walk(blob_root()):
+        for digest in names:
+            path = os.path.join(directory, digest)
+            blob_stat = os.stat(path)
+            links = blob_stat.st_nlink - 1
+            if links or blob_stat.st_mtime > cutoff:
+                counts.append({'_digest': digest, '_links': links})
+                if len(counts) >= batch_size:
+                    write_counts()
+                continue
+
+            if not dry_run:
+                os.remove(path)
+                db.session.execute(blobs.delete().where(blobs.c.digest == digest))
+            yield digest, blob_stat.st_size
+    write_counts()
@@ -0,0 +1,269 @@
+''' Resumable uploads, sent in chunks.
+
+    An upload session is started with the file's name and size (and, for the file
+    manager, the item and folder it goes into). Every chunk is written straight into a
+    temporary file in the item storage volume, at the offset it was sent for, so the size
+    of that file is the offset of the next chunk: a client that lost its connection asks
+    for the offset and carries on from there instead of starting over. Chunks may carry
+    a checksum (Upload-Checksum: sha256 <hex digest>), a chunk that doesn't match it is
+    cut off again.
+
+    A complete upload is hashed and moved into place once, by the /upload form (see
+    backend.handle_item_upload) or by an 'upload' file job for the file manager, which
+    updates the item's file list and file index once for the whole file. Sessions that
+    haven't received a chunk in CHUNKED_UPLOAD_EXPIRY seconds are deleted by
+    ./item_storage.py prune-uploads. '''
+import contextlib
+import hashlib
+import os
+import re
+import secrets
+import time
+
+import flask
+
+from tsuu import backend, manifest, models
+from tsuu.extensions import db
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+    import msvcrt
+
+app = flask.current_app
+
+CHECKSUM_ALGORITHMS = ('sha1', 'sha256')
+
+TOKEN_BYTES = 16
+
+TEMP_PREFIX = '.chunked-'
+
+CONTENT_RANGE_RE = re.compile(r'^bytes (\d+)-(\d+)/(\d+)$')
+
+
+class UploadError(Exception):
+    pass
+
+
+class OffsetMismatch(UploadError):
+    ''' A chunk was sent for an offset past the data received so far '''
+
+    def __init__(self, offset):
+        super().__init__('Expected a chunk at offset {}'.format(offset))
+        self.offset = offset
+
+
+class ChecksumMismatch(UploadError):
+    pass
+
+
+class UploadBusy(UploadError):
+    pass
+
+
+def parse_checksum(header):
+    ''' Parses an Upload-Checksum header ("<algorithm> <hex digest>").
+        Returns (algorithm, hex digest), or None without a header. '''
+    if not header:
+        return None
+    algorithm, _, digest = header.strip().partition(' ')
+    algorithm = algorithm.lower()
+    if algorithm not in CHECKSUM_ALGORITHMS:
+        raise UploadError('Unsupported checksum algorithm {!r}'.format(algorithm))
+    return algorithm, digest.strip().lower()
+
+
+def parse_content_range(header):
+    ''' Parses a Content-Range header ("bytes <first>-<last>/<total>", as sent by
+        js-fileexplorer). Returns the offset of the first byte, or 0 without a header. '''
+    if not header:
+        return 0
+    match = CONTENT_RANGE_RE.match(header.strip())
+    if not match:
+        raise UploadError('Invalid Content-Range {!r}'.format(header))
+    return int(match.group(1))
+
+
+@contextlib.contextmanager
+def _locked(upload_file, size):
+    ''' Locks an upload file of size bytes against other chunks of the same upload, in
+        any process. The lock goes away with the process holding it. '''
+    fd = upload_file.fileno()
+    try:
+        if fcntl:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        else:
+            # Windows locks byte ranges, this one is past the end of the complete file
+            os.lseek(fd, size, os.SEEK_SET)
+            msvcrt.locking(fd, msvcrt.LK_NBLCK, 1)
+    except OSError:
+        raise UploadBusy('Another chunk of this upload is being written')
+    try:
+        yield
+    finally:
+        if not fcntl:
+            os.lseek(fd, size, os.SEEK_SET)
+            msvcrt.locking(fd, msvcrt.LK_UNLCK, 1)
+
+
+def write_chunk(path, offset, stream, size, checksum=None, chunk_size=None):
+    ''' Writes a chunk read from stream into the upload file at path, at offset. The
+        file is complete at size bytes. Data before the end of the file has been received
+        already (a chunk sent again after its response got lost) and is skipped; a chunk
+        starting past the end raises OffsetMismatch. With a checksum (see parse_checksum),
+        a chunk that doesn't match it is discarded.
+        Returns (the new offset, whether this chunk completed the file). '''
+    chunk_size = chunk_size or 1024 * 1024
+    h = hashlib.new(checksum[0]) if checksum else None
+
+    with open(path, 'r+b') as upload_file, _locked(upload_file, size):
+        current = os.fstat(upload_file.fileno()).st_size
+        if offset > current:
+            raise OffsetMismatch(current)
+
+        upload_file.seek(current)
+        position = offset
+        try:
+            for data in iter(lambda: stream.read(chunk_size), b''):
+                if h:
+                    h.update(data)
+                end = position + len(data)
+                if end > size:
+                    raise UploadError('The chunk goes past the end of the file')
+                if end > current:
+                    upload_file.write(data[max(current - position, 0):])
+                position = end
+            if h and h.hexdigest() != checksum[1]:
+                raise ChecksumMismatch('The chunk does not match its checksum')
+        except UploadError:
+            upload_file.truncate(current)
+            raise
+        except BaseException:
+            # Without a checksum, whatever arrived of the chunk is kept for the next one
+            if h:
+                upload_file.truncate(current)
+            raise
+
+        upload_file.flush()
+        new_offset = upload_file.tell()
+    return new_offset, current < size and new_offset == size
+
+
+def upload_path(token):
+    ''' The temporary file of an upload, next to the item directories so that moving it
+        into one is a rename '''
+    return os.path.join(backend.item_storage_root(), TEMP_PREFIX + token)
+
+
+def offset(upload):
+    ''' Returns the number of bytes received, or None if the upload's file is gone '''
+    try:
+        return os.path.getsize(upload_path(upload.token))
+    except FileNotFoundError:
+        return None
+
+
+def create(user, filename, size, item=None, path=None):
+    ''' Starts an upload of size bytes. For the file manager, path is where the file goes
+        in the item's directory. Commits and returns the session. '''
+    upload = models.UploadSession(token=secrets.token_hex(TOKEN_BYTES), filename=filename,
+                                  size=size, item_id=item.id if item else None, path=path,
+                                  user_id=user.id if user else None)
+    os.makedirs(backend.item_storage_root(), exist_ok=True)
+    with open(upload_path(upload.token), 'xb'):
+        pass
+    db.session.add(upload)
+    db.session.commit()
+    return upload
+
+
+def get(token, user):
+    ''' Returns the upload session with token if it belongs to user and its file is still
+        there, None otherwise '''
+    upload = models.UploadSession.by_token(token) if token else None
+    if upload is None or upload.user_id != (user.id if user else None):
+        return None
+    if offset(upload) is None:
+        return None
+    return upload
+
+
+def resume(token, user, filename, size, item=None, path=None):
+    ''' Returns the session of token if it's an upload of the same file to the same
+        place, so that the client can carry on with it, None otherwise '''
+    upload = get(token, user)
+    if upload is None or upload.item_id != (item.id if item else None):
+        return None
+    if (upload.filename, upload.size, upload.path) == (filename, size, path):
+        return upload
+    return None
+
+
+def claim(upload):
+    ''' Takes a complete upload out of its session to store it. Hashes the file (in the
+        manifest process pool) and deletes the session, without committing.
+        Returns (temporary file path, sha256 hexdigest, size). '''
+    temp_path = upload_path(upload.token)
+    if offset(upload) != upload.size:
+        raise UploadError('The upload is not complete')
+
+    executor = manifest.executor()
+    if executor:
+        digest = executor.submit(manifest.hash_file, temp_path).result()
+    else:
+        digest = manifest.hash_file(temp_path)
+
+    db.session.delete(upload)
+    return temp_path, digest, upload.size
+
+
+def cancel(upload):
+    ''' Deletes an upload and the data received for it. Commits. '''
+    try:
+        os.remove(upload_path(upload.token))
+    except FileNotFoundError:
+        pass
+    db.session.delete(upload)
+    db.session.commit()
+
+
+def prune(expiry, dry_run=False):
+    ''' Deletes the uploads that haven't received a chunk in expiry seconds, and
+        temporary files without a session. Yields the token of every deleted upload. '''
+    cutoff = time.time() - expiry
+    storage_root = backend.item_storage_root()
+
+    tokens = set()
+    for upload in models.UploadSession.query.all():
+        tokens.add(upload.token)
+        try:
+            expired = os.path.getmtime(upload_path(upload.token)) < cutoff
+        except FileNotFoundError:
+            expired = True
+        if expired:
+            if not dry_run:
+                cancel(upload)
+            yield upload.token
+
+    for name in os.listdir(storage_root) if os.path.isdir(storage_root) else []:
+        if not name.startswith(TEMP_PREFIX) or name[len(TEMP_PREFIX):] in tokens:
+            continue
+        path = os.path.join(storage_root, name)
+        if os.path.getmtime(path) < cutoff:
+            if not dry_run:
+                os.remove(path)
+            yield name[len(TEMP_PREFIX):]
+
+
+def describe(upload):
+    ''' The response to starting or resuming an upload: where to send its chunks, from
+        which offset and in chunks of which size '''
+    return {
+        'success': True,
+        'token': upload.token,
+        'url': flask.url_for('uploads.chunk', token=upload.token),
+        'offset': offset(upload),
+        'size': upload.size,
+        'chunk_size': app.config.get('CHUNKED_UPLOAD_CHUNK_SIZE', 8 * 1024 * 1024),
+    }
@@ -0,0 +1,222 @@
+''' Buffered, batched database writes.
+
+    Counting a download with an UPDATE per request means a write and a row lock on
+    the statistics row of every hot item. Instead, downloads are added up in memory
+    (or in a redis hash shared by all workers) and a background thread applies them
+    in batches, with one UPDATE ... SET download_count = download_count + n
+    per distinct n. Users' last login IPs are written the same way. '''
+import atexit
+import os
+import threading
+import time
+import uuid
+from collections import Counter, defaultdict
+
+import redis
+from sqlalchemy import bindparam
+
+from tsuu import models
+from tsuu.extensions import db
+
+# Maximum number of item ids per UPDATE statement
+UPDATE_BATCH_SIZE = 500
+
+
+def group_increments(counts):
+    ''' Turns {item_id: n} into {n: [item_id, ...]} so every batch is one UPDATE '''
+    groups = defaultdict(list)
+    for item_id, count in counts.items():
+        if count:
+            groups[count].append(item_id)
+    return groups
+
+
+class BufferedWriter(object):
+    ''' Base class for writes that are gathered in memory and applied in batches
+        by a background thread every `interval` seconds. Subclasses implement flush(),
+        which writes what was gathered (and puts it back if that fails) and returns
+        the number of writes. '''
+
+    interval_config_key = None
+
+    def __init__(self, app=None):
+        self._lock = threading.Lock()
+        self._thread = None
+        self._pid = None
+        self.app = None
+        self.interval = 30
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.app = app
+        self.interval = app.config.get(self.interval_config_key, self.interval)
+        # Don't lose the last few seconds of writes on a clean shutdown
+        atexit.register(self.flush_in_context)
+
+    def _ensure_flusher(self):
+        # Started lazily (and again after a fork), since threads don't survive forking workers
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            self._reset()
+            self._thread = threading.Thread(target=self._run, name=type(self).__name__,
+                                            daemon=True)
+            self._thread.start()
+
+    def _reset(self):
+        ''' Drops writes buffered by the parent process (called after a fork) '''
+        pass
+
+    def _run(self):
+        while True:
+            time.sleep(self.interval)
+            try:
+                self.flush_in_context()
+            except Exception:
+                self.app.logger.exception('%s flush failed', type(self).__name__)
+
+    def flush_in_context(self):
+        if self.app is None:
+            return
+        with self.app.app_context():
+            return self.flush()
+
+
+class DownloadCounter(BufferedWriter):
+
+    interval_config_key = 'DOWNLOAD_COUNT_FLUSH_INTERVAL'
+
+    def __init__(self, app=None):
+        self._pending = Counter()
+        self._redis = None
+        self._redis_key = None
+        super().__init__(app)
+
+    def init_app(self, app):
+        super().init_app(app)
+        redis_url = app.config.get('DOWNLOAD_COUNT_REDIS_URL')
+        if redis_url:
+            self._redis = redis.StrictRedis.from_url(redis_url)
+            self._redis_key = app.config.get('DOWNLOAD_COUNT_REDIS_KEY', 'tsuu_download_counts')
+
+    def record(self, item_id, count=1):
+        ''' Counts a download of an item. Doesn't touch the database. '''
+        self._ensure_flusher()
+        if self._redis is not None:
+            self._redis.hincrby(self._redis_key, item_id, count)
+        else:
+            with self._lock:
+                self._pending[item_id] += count
+
+    def _reset(self):
+        self._pending.clear()
+
+    def _take_pending(self):
+        ''' Atomically takes the counts gathered so far '''
+        if self._redis is None:
+            with self._lock:
+                pending, self._pending = self._pending, Counter()
+            return pending
+
+        # Renaming the hash claims it, so concurrent flushers never apply the same counts
+        claimed_key = '{}_{}'.format(self._redis_key, uuid.uuid4().hex)
+        if not self._redis.exists(self._redis_key):
+            return {}
+        try:
+            self._redis.rename(self._redis_key, claimed_key)
+        except redis.exceptions.ResponseError:
+            return {}  # Someone else claimed it first
+        pending = self._redis.hgetall(claimed_key)
+        self._redis.delete(claimed_key)
+        return {int(item_id): int(count) for item_id, count in pending.items()}
+
+    def _restore_pending(self, pending):
+        ''' Puts back counts that couldn't be written, for the next flush '''
+        if self._redis is None:
+            with self._lock:
+                self._pending.update(pending)
+            return
+
+        pipeline = self._redis.pipeline()
+        for item_id, count in pending.items():
+            pipeline.hincrby(self._redis_key, item_id, count)
+        pipeline.execute()
+
+    def flush(self):
+        ''' Writes the buffered counts to the database. Needs an app context. '''
+        pending = self._take_pending()
+        if not pending:
+            return 0
+
+        statistics = models.Statistic.__table__
+        # Core UPDATEs skip the mapper events that copy the counts into the listings
+        listings = models.Listing.__table__
+        try:
+            for count, item_ids in group_increments(pending).items():
+                for i in range(0, len(item_ids), UPDATE_BATCH_SIZE):
+                    batch = item_ids[i:i + UPDATE_BATCH_SIZE]
+                    db.session.execute(
+                        statistics.update()
+                        .where(statistics.c.item_id.in_(batch))
+                        .values(download_count=statistics.c.download_count + count))
+                    db.session.execute(
+                        listings.update()
+                        .where(listings.c.id.in_(batch))
+                        .values(download_count=listings.c.download_count + count))
+            db.session.commit()
+        except Exception:
+            # A deadlock or lost connection, none of the counts were written
+            db.session.rollback()
+            self._restore_pending(pending)
+            raise
+        return sum(pending.values())
+
+
+class LoginIpWriter(BufferedWriter):
+    ''' Coalesces User.last_login_ip updates: only the latest IP of every user
+        is written, in one executemany UPDATE per flush. '''
+
+    interval_config_key = 'LOGIN_IP_FLUSH_INTERVAL'
+
+    def __init__(self, app=None):
+        self._pending = {}
+        super().__init__(app)
+
+    def record(self, user_id, ip):
+        self._ensure_flusher()
+        with self._lock:
+            self._pending[user_id] = ip
+
+    def _reset(self):
+        self._pending.clear()
+
+    def flush(self):
+        with self._lock:
+            pending, self._pending = self._pending, {}
+        if not pending:
+            return 0
+
+        users = models.User.__table__
+        try:
+            db.session.execute(
+                users.update()
+                .where(users.c.id == bindparam('_user_id'))
+                .values(last_login_ip=bindparam('_ip')),
+                [{'_user_id': user_id, '_ip': ip} for user_id, ip in pending.items()])
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            with self._lock:
+                # IPs recorded since are newer
+                for user_id, ip in pending.items():
+                    self._pending.setdefault(user_id, ip)
+            raise
+        return len(pending)
+
+
+download_counter = DownloadCounter()
+login_ip_writer = LoginIpWriter()
@@ -0,0 +1,195 @@
+''' An inverted index of the file and directory names inside items.
+
+    Every file and directory of an item gets one row per term in its name in the
+    file_terms table: the lowercased words of the name and its extension (".mkv").
+    Searching for "file:<pattern>" then finds the items, and the paths inside them,
+    that have a name with all of the pattern's terms, straight from the index
+    instead of decoding every item's file list. Incremental file list changes only
+    replace the rows of the paths they touched (see reindex_paths), rescans rewrite
+    all of an item's rows; fill the index on an existing database with
+    ./item_storage.py rebuild-file-index. '''
+import os
+import re
+
+import sqlalchemy
+from tsuu import filelist, filetree, models
+from tsuu.extensions import db
+
+TERM_LENGTH = 64
+INSERT_BATCH_SIZE = 1000
+
+_WORD_REGEX = re.compile(r'\w+')
+# file:word, file:*.ext, file:"several words"
+_PATTERN_REGEX = re.compile(r'(?i)(?:^|\s)file:(?:"([^"]*)"|(\S+))')
+
+
+def name_terms(name):
+    ''' Returns the set of index terms for a file or directory name '''
+    name = name.lower()
+    terms = set(word[:TERM_LENGTH] for word in _WORD_REGEX.findall(name))
+    extension = os.path.splitext(name)[1]
+    if len(extension) > 1:
+        terms.add(extension[:TERM_LENGTH])
+    return terms
+
+
+def pattern_terms(pattern):
+    ''' Returns the terms a name must have to match a file: pattern.
+        "*.ext" and ".ext" match the extension, anything else the words in it. '''
+    pattern = pattern.lower().strip()
+    if pattern.startswith('*.'):
+        pattern = pattern[1:]
+    if re.match(r'^\.\w+$', pattern):
+        return {pattern[:TERM_LENGTH]}
+    return set(word[:TERM_LENGTH] for word in _WORD_REGEX.findall(pattern))
+
+
+def split_file_patterns(term):
+    ''' Splits the file: patterns out of a search term.
+        Returns (the rest of the term, [set of terms for every pattern]) '''
+    patterns = []
+    for phrase, word in _PATTERN_REGEX.findall(term):
+        terms = pattern_terms(phrase or word)
+        if terms:
+            patterns.append(terms)
+    rest = ' '.join(_PATTERN_REGEX.sub(' ', term).split())
+    return rest, patterns
+
+
+def index_rows(item_id, tree, parts=()):
+    ''' Yields the file_terms rows for an item's file tree (without the item directory),
+        or for the subtree at parts. Directory paths end with a slash. '''
+    for parts, node in filetree.walk_tree(tree, tuple(parts)):
+        yield from _node_rows(item_id, parts, node)
+
+
+def _node_rows(item_id, parts, node):
+    path = '/'.join(parts) + ('/' if isinstance(node, dict) else '')
+    for term in name_terms(parts[-1]):
+        yield {'item_id': item_id, 'term': term, 'path': path}
+
+
+def _insert_rows(rows):
+    table = models.FileTerm.__table__
+    batch = []
+    for row in rows:
+        batch.append(row)
+        if len(batch) >= INSERT_BATCH_SIZE:
+            db.session.execute(table.insert(), batch)
+            batch = []
+    if batch:
+        db.session.execute(table.insert(), batch)
+
+
+def reindex_item(item_id, file_tree):
+    ''' Replaces the index rows of an item with those for file_tree, as stored in
+        its file list ({item_directory: tree}). Doesn't commit. '''
+    table = models.FileTerm.__table__
+    db.session.execute(table.delete().where(table.c.item_id == item_id))
+
+    if not isinstance(file_tree, dict):
+        return
+    # The top level entry is the item directory (or the file of a single file item)
+    tree = {}
+    for name, node in file_tree.items():
+        tree.update(node if isinstance(node, dict) else {name: node})
+
+    _insert_rows(index_rows(item_id, tree))
+
+
+def touched_roots(touched):
+    ''' Reduces the touched paths of filetree.apply_changes to the ones to reindex.
+        Returns ({parts: node or None}, set of the parent directory parts), without the
+        paths below another touched path, which are reindexed along with it. '''
+    roots = {}
+    for parts, node in touched:
+        roots[tuple(parts)] = node
+    roots = {parts: node for parts, node in roots.items()
+             if not any(parts[:i] in roots for i in range(1, len(parts)))}
+    # Adding a path creates its missing parent directories
+    parents = set(parts[:i] for parts in roots for i in range(1, len(parts)))
+    return roots, parents
+
+
+def reindex_paths(item_id, tree, touched):
+    ''' Replaces the index rows of the paths filetree.apply_changes touched in an item's
+        tree (without the item directory), and of everything below them, so that
+        renaming or removing a directory takes its contents along. Doesn't commit. '''
+    table = models.FileTerm.__table__
+    item_rows = table.c.item_id == item_id
+    roots, parents = touched_roots(touched)
+
+    rows = []
+    for parts in sorted(parents):
+        path = '/'.join(parts) + '/'
+        db.session.execute(table.delete().where(item_rows).where(table.c.path == path))
+        rows.extend(_node_rows(item_id, parts, filetree.get_node(tree, parts)))
+    for parts, node in sorted(roots.items()):
+        path = '/'.join(parts)
+        db.session.execute(table.delete().where(item_rows).where(
+            (table.c.path == path) | table.c.path.startswith(path + '/', autoescape=True)))
+        if node is not None:
+            rows.extend(_node_rows(item_id, parts, node))
+            if isinstance(node, dict):
+                rows.extend(index_rows(item_id, node, parts))
+
+    _insert_rows(rows)
+
+
+def rebuild(batch_size=500):
+    ''' Reindexes every item from its stored file list, one batch at a time.
+        Yields (last item id, number of items indexed) after every batch. '''
+    last_id = 0
+    while True:
+        batch = models.Filelist.query \
+            .filter(models.Filelist.item_id > last_id) \
+            .order_by(models.Filelist.item_id.asc()) \
+            .limit(batch_size).all()
+        if not batch:
+            return
+
+        for item_filelist in batch:
+            blob = item_filelist.filelist_blob
+            reindex_item(item_filelist.item_id, filelist.decode(blob) if blob else None)
+        db.session.commit()
+
+        last_id = batch[-1].item_id
+        yield last_id, len(batch)
+
+
+def _matching_files(terms, term_count):
+    table = models.FileTerm.__table__
+    return (sqlalchemy.select([table.c.item_id, table.c.path])
+            .where(table.c.term.in_(terms))
+            .group_by(table.c.item_id, table.c.path)
+            .having(sqlalchemy.func.count(sqlalchemy.distinct(table.c.term)) == term_count))
+
+
+def item_criterion(terms, term_count, id_column=None):
+    ''' Filters items (by id_column, the item id by default) to those with a file or
+        directory name that has all of the terms. For baked queries, terms can be an
+        expanding bindparam and term_count a bindparam. '''
+    if id_column is None:
+        id_column = models.Item.id
+    matching = _matching_files(terms, term_count).alias()
+    return id_column.in_(sqlalchemy.select([matching.c.item_id]))
+
+
+def matching_paths(patterns, item_ids, limit=5):
+    ''' Returns {item_id: [path, ...]} with up to `limit` paths per item that match any
+        of the patterns, for showing next to search results '''
+    matches = {}
+    if not item_ids:
+        return matches
+
+    for terms in patterns:
+        query = _matching_files(list(terms), len(terms)).where(
+            models.FileTerm.__table__.c.item_id.in_(item_ids))
+        for item_id, path in db.session.execute(query):
+            paths = matches.setdefault(item_id, [])
+            if len(paths) < limit and path not in paths:
+                paths.append(path)
+
+    for paths in matches.values():
+        paths.sort()
+    return matches
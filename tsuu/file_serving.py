@@ -0,0 +1,136 @@
+''' Serving files (and other bodies of a known size) with conditional GET and Range support.
+
+    Full responses are handed to the WSGI server's wsgi.file_wrapper when it has one,
+    which lets servers like gunicorn and uWSGI use sendfile(2) instead of copying the
+    file through Python. Partial responses are read in bounded chunks, since
+    file_wrapper implementations don't agree on whether they stop at Content-Length.
+
+    Alternatively, offload_file hands the whole transfer to the front-end web server. '''
+import mimetypes
+import os
+from datetime import datetime
+from urllib.parse import quote
+
+from werkzeug.http import is_resource_modified, parse_range_header
+from werkzeug.wrappers import Response
+from werkzeug.wsgi import wrap_file
+
+CHUNK_SIZE = 64 * 1024
+
+
+def file_etag(stat_result):
+    ''' A strong ETag derived from the file's size and modification time '''
+    return '{:x}-{:x}'.format(stat_result.st_mtime_ns, stat_result.st_size)
+
+
+def requested_range(environ, size, etag, last_modified):
+    ''' Works out which part of a body of the given size should be sent.
+
+        Returns None for the whole body, (start, stop) for a single byte range,
+        or False if the requested range can't be satisfied.
+        Multiple ranges are answered with the whole body. '''
+    if 'HTTP_RANGE' not in environ or environ['REQUEST_METHOD'] not in ('GET', 'HEAD'):
+        return None
+
+    # If-Range: the client only wants the range if its copy is still current
+    if 'HTTP_IF_RANGE' in environ and is_resource_modified(
+            environ, etag, last_modified=last_modified, ignore_if_range=False):
+        return None
+
+    byte_range = parse_range_header(environ['HTTP_RANGE'])
+    if byte_range is None or byte_range.units != 'bytes':
+        return None
+    if len(byte_range.ranges) != 1:
+        return None
+
+    range_for_length = byte_range.range_for_length(size)
+    if range_for_length is None:
+        return False
+    return range_for_length
+
+
+def make_response(environ, size, etag, last_modified, open_body,
+                  mimetype='application/octet-stream', response_class=Response):
+    ''' Builds a (possibly 206 or 304) response for a body of a known size.
+
+        open_body(start, stop) must return an iterable yielding bytes start..stop
+        of the body; it is only called if a body is actually sent. '''
+    if isinstance(last_modified, (int, float)):
+        last_modified = datetime.utcfromtimestamp(int(last_modified))
+
+    response = response_class(mimetype=mimetype, direct_passthrough=True)
+    response.set_etag(etag)
+    response.last_modified = last_modified
+    response.accept_ranges = 'bytes'
+
+    if not is_resource_modified(environ, etag, last_modified=last_modified):
+        response.status_code = 304
+        return response
+
+    byte_range = requested_range(environ, size, etag, last_modified)
+    if byte_range is False:
+        response.status_code = 416
+        response.headers['Content-Range'] = 'bytes */{}'.format(size)
+        return response
+
+    start, stop = byte_range or (0, size)
+    if byte_range is not None:
+        response.status_code = 206
+        response.content_range.set(start, stop, size)
+
+    response.content_length = stop - start
+    if environ['REQUEST_METHOD'] != 'HEAD':
+        response.response = open_body(start, stop)
+    return response
+
+
+def iter_file_range(f, start, stop, chunk_size=CHUNK_SIZE):
+    ''' Yields bytes start..stop of an open file, closing it afterwards '''
+    try:
+        f.seek(start)
+        remaining = stop - start
+        while remaining > 0:
+            data = f.read(min(chunk_size, remaining))
+            if not data:
+                break
+            remaining -= len(data)
+            yield data
+    finally:
+        f.close()
+
+
+def send_file(environ, path, mimetype=None, response_class=Response, chunk_size=CHUNK_SIZE):
+    ''' Sends a file from disk, honouring conditional and Range requests '''
+    stat_result = os.stat(path)
+    size = stat_result.st_size
+
+    if mimetype is None:
+        mimetype = mimetypes.guess_type(path)[0] or 'application/octet-stream'
+
+    def open_body(start, stop):
+        f = open(path, 'rb')
+        if start == 0 and stop == size:
+            return wrap_file(environ, f, chunk_size)
+        return iter_file_range(f, start, stop, chunk_size)
+
+    return make_response(environ, size, file_etag(stat_result), stat_result.st_mtime,
+                         open_body, mimetype=mimetype, response_class=response_class)
+
+
+def offload_file(mode, path, accel_path, mimetype=None, response_class=Response):
+    ''' Lets the front-end web server send a file after the app has authorised it.
+
+        mode is either 'x-accel' (nginx, redirects to the internal location accel_path)
+        or 'x-sendfile' (Apache mod_xsendfile and lighttpd, which get the file path).
+        The web server takes care of Range and conditional requests. '''
+    if mimetype is None:
+        mimetype = mimetypes.guess_type(path)[0] or 'application/octet-stream'
+
+    response = response_class(mimetype=mimetype)
+    if mode == 'x-accel':
+        response.headers['X-Accel-Redirect'] = quote(accel_path)
+    elif mode == 'x-sendfile':
+        response.headers['X-Sendfile'] = os.path.abspath(path)
+    else:
+        raise ValueError('Unknown download offload mode: {!r}'.format(mode))
+    return response
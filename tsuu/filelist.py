@@ -0,0 +1,235 @@
+''' Compact binary encoding for item file lists (ItemFilelist.filelist_blob).
+
+    Layout (little-endian), version 1:
+
+        header        magic "TSFL", version, node count, file count,
+                      string count, string data size
+        string index  (string count + 1) offsets into the string data
+        string data   utf-8 names, deduplicated
+        nodes         one (parent, name, size, is_dir) record per node
+        child index   one (first child, child count) record per node
+
+    Node 0 is a nameless root. Nodes are stored breadth-first with every
+    directory's children sorted like utils.sorted_pathdict (directories first,
+    then by name), so the children of a directory are a contiguous slice of
+    the node list. That lets a reader count files, list one directory or
+    decode the first N entries without materializing the whole tree.
+
+    Older blobs are plain JSON dicts; FilelistReader and decode read both. '''
+import json
+import struct
+from collections import deque
+
+MAGIC = b'TSFL'
+VERSION = 1
+
+_HEADER = struct.Struct('<4sB3xIIII')
+_OFFSET = struct.Struct('<I')
+_NODE = struct.Struct('<IIQ?')
+_CHILDREN = struct.Struct('<II')
+
+_NO_PARENT = 0xFFFFFFFF
+
+
+class FilelistFormatError(ValueError):
+    pass
+
+
+def is_binary(blob):
+    ''' Returns True if the blob uses the binary format, False for legacy JSON '''
+    return bytes(blob[:len(MAGIC)]) == MAGIC
+
+
+def _sorted_children(directory):
+    ''' Directories first, then files, both sorted by name (like utils.sorted_pathdict) '''
+    directories = sorted(k for k, v in directory.items() if isinstance(v, dict))
+    files = sorted(k for k, v in directory.items() if not isinstance(v, dict))
+    return [(name, directory[name]) for name in directories + files]
+
+
+def encode(tree):
+    ''' Encodes a file tree dict into the binary format '''
+    strings = {}
+    string_data = []
+    string_offsets = [0]
+
+    def intern(name):
+        index = strings.get(name)
+        if index is None:
+            index = strings[name] = len(string_data)
+            encoded = name.encode('utf-8', 'surrogatepass')
+            string_data.append(encoded)
+            string_offsets.append(string_offsets[-1] + len(encoded))
+        return index
+
+    # (parent, name index, size, is_dir) and (first child, child count) per node
+    nodes = [(_NO_PARENT, intern(''), 0, True)]
+    children = [None]
+    file_count = 0
+
+    queue = deque([(0, tree)])
+    while queue:
+        node_index, directory = queue.popleft()
+        entries = _sorted_children(directory)
+        children[node_index] = (len(nodes), len(entries))
+        for name, value in entries:
+            child_index = len(nodes)
+            if isinstance(value, dict):
+                nodes.append((node_index, intern(name), 0, True))
+                children.append(None)
+                queue.append((child_index, value))
+            else:
+                nodes.append((node_index, intern(name), value, False))
+                children.append((0, 0))
+                file_count += 1
+
+    # Directory sizes are the sum of their contents; children always come after parents
+    sizes = [node[2] for node in nodes]
+    for index in range(len(nodes) - 1, 0, -1):
+        sizes[nodes[index][0]] += sizes[index]
+
+    joined_strings = b''.join(string_data)
+    parts = [_HEADER.pack(MAGIC, VERSION, len(nodes), file_count,
+                          len(string_data), len(joined_strings))]
+    parts.extend(_OFFSET.pack(offset) for offset in string_offsets)
+    parts.append(joined_strings)
+    parts.extend(_NODE.pack(parent, name, size, is_dir)
+                 for (parent, name, _, is_dir), size in zip(nodes, sizes))
+    parts.extend(_CHILDREN.pack(*child_range) for child_range in children)
+    return b''.join(parts)
+
+
+class FilelistReader(object):
+    ''' Lazily reads a binary (or legacy JSON) file list blob.
+        Only the records that are asked for are unpacked. '''
+
+    def __init__(self, blob):
+        if not is_binary(blob):
+            # Legacy JSON blob, convert it in memory
+            blob = encode(json.loads(bytes(blob).decode('utf-8')))
+
+        self._buffer = memoryview(blob)
+        if len(self._buffer) < _HEADER.size:
+            raise FilelistFormatError('Truncated file list')
+
+        magic, version, self.node_count, self.file_count, string_count, strings_size = \
+            _HEADER.unpack_from(self._buffer)
+        if version != VERSION:
+            raise FilelistFormatError('Unsupported file list version {}'.format(version))
+
+        self._string_index = _HEADER.size
+        self._string_data = self._string_index + (string_count + 1) * _OFFSET.size
+        self._nodes = self._string_data + strings_size
+        self._children = self._nodes + self.node_count * _NODE.size
+        if len(self._buffer) != self._children + self.node_count * _CHILDREN.size:
+            raise FilelistFormatError('Truncated file list')
+
+    def __len__(self):
+        return self.file_count
+
+    def _string(self, index):
+        start, end = struct.unpack_from('<II', self._buffer,
+                                        self._string_index + index * _OFFSET.size)
+        data = self._buffer[self._string_data + start:self._string_data + end]
+        return bytes(data).decode('utf-8', 'surrogatepass')
+
+    def node(self, index):
+        ''' Returns (name, is_dir, size) for a node index '''
+        _, name, size, is_dir = _NODE.unpack_from(self._buffer, self._nodes + index * _NODE.size)
+        return self._string(name), is_dir, size
+
+    def child_range(self, index):
+        ''' Returns (first child index, child count) for a node index '''
+        return _CHILDREN.unpack_from(self._buffer, self._children + index * _CHILDREN.size)
+
+    def _is_dir(self, index):
+        return _NODE.unpack_from(self._buffer, self._nodes + index * _NODE.size)[3]
+
+    def _name(self, index):
+        name = _NODE.unpack_from(self._buffer, self._nodes + index * _NODE.size)[1]
+        return self._string(name)
+
+    def _bisect_name(self, start, end, name):
+        while start < end:
+            middle = (start + end) // 2
+            if self._name(middle) < name:
+                start = middle + 1
+            else:
+                end = middle
+        return start
+
+    def find(self, parts):
+        ''' Returns the node index of the given path parts, or None '''
+        index = 0
+        for part in parts:
+            first, count = self.child_range(index)
+            end = first + count
+
+            # Children are sorted directories first, then by name, so binary search each half
+            start, files_start = first, end
+            while start < files_start:
+                middle = (start + files_start) // 2
+                if self._is_dir(middle):
+                    start = middle + 1
+                else:
+                    files_start = middle
+
+            for half_start, half_end in ((first, files_start), (files_start, end)):
+                child = self._bisect_name(half_start, half_end, part)
+                if child < half_end and self._name(child) == part:
+                    index = child
+                    break
+            else:
+                return None
+        return index
+
+    def listdir(self, parts=(), offset=0, limit=None):
+        ''' Returns a list of (name, is_dir, size) for one directory level, or None
+            if the path doesn't exist or isn't a directory. '''
+        index = self.find(parts)
+        if index is None or not self.node(index)[1]:
+            return None
+
+        first, count = self.child_range(index)
+        start = first + min(offset, count)
+        end = first + count if limit is None else min(first + count, start + limit)
+        return [self.node(child) for child in range(start, end)]
+
+    def count_children(self, parts=()):
+        ''' Returns the number of entries directly inside a directory, or None '''
+        index = self.find(parts)
+        if index is None or not self.node(index)[1]:
+            return None
+        return self.child_range(index)[1]
+
+    def to_dict(self, parts=(), limit=None):
+        ''' Decodes a (sub)tree into nested dicts. With limit, stops after that many files. '''
+        index = self.find(parts)
+        if index is None:
+            return None
+        remaining = [limit]
+
+        def build(node_index):
+            result = {}
+            first, count = self.child_range(node_index)
+            for child in range(first, first + count):
+                if remaining[0] is not None and remaining[0] <= 0:
+                    break
+                name, is_dir, size = self.node(child)
+                if is_dir:
+                    result[name] = build(child)
+                else:
+                    result[name] = size
+                    if remaining[0] is not None:
+                        remaining[0] -= 1
+            return result
+
+        name, is_dir, size = self.node(index)
+        return build(index) if is_dir else size
+
+
+def decode(blob):
+    ''' Decodes a binary or legacy JSON file list blob into a file tree dict '''
+    if not is_binary(blob):
+        return json.loads(bytes(blob).decode('utf-8'))
+    return FilelistReader(blob).to_dict()
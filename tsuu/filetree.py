@@ -0,0 +1,264 @@
+''' Helpers for parsed item file trees.
+
+    A file tree is a nested dict: directories map names to dicts,
+    files map names to their size in bytes. scan_tree builds a tree from disk
+    (list_directory lists a single level of it),
+    the other helpers apply single file manager operations to a stored tree,
+    so the index does not have to be rebuilt from disk after every change. '''
+import copy
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+
+class FileTreeError(Exception):
+    ''' Raised when an operation does not match the stored tree '''
+    pass
+
+
+def _scan_directory(path):
+    tree = {}
+    total_size = 0
+    with os.scandir(path) as entries:
+        for entry in entries:
+            # DirEntry caches the file type from the directory read itself,
+            # so only files need a stat() call for their size
+            if entry.is_dir():
+                tree[entry.name], size = _scan_directory(entry.path)
+            else:
+                tree[entry.name] = size = entry.stat().st_size
+            total_size += size
+    return tree, total_size
+
+
+def scan_tree(root, workers=0):
+    ''' Walks a directory in a single os.scandir pass.
+        Returns a tuple of (tree, total size in bytes). If root is a file,
+        the tree is just its size.
+
+        With workers set, the subdirectories of root are scanned in a thread pool,
+        which helps wide directories on high-latency (network) storage. '''
+    if not os.path.isdir(root):
+        size = os.path.getsize(root)
+        return size, size
+
+    if not workers:
+        return _scan_directory(root)
+
+    tree = {}
+    total_size = 0
+    subdirectories = []
+    with os.scandir(root) as entries:
+        for entry in entries:
+            if entry.is_dir():
+                subdirectories.append(entry)
+            else:
+                tree[entry.name] = entry.stat().st_size
+                total_size += tree[entry.name]
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        results = executor.map(_scan_directory, [entry.path for entry in subdirectories])
+        for entry, (subtree, size) in zip(subdirectories, results):
+            tree[entry.name] = subtree
+            total_size += size
+    return tree, total_size
+
+
+def list_directory(path):
+    ''' Lists a single directory level in one os.scandir pass.
+        Returns a list of (name, is_dir, size, mtime, mtime_ns) tuples, directories first
+        and then by name like utils.sorted_pathdict. size is None for directories. '''
+    directories = []
+    files = []
+    with os.scandir(path) as entries:
+        for entry in entries:
+            stat_result = entry.stat()
+            mtimes = (int(stat_result.st_mtime), stat_result.st_mtime_ns)
+            if entry.is_dir():
+                directories.append((entry.name, True, None) + mtimes)
+            else:
+                files.append((entry.name, False, stat_result.st_size) + mtimes)
+    return sorted(directories) + sorted(files)
+
+
+def split_path(path):
+    ''' Splits a relative path into its parts, dropping empty and "." parts '''
+    if not isinstance(path, (list, tuple)):
+        path = path.replace('\\', '/').split('/')
+    parts = [part for part in path if part not in ('', '.')]
+    if '..' in parts:
+        raise FileTreeError('Path escapes the item directory: {}'.format(path))
+    return parts
+
+
+def tree_size(node):
+    ''' Returns the total size of a file or directory node '''
+    if isinstance(node, dict):
+        return sum(tree_size(child) for child in node.values())
+    return node
+
+
+def walk_tree(tree, parts=()):
+    ''' Yields (path parts, node) for every file and directory below tree, parents first '''
+    for name, node in tree.items():
+        path = parts + (name,)
+        yield path, node
+        if isinstance(node, dict):
+            yield from walk_tree(node, path)
+
+
+def get_node(tree, parts):
+    ''' Returns the node at the given path parts, raising FileTreeError if it doesn't exist '''
+    node = tree
+    for part in parts:
+        if not isinstance(node, dict) or part not in node:
+            raise FileTreeError('No such path in tree: {}'.format('/'.join(parts)))
+        node = node[part]
+    return node
+
+
+def _get_parent(tree, parts, create=False):
+    if not parts:
+        raise FileTreeError('Cannot modify the root of the tree')
+
+    node = tree
+    for part in parts[:-1]:
+        if part not in node:
+            if not create:
+                raise FileTreeError('No such directory in tree: {}'.format('/'.join(parts)))
+            node[part] = {}
+        node = node[part]
+        if not isinstance(node, dict):
+            raise FileTreeError('Not a directory in tree: {}'.format('/'.join(parts)))
+    return node
+
+
+def add_node(tree, parts, value):
+    ''' Adds (or replaces) a file or directory, creating missing parent directories.
+        Returns the change in total size. '''
+    parent = _get_parent(tree, parts, create=True)
+    old_size = tree_size(parent.get(parts[-1], 0))
+    parent[parts[-1]] = value
+    return tree_size(value) - old_size
+
+
+def remove_node(tree, parts):
+    ''' Removes a file or directory. Returns the change in total size. '''
+    parent = _get_parent(tree, parts)
+    if parts[-1] not in parent:
+        raise FileTreeError('No such path in tree: {}'.format('/'.join(parts)))
+    return -tree_size(parent.pop(parts[-1]))
+
+
+def sync_node(tree, parts, value):
+    ''' Sets a path to what the disk has there (see scan_tree), a file size or a
+        directory, or removes it for None. Returns the change in total size. '''
+    if value is not None:
+        return add_node(tree, parts, value)
+    try:
+        get_node(tree, parts)
+    except FileTreeError:
+        return 0
+    return remove_node(tree, parts)
+
+
+def _merge(target, source):
+    ''' Merges source into target the way copytree(dirs_exist_ok=True) would '''
+    for name, value in source.items():
+        if isinstance(value, dict) and isinstance(target.get(name), dict):
+            _merge(target[name], value)
+        else:
+            target[name] = copy.deepcopy(value)
+
+
+def copy_node(tree, src_parts, dest_parts):
+    ''' Copies a file or directory, merging into an existing directory.
+        Returns the change in total size. '''
+    source = get_node(tree, src_parts)
+    parent = _get_parent(tree, dest_parts, create=True)
+    existing = parent.get(dest_parts[-1])
+    old_size = tree_size(existing or 0)
+
+    if isinstance(source, dict) and isinstance(existing, dict):
+        _merge(existing, source)
+    else:
+        parent[dest_parts[-1]] = copy.deepcopy(source)
+    return tree_size(parent[dest_parts[-1]]) - old_size
+
+
+def rename_node(tree, src_parts, dest_parts):
+    ''' Renames a file or directory, replacing the destination like os.rename.
+        Returns the change in total size. '''
+    source = get_node(tree, src_parts)
+    delta = remove_node(tree, src_parts)
+    return delta + add_node(tree, dest_parts, source)
+
+
+def move_node(tree, src_parts, dest_parts):
+    ''' Moves a file or directory like shutil.move: moving onto an existing
+        directory places the source inside of it.
+        Returns the change in total size and the final destination parts. '''
+    try:
+        destination = get_node(tree, dest_parts)
+    except FileTreeError:
+        destination = None
+    if isinstance(destination, dict):
+        dest_parts = list(dest_parts) + [src_parts[-1]]
+    return rename_node(tree, src_parts, dest_parts), dest_parts
+
+
+def apply_changes(tree, changes):
+    ''' Applies a list of changes to a tree in place.
+
+        Each change is a tuple of one of:
+            ('add', path, value)  - a new file (value is its size) or directory (a dict)
+            ('remove', path)
+            ('rename', src, dest)
+            ('copy', src, dest)
+            ('move', src, dest)
+            ('sync', path, value) - a path read from disk again, value is None if it's gone
+
+        Returns a tuple of (change in total size, touched paths), where touched paths
+        is a list of (parts, node) tuples describing what the disk should look like
+        afterwards; node is None for paths that should no longer exist. '''
+    delta = 0
+    touched_parts = []
+
+    for change in changes:
+        action = change[0]
+        if action == 'add':
+            parts = split_path(change[1])
+            delta += add_node(tree, parts, change[2])
+            touched_parts.append(parts)
+        elif action == 'remove':
+            parts = split_path(change[1])
+            delta += remove_node(tree, parts)
+            touched_parts.append(parts)
+        elif action == 'sync':
+            parts = split_path(change[1])
+            delta += sync_node(tree, parts, change[2])
+            touched_parts.append(parts)
+        elif action in ('rename', 'copy', 'move'):
+            src_parts = split_path(change[1])
+            dest_parts = split_path(change[2])
+            if action == 'rename':
+                delta += rename_node(tree, src_parts, dest_parts)
+            elif action == 'copy':
+                delta += copy_node(tree, src_parts, dest_parts)
+            else:
+                moved, dest_parts = move_node(tree, src_parts, dest_parts)
+                delta += moved
+
+            if action != 'copy':
+                touched_parts.append(src_parts)
+            touched_parts.append(dest_parts)
+        else:
+            raise FileTreeError('Unknown change: {!r}'.format(action))
+
+    # Describe the final state, later changes may have undone earlier ones
+    touched = []
+    for parts in touched_parts:
+        try:
+            touched.append((parts, get_node(tree, parts)))
+        except FileTreeError:
+            touched.append((parts, None))
+    return delta, touched
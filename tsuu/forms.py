@@ -72,6 +72,13 @@ def upload_recaptcha_validator_shim(form, field):
         return True
 
 
+def upload_file_required(form, field):
+    ''' Requires a file, unless it was sent in chunks before the form (upload_token) '''
+    if form.upload_token.data:
+        raise StopValidation()
+    return FileRequired()(form, field)
+
+
 def register_email_blacklist_validator(form, field):
     email_blacklist = app.config.get('EMAIL_BLACKLIST', [])
     email = field.data.strip()
@@ -350,8 +357,10 @@ class NukeForm(FlaskForm):
 
 class UploadForm(FlaskForm):
     submission_file = FileField('Item file', [
-        FileRequired()
+        upload_file_required
     ])
+    # A resumable upload of the file, see chunked_uploads
+    upload_token = HiddenField()
 
     display_name = StringField('Item display name', [
         Length(min=3, max=255,
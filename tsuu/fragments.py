@@ -0,0 +1,143 @@
+''' Cached rendering of item listings.
+
+    Every search result row is cached as HTML, keyed by everything it shows (the
+    listing's id, updated_time, flags, comment count and statistics), so a changed item
+    simply gets a new key and nothing has to be invalidated.
+
+    Whole responses, the first pages of listings and the RSS feeds, are cached for
+    anonymous visitors. Their key has the listing generation, which is bumped once a
+    change to an item is committed (uploads, edits, deletes, comment counts), so they're
+    invalidated right away. Statistics only catch up when the key's time bucket changes.
+    The response's ETag is derived from the same key, which makes revalidation a 304
+    without touching the cache or the database. '''
+import hashlib
+import time
+import uuid
+
+import flask
+from sqlalchemy import event, inspect
+from sqlalchemy.orm import Session
+
+from tsuu import models
+from tsuu.extensions import cache
+
+app = flask.current_app
+
+GENERATION_KEY = 'listing_generation'
+
+# Response headers that aren't stored with a cached response
+_UNCACHED_HEADERS = ('set-cookie', 'content-length', 'etag', 'date')
+
+
+def bump_generation():
+    # Random like auth_cache.bump_generation, so an evicted key can't bring back an old one
+    cache.set(GENERATION_KEY, uuid.uuid4().hex, timeout=0)
+
+
+def _row_key(item):
+    return 'result_row_{}_{}_{:%Y%m%d%H%M%S%f}_{}_{}_{}_{}_{}'.format(
+        app.config['COMMIT_HASH'], item.id, item.updated_time, item.flags, item.comment_count,
+        item.seed_count, item.leech_count, item.download_count)
+
+
+def render_rows(items, file_matches=None):
+    ''' Returns the rendered search result rows of listings, from the row cache where
+        possible. Rows with file matches depend on the search and are never cached. '''
+    file_matches = file_matches or {}
+    timeout = app.config.get('ROW_CACHE_TIMEOUT', 0)
+
+    keys = [_row_key(item) for item in items]
+    cached = cache.get_many(*keys) if timeout and keys else [None] * len(keys)
+
+    rows = []
+    rendered = {}
+    for item, key, row in zip(items, keys, cached):
+        matches = file_matches.get(item.id)
+        if row is None or matches:
+            row = flask.render_template('search_result_row.html', item=item, matches=matches)
+            if timeout and not matches:
+                rendered[key] = row
+        rows.append(row)
+
+    if rendered:
+        cache.set_many(rendered, timeout=timeout)
+    return flask.Markup(''.join(rows))
+
+
+def response_key():
+    ''' Returns the response cache key of the current request, or None if its response
+        can't be shared: for logged in users or with flashed messages to show '''
+    timeout = app.config.get('RESPONSE_CACHE_TIMEOUT', 0)
+    if not timeout or flask.g.user or '_flashes' in flask.session:
+        return None
+
+    request = flask.request
+    url = request.url_root + request.full_path
+    return 'response_{}_{}_{}_{}'.format(
+        app.config['COMMIT_HASH'], cache.get(GENERATION_KEY), int(time.time() // timeout),
+        hashlib.sha1(url.encode('utf-8')).hexdigest())
+
+
+def _etag(key):
+    return hashlib.sha1(key.encode('utf-8')).hexdigest()
+
+
+def cached_response(key):
+    ''' Returns a 304 if the client has the response for key already, the cached
+        response if there is one, or None '''
+    etag = _etag(key)
+    if etag in flask.request.if_none_match:
+        response = flask.Response(status=304)
+        response.set_etag(etag)
+        return response
+
+    cached = cache.get(key)
+    if cached is None:
+        return None
+    body, headers = cached
+    response = flask.Response(body, headers=headers)
+    response.set_etag(etag)
+    return response
+
+
+def cache_response(key, response):
+    ''' Stores a successful response under key and gives it the ETag of the key '''
+    if response.status_code != 200:
+        return response
+
+    headers = [(name, value) for name, value in response.headers
+               if name.lower() not in _UNCACHED_HEADERS]
+    cache.set(key, (response.get_data(), headers),
+              timeout=app.config.get('RESPONSE_CACHE_TIMEOUT', 0))
+    response.set_etag(_etag(key))
+    return response
+
+
+# Bump the generation once a change to an item is committed, so that no request
+# caches the old listing in between
+def _mark_changed(mapper, connection, target):
+    session = inspect(target).session
+    if session is not None:
+        session.info['listing_changed'] = True
+
+
+for _event_name in ('after_insert', 'after_update', 'after_delete'):
+    event.listen(models.Item, _event_name, _mark_changed, propagate=True)
+
+
+@event.listens_for(Session, 'after_bulk_update')
+def _after_bulk_update(update_context):
+    # Item.update_comment_count_db
+    if issubclass(update_context.mapper.class_, (models.Item, models.Listing)):
+        update_context.session.info['listing_changed'] = True
+
+
+@event.listens_for(Session, 'after_commit')
+def _after_commit(session):
+    if session.info.pop('listing_changed', False):
+        bump_generation()
+
+
+@event.listens_for(Session, 'after_rollback')
+def _after_rollback(session):
+    session.info.pop('listing_changed', None)
@@ -0,0 +1,115 @@
+''' Full-text search on SQLite, with an FTS5 index over item names and descriptions.
+
+    MySQL deployments use the FULLTEXT index through sqlalchemy_fulltext instead.
+    The FTS5 table uses the items table as its external content and is kept in sync
+    by triggers, so every way of writing an item (uploads, edits, the API, scripts)
+    updates it. It is created along with the items table by db_create.py; on an
+    existing database create and fill it with ./item_storage.py rebuild-fulltext. '''
+import re
+
+import flask
+import sqlalchemy
+from sqlalchemy import DDL, event
+
+from tsuu import models
+from tsuu.extensions import db
+
+app = flask.current_app
+
+ITEMS_TABLE = models.Item.__table__.name
+FTS_TABLE = ITEMS_TABLE + '_fts'
+
+# Matches in the name count ten times as much as matches in the description
+BM25_WEIGHTS = (10.0, 1.0)
+
+_CREATE_STATEMENTS = (
+    # Prefix indexes make short prefix queries ("abc"*) fast
+    "CREATE VIRTUAL TABLE IF NOT EXISTS {fts} USING fts5("
+    "display_name, description, content='{items}', content_rowid='id', "
+    "tokenize='unicode61 remove_diacritics 2', prefix='2 3')",
+
+    "CREATE TRIGGER IF NOT EXISTS {fts}_ai AFTER INSERT ON {items} BEGIN "
+    "INSERT INTO {fts}(rowid, display_name, description) "
+    "VALUES (new.id, new.display_name, new.description); END",
+
+    "CREATE TRIGGER IF NOT EXISTS {fts}_ad AFTER DELETE ON {items} BEGIN "
+    "INSERT INTO {fts}({fts}, rowid, display_name, description) "
+    "VALUES ('delete', old.id, old.display_name, old.description); END",
+
+    "CREATE TRIGGER IF NOT EXISTS {fts}_au AFTER UPDATE OF display_name, description "
+    "ON {items} BEGIN "
+    "INSERT INTO {fts}({fts}, rowid, display_name, description) "
+    "VALUES ('delete', old.id, old.display_name, old.description); "
+    "INSERT INTO {fts}(rowid, display_name, description) "
+    "VALUES (new.id, new.display_name, new.description); END",
+)
+
+for _statement in _CREATE_STATEMENTS:
+    event.listen(models.Item.__table__, 'after_create',
+                 DDL(_statement.format(fts=FTS_TABLE, items=ITEMS_TABLE))
+                 .execute_if(dialect='sqlite'))
+
+fts_table = sqlalchemy.table(FTS_TABLE, sqlalchemy.column('rowid'))
+_fts_table_column = sqlalchemy.literal_column(FTS_TABLE)
+
+# -word, "a phrase", word*
+_TOKEN_REGEX = re.compile(r'(-?)(?:"([^"]*)"|(\S+))')
+
+
+def enabled():
+    ''' Returns True if search terms should use the FTS5 index '''
+    return (not app.config.get('USE_MYSQL') and
+            app.config.get('SQLITE_FULLTEXT_SEARCH', True) and
+            db.engine.dialect.name == 'sqlite')
+
+
+def match_expression(term):
+    ''' Turns a search term into an FTS5 query. All words have to match, "quoted phrases"
+        match as a whole, a trailing * matches prefixes and a leading - excludes.
+        Returns None if there is nothing to search for. '''
+    included = []
+    excluded = []
+    for negate, phrase, word in _TOKEN_REGEX.findall(term):
+        text, prefix = phrase, False
+        if not phrase:
+            text = word.rstrip('*')
+            prefix = text != word
+
+        # Quoting every token keeps FTS5 from reading its punctuation as syntax
+        if not re.search(r'\w', text):
+            continue
+        token = '"{}"'.format(text.replace('"', '""')) + ('*' if prefix else '')
+        (excluded if negate else included).append(token)
+
+    if not included:
+        return None
+    expression = ' AND '.join(included)
+    if excluded:
+        expression = '({}) NOT {}'.format(expression, ' NOT '.join(excluded))
+    return expression
+
+
+def match_criterion(expression):
+    ''' Filters a query joined with join_fts to the rows matching an FTS5 expression '''
+    return _fts_table_column.op('MATCH')(expression)
+
+
+def join_fts(query, id_column=None):
+    ''' Joins the FTS5 table on id_column, by default the item id '''
+    if id_column is None:
+        id_column = models.Item.id
+    return query.join(fts_table, fts_table.c.rowid == id_column)
+
+
+def rank():
+    ''' BM25 rank of the current match, lower is more relevant '''
+    return sqlalchemy.func.bm25(_fts_table_column, *BM25_WEIGHTS)
+
+
+def rebuild():
+    ''' Creates the FTS5 table and its triggers if needed and reindexes all items '''
+    for statement in _CREATE_STATEMENTS:
+        db.session.execute(sqlalchemy.text(statement.format(fts=FTS_TABLE, items=ITEMS_TABLE)))
+    db.session.execute(sqlalchemy.text(
+        "INSERT INTO {0}({0}) VALUES ('rebuild')".format(FTS_TABLE)))
+    db.session.commit()
@@ -0,0 +1,94 @@
+''' A binary prefix trie of IPv4 and IPv6 networks.
+
+    Every network is stored at the node reached by following the bits of its
+    prefix, so looking up an address walks at most 32 (IPv4) or 128 (IPv6) nodes
+    and finds every stored network that contains it, however many are stored. '''
+from ipaddress import ip_address, ip_network
+
+# Node layout: [child for bit 0, child for bit 1, {key: value} or None]
+_ZERO, _ONE, _VALUES = 0, 1, 2
+
+
+def _new_node():
+    return [None, None, None]
+
+
+class PrefixTrie(object):
+
+    def __init__(self):
+        self._roots = {4: _new_node(), 6: _new_node()}
+        self._size = 0
+
+    def __len__(self):
+        return self._size
+
+    @staticmethod
+    def _bits(network):
+        ''' Yields the prefix bits of a network, most significant first '''
+        value = int(network.network_address)
+        width = network.max_prefixlen
+        for i in range(network.prefixlen):
+            yield (value >> (width - 1 - i)) & 1
+
+    def add(self, network, key, value=None):
+        ''' Stores value under key at network (an ip_network or CIDR string) '''
+        network = ip_network(network, strict=False)
+        node = self._roots[network.version]
+        for bit in self._bits(network):
+            if node[bit] is None:
+                node[bit] = _new_node()
+            node = node[bit]
+
+        if node[_VALUES] is None:
+            node[_VALUES] = {}
+        if key not in node[_VALUES]:
+            self._size += 1
+        node[_VALUES][key] = value
+
+    def remove(self, network, key):
+        ''' Removes key from network. Returns False if it wasn't there. '''
+        network = ip_network(network, strict=False)
+        path = [self._roots[network.version]]
+        for bit in self._bits(network):
+            node = path[-1][bit]
+            if node is None:
+                return False
+            path.append(node)
+
+        values = path[-1][_VALUES]
+        if not values or key not in values:
+            return False
+        del values[key]
+        self._size -= 1
+        if not values:
+            path[-1][_VALUES] = None
+
+        # Prune nodes that no longer lead anywhere
+        bits = list(self._bits(network))
+        for depth in range(len(bits), 0, -1):
+            node = path[depth]
+            if node[_ZERO] is None and node[_ONE] is None and node[_VALUES] is None:
+                path[depth - 1][bits[depth - 1]] = None
+            else:
+                break
+        return True
+
+    def matches(self, address):
+        ''' Yields (key, value) for every stored network containing address,
+            most general network first. address may be packed bytes, a string
+            or an ip_address. '''
+        if isinstance(address, (bytes, bytearray)):
+            address = bytes(address)
+        address = ip_address(address)
+        node = self._roots[address.version]
+        value = int(address)
+        width = address.max_prefixlen
+
+        for i in range(width + 1):
+            if node[_VALUES]:
+                yield from node[_VALUES].items()
+            if i == width:
+                break
+            node = node[(value >> (width - 1 - i)) & 1]
+            if node is None:
+                break
@@ -0,0 +1,155 @@
+''' Result totals for item listings without running COUNT over the items table.
+
+    The item_counts table holds the number of items for every combination of
+    uploader, category and flags present. It is kept up to date by mapper events
+    whenever an item is added or deleted or changes uploader, category or flags,
+    in the same transaction. A total for a listing without a search term is then
+    a SUM over a few of its rows. Rows with uploader_id ALL_UPLOADERS hold the
+    totals over all uploaders.
+
+    Searches with a term can't use the counters; for those, estimate_rows asks the
+    query planner for its row estimate (MySQL and PostgreSQL only). '''
+import json
+
+import sqlalchemy
+from sqlalchemy import event, inspect
+from sqlalchemy.exc import IntegrityError
+
+from tsuu import models
+from tsuu.extensions import db
+
+ALL_UPLOADERS = 0
+
+_COUNTED_ATTRIBUTES = ('uploader_id', 'main_category_id', 'sub_category_id', 'flags')
+
+
+def _keys(uploader_id, main_category_id, sub_category_id, flags):
+    keys = [(ALL_UPLOADERS, main_category_id, sub_category_id, flags)]
+    if uploader_id:
+        keys.append((uploader_id, main_category_id, sub_category_id, flags))
+    return keys
+
+
+def _key_criterion(table, key):
+    uploader_id, main_category_id, sub_category_id, flags = key
+    return sqlalchemy.and_(table.c.uploader_id == uploader_id,
+                           table.c.main_category_id == main_category_id,
+                           table.c.sub_category_id == sub_category_id,
+                           table.c.flags == flags)
+
+
+def _adjust(connection, keys, delta):
+    table = models.ItemCount.__table__
+    for key in keys:
+        update = table.update().where(_key_criterion(table, key))
+        if connection.execute(update.values(count=table.c.count + delta)).rowcount:
+            continue
+
+        # First item with this combination. Another transaction may be inserting the
+        # same row, so insert in a savepoint and fall back to updating it.
+        values = dict(zip(_COUNTED_ATTRIBUTES, key), count=delta)
+        try:
+            with connection.begin_nested():
+                connection.execute(table.insert().values(**values))
+        except IntegrityError:
+            connection.execute(update.values(count=table.c.count + delta))
+
+
+def _current_key(item):
+    return tuple(getattr(item, name) for name in _COUNTED_ATTRIBUTES)
+
+
+def _previous_key(item):
+    state = inspect(item)
+    key = []
+    for name in _COUNTED_ATTRIBUTES:
+        history = state.attrs[name].history
+        key.append(history.deleted[0] if history.deleted else getattr(item, name))
+    return tuple(key)
+
+
+@event.listens_for(models.Item, 'after_insert', propagate=True)
+def _item_inserted(mapper, connection, item):
+    _adjust(connection, _keys(*_current_key(item)), 1)
+
+
+@event.listens_for(models.Item, 'after_delete', propagate=True)
+def _item_deleted(mapper, connection, item):
+    _adjust(connection, _keys(*_previous_key(item)), -1)
+
+
+@event.listens_for(models.Item, 'after_update', propagate=True)
+def _item_updated(mapper, connection, item):
+    previous, current = _previous_key(item), _current_key(item)
+    if previous != current:
+        _adjust(connection, _keys(*previous), -1)
+        _adjust(connection, _keys(*current), 1)
+
+
+def count_items(flag_conditions=(), main_category_id=None, sub_category_id=None,
+                uploader_id=None):
+    ''' Returns the number of items matching all of the given conditions.
+        flag_conditions is a list of (mask, is_set) pairs: with is_set, at least one of
+        the bits in mask must be set, otherwise none of them. '''
+    table = models.ItemCount.__table__
+    query = sqlalchemy.select([sqlalchemy.func.coalesce(sqlalchemy.func.sum(table.c.count), 0)])
+    query = query.where(table.c.uploader_id == (uploader_id or ALL_UPLOADERS))
+
+    for mask, is_set in flag_conditions:
+        masked = table.c.flags.op('&')(int(mask))
+        query = query.where(masked != 0 if is_set else masked == 0)
+    if main_category_id:
+        query = query.where(table.c.main_category_id == main_category_id)
+    if sub_category_id:
+        query = query.where(table.c.sub_category_id == sub_category_id)
+
+    return int(db.session.execute(query).scalar())
+
+
+def rebuild():
+    ''' Recounts all counters from the items table. Needs an app context. '''
+    table = models.ItemCount.__table__
+    items = models.Item.__table__
+    grouped = [items.c.main_category_id, items.c.sub_category_id, items.c.flags]
+    count = sqlalchemy.func.count(items.c.id)
+
+    db.session.execute(table.delete())
+    db.session.execute(table.insert().from_select(
+        list(_COUNTED_ATTRIBUTES) + ['count'],
+        sqlalchemy.select([sqlalchemy.literal(ALL_UPLOADERS)] + grouped + [count])
+        .group_by(*grouped)))
+    db.session.execute(table.insert().from_select(
+        list(_COUNTED_ATTRIBUTES) + ['count'],
+        sqlalchemy.select([items.c.uploader_id] + grouped + [count])
+        .where(items.c.uploader_id.isnot(None))
+        .group_by(items.c.uploader_id, *grouped)))
+    db.session.commit()
+
+
+def estimate_rows(query):
+    ''' Returns the query planner's estimate of how many rows an ORM query returns,
+        or None if the database doesn't give one '''
+    dialect = db.engine.dialect
+    if dialect.name == 'mysql':
+        explain = 'EXPLAIN '
+    elif dialect.name == 'postgresql':
+        explain = 'EXPLAIN (FORMAT JSON) '
+    else:
+        return None
+
+    compiled = query.statement.compile(dialect=dialect)
+    if compiled.positional:
+        params = tuple(compiled.params[name] for name in compiled.positiontup)
+    else:
+        params = compiled.params
+    rows = db.session.connection().execute(explain + str(compiled), params).fetchall()
+    if not rows:
+        return None
+
+    if dialect.name == 'mysql':
+        # The first table in the plan drives the query
+        return int(rows[0]['rows'] or 0)
+    plan = rows[0][0]
+    if isinstance(plan, str):
+        plan = json.loads(plan)
+    return int(plan[0]['Plan']['Plan Rows'])
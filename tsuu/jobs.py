@@ -0,0 +1,508 @@
+''' Background jobs for copies, moves and deletes inside item directories.
+
+    Copying or deleting a big directory inside the request ties up a worker for as long
+    as the disk takes, and the file manager can't tell how far along it is. The files
+    views store the operation as a FileJob instead and answer right away. Worker threads
+    (or ./item_storage.py run-jobs in a process of its own) claim queued jobs from the
+    database, run them while writing their progress to the job row, and update the
+    item's file list and file index once the whole job is done. The file manager polls
+    the job until it's finished. Changes to an item's files also queue a job that
+    updates its manifest of file hashes, and uploads finished in chunks (see
+    chunked_uploads) are moved into place by a job. '''
+import importlib
+import json
+import os
+import shutil
+import threading
+import time
+from datetime import datetime, timedelta
+
+import werkzeug
+
+from tsuu import backend, blobstore, chunked_uploads, filetree, manifest, models
+from tsuu.extensions import db
+
+try:
+    from gevent import monkey
+except ImportError:
+    monkey = None
+
+ACTIONS = ('copy', 'move', 'remove', 'manifest', 'upload', 'batch')
+
+# Operations of batch jobs
+BATCH_ACTIONS = ('copy', 'move', 'remove', 'rename')
+
+# Progress is written to the job row at most this often, in seconds
+PROGRESS_INTERVAL = 1.0
+
+
+class FileJobError(Exception):
+    pass
+
+
+def _original(module, name):
+    ''' Returns module.name from before gevent's monkey patching. Jobs run on OS threads:
+        in a greenlet, a copy would stall every request of the process until it's done,
+        and the job's heartbeat along with them. '''
+    if monkey is None:
+        return getattr(importlib.import_module(module), name)
+    return monkey.get_original(module, name)
+
+
+def _start_thread(function):
+    _original('_thread', 'start_new_thread')(function, ())
+
+
+def _allocate_lock(locked=False):
+    lock = _original('_thread', 'allocate_lock')()
+    if locked:
+        lock.acquire()
+    return lock
+
+
+def count_files(path):
+    ''' Returns the number of files under path (1 for a file), the unit of job progress '''
+    if not os.path.isdir(path):
+        return 1
+    return sum(len(files) for _, _, files in os.walk(path))
+
+
+def resolve(base_dir, path):
+    ''' Returns the full path of a path relative to the item directory '''
+    full_path = werkzeug.security.safe_join(base_dir, path)
+    if not full_path:
+        raise FileJobError('Invalid path: {}'.format(path))
+    return full_path
+
+
+def enqueue(item, user, action, operations):
+    ''' Queues a job for an item. operations is a list of (source, destination) paths
+        relative to the item directory, the destination is None for removes. For uploads
+        the source is the token of a complete chunked upload, batches are lists of
+        (action, source, destination). Commits and returns the job. '''
+    if action not in ACTIONS:
+        raise ValueError('Unknown file job action {!r}'.format(action))
+
+    job = models.FileJob(item_id=item.id, user_id=user.id if user else None, action=action,
+                         operations=json.dumps([list(operation) for operation in operations]),
+                         status=models.FileJobStatus.QUEUED)
+    db.session.add(job)
+    db.session.commit()
+
+    job_runner.notify()
+    return job
+
+
+def schedule_manifest(item_id):
+    ''' Queues an update of an item's manifest, unless one is queued already.
+        Doesn't commit. '''
+    FileJob = models.FileJob
+    queued = db.session.query(FileJob.id).filter(
+        FileJob.item_id == item_id,
+        FileJob.action == 'manifest',
+        FileJob.status == models.FileJobStatus.QUEUED).first()
+    if queued is None:
+        db.session.add(models.FileJob(item_id=item_id, action='manifest', operations='[]',
+                                      status=models.FileJobStatus.QUEUED))
+
+
+def claim_next(stale_timeout):
+    ''' Claims the oldest queued job (or a running one that hasn't been touched in
+        stale_timeout seconds, its worker is assumed dead, see _Heartbeat). Concurrent
+        workers never claim the same job. Returns the job or None. '''
+    FileJob = models.FileJob
+    table = FileJob.__table__
+    now = datetime.utcnow()
+
+    candidates = db.session.query(FileJob.id, FileJob.updated_time).filter(
+        (FileJob.status == models.FileJobStatus.QUEUED) |
+        ((FileJob.status == models.FileJobStatus.RUNNING) &
+         (FileJob.updated_time < now - timedelta(seconds=stale_timeout)))
+    ).order_by(FileJob.id.asc()).limit(10).all()
+
+    for job_id, updated_time in candidates:
+        # Whoever changes the row first wins, everyone else updates nothing
+        result = db.session.execute(
+            table.update()
+            .where(table.c.id == job_id)
+            .where(table.c.updated_time == updated_time)
+            .where(table.c.status.in_([models.FileJobStatus.QUEUED, models.FileJobStatus.RUNNING]))
+            .values(status=models.FileJobStatus.RUNNING, done_count=0, updated_time=now))
+        db.session.commit()
+        if result.rowcount == 1:
+            return FileJob.by_id(job_id)
+    return None
+
+
+class _Heartbeat(object):
+    ''' Touches the updated_time of a running job every interval seconds, from an OS
+        thread of its own, for as long as its worker runs it. A single file that takes
+        longer than the stale timeout to copy or hash doesn't get its job claimed again. '''
+
+    def __init__(self, engine, job_id, interval, logger):
+        self.engine = engine
+        self.job_id = job_id
+        self.interval = interval
+        self.logger = logger
+        # Plain OS locks, which work across threads with or without gevent
+        self._stopped = _allocate_lock(locked=True)
+        self._finished = _allocate_lock()
+
+    def __enter__(self):
+        self._finished.acquire()
+        _start_thread(self._run)
+        return self
+
+    def __exit__(self, *exc_info):
+        self._stopped.release()
+        # Waits for a write in progress
+        with self._finished:
+            pass
+
+    def _run(self):
+        table = models.FileJob.__table__
+        try:
+            while not self._stopped.acquire(timeout=self.interval):
+                try:
+                    with self.engine.begin() as connection:
+                        connection.execute(
+                            table.update()
+                            .where(table.c.id == self.job_id)
+                            .where(table.c.status == models.FileJobStatus.RUNNING)
+                            .values(updated_time=datetime.utcnow()))
+                except Exception:
+                    self.logger.exception('Touching file job #%d failed', self.job_id)
+        finally:
+            self._finished.release()
+
+
+class _Progress(object):
+    ''' Counts finished files and writes them to the job row every PROGRESS_INTERVAL '''
+
+    def __init__(self, job_id):
+        self.job_id = job_id
+        self.done = 0
+        self._written = time.monotonic()
+
+    def add(self, count=1):
+        self.done += count
+        if time.monotonic() - self._written >= PROGRESS_INTERVAL:
+            self.write()
+        # Lets other greenlets run when the worker is monkey patched
+        time.sleep(0)
+
+    def write(self, **values):
+        table = models.FileJob.__table__
+        db.session.execute(
+            table.update().where(table.c.id == self.job_id)
+            .values(done_count=self.done, updated_time=datetime.utcnow(), **values))
+        db.session.commit()
+        self._written = time.monotonic()
+
+
+def _run_operation(action, base_dir, source, destination, copy_file):
+    ''' Runs one operation of a job, returns its change for backend.handle_item_change '''
+    src = resolve(base_dir, source)
+    if action == 'remove':
+        if os.path.isdir(src):
+            shutil.rmtree(src)
+        else:
+            os.remove(src)
+        return ('remove', source)
+
+    dest = resolve(base_dir, destination)
+    if action == 'rename':
+        if os.path.lexists(dest):
+            raise FileJobError('{} exists already'.format(destination))
+        os.rename(src, dest)
+    elif action == 'copy':
+        if os.path.isdir(src):
+            shutil.copytree(src, dest, dirs_exist_ok=True, copy_function=copy_file)
+        else:
+            copy_file(src, dest)
+    else:
+        # A rename on the same filesystem never calls copy_function
+        shutil.move(src, dest, copy_function=blobstore.copy_file)
+    return (action, source, destination)
+
+
+def _run_operations(action, base_dir, operations, progress):
+    ''' Runs the operations of a job, returns their changes for backend.handle_item_change '''
+    changes = []
+
+    def copy_file(src, dest):
+        blobstore.copy_file(src, dest)
+        progress.add()
+        return dest
+
+    for source, destination in operations:
+        # Copies count their files as they go
+        count = 0 if action == 'copy' else count_files(resolve(base_dir, source))
+        changes.append(_run_operation(action, base_dir, source, destination, copy_file))
+        progress.add(count)
+    return changes
+
+
+def _sync_changes(base_dir, paths):
+    ''' Returns changes that read paths from disk again, for operations that failed
+        and may have happened in part '''
+    changes = []
+    for path in paths:
+        full_path = resolve(base_dir, path)
+        value = filetree.scan_tree(full_path)[0] if os.path.lexists(full_path) else None
+        changes.append(('sync', path, value))
+    return changes
+
+
+def _run_batch(base_dir, operations, progress):
+    ''' Runs a batch of (action, source, destination) copies, moves, removes and renames.
+        A failed operation doesn't stop the ones after it. Returns the changes of the
+        operations that worked, followed by those that read the paths of failed ones
+        from disk again, and the outcome of every operation. '''
+    changes = []
+    results = []
+    failed_paths = []
+    for action, source, destination in operations:
+        try:
+            changes.append(_run_operation(action, base_dir, source, destination,
+                                          blobstore.copy_file))
+        except (OSError, shutil.Error, FileJobError) as e:
+            results.append({'status': 'failed', 'success': False, 'error': str(e)})
+            for path in (source, destination):
+                if path is not None and path not in failed_paths:
+                    failed_paths.append(path)
+        else:
+            results.append({'status': 'done', 'success': True})
+        progress.add()
+    return changes + _sync_changes(base_dir, failed_paths), results
+
+
+def _run_batch_job(item, operations, progress):
+    ''' Runs a batch job, updates the file list once for all of it and stores the outcome
+        of every operation in the job's results. A batch in which only some operations
+        failed finishes as PARTIAL. '''
+    base_dir = backend.item_path(item.item_directory)
+    progress.write(total_count=len(operations))
+    try:
+        changes, results = _run_batch(base_dir, operations, progress)
+    except (OSError, FileJobError) as e:
+        # The paths of a failed operation couldn't be read again
+        db.session.rollback()
+        backend.handle_item_change(item.id)
+        progress.write(status=models.FileJobStatus.FAILED, error=str(e)[:255])
+        return False
+    backend.handle_item_change(item.id, changes)
+
+    failed = sum(1 for result in results if not result['success'])
+    if not failed:
+        progress.write(status=models.FileJobStatus.DONE, results=json.dumps(results))
+        return True
+
+    # Finished with errors, unless nothing worked at all
+    if failed < len(results):
+        status = models.FileJobStatus.PARTIAL
+    else:
+        status = models.FileJobStatus.FAILED
+    progress.write(status=status, results=json.dumps(results),
+                   error='{} of {} operations failed'.format(failed, len(results)))
+    return False
+
+
+def update_manifest(item, on_hashed=None, on_wait=None):
+    ''' Hashes the files of an item that changed since its last manifest, in the
+        process pool, and stores the new manifest. Calls on_hashed(number of files to
+        hash) first and on_hashed() after every file, and on_wait() every
+        PROGRESS_INTERVAL while a big file is being hashed. Needs an app context. '''
+    if item.filelist is None:
+        item.filelist = models.Filelist()
+    previous = manifest.decode(item.filelist.manifest_blob)
+    algorithm = manifest.algorithm()
+    base_dir = backend.item_path(item.item_directory)
+
+    entries, stale = manifest.plan(base_dir, previous, algorithm)
+    if on_hashed:
+        on_hashed(len(stale))
+    hashed = manifest.hash_files(base_dir, stale, algorithm, manifest.executor(), on_wait,
+                                 PROGRESS_INTERVAL)
+    for path, entry in hashed:
+        entries[path] = entry
+        if on_hashed:
+            on_hashed()
+
+    item.filelist.manifest_blob = manifest.encode(manifest.make(algorithm, entries))
+    db.session.commit()
+    return len(stale)
+
+
+def _run_manifest_job(item, progress):
+    def on_hashed(total=None):
+        if total is None:
+            progress.add()
+        else:
+            progress.write(total_count=total)
+
+    try:
+        # Keeps the job from looking stale while one big file is hashed
+        update_manifest(item, on_hashed, on_wait=progress.write)
+    except OSError as e:
+        db.session.rollback()
+        progress.write(status=models.FileJobStatus.FAILED, error=str(e)[:255])
+        return False
+    progress.write(status=models.FileJobStatus.DONE)
+    return True
+
+
+def _seed_manifest(item, base_dir, digests):
+    ''' Adds the SHA-256 of uploaded files to the item's manifest, so the manifest job
+        doesn't read them again '''
+    if item.filelist is None or manifest.algorithm() != 'sha256':
+        return
+    previous = manifest.decode(item.filelist.manifest_blob)
+    entries = previous['files'] if previous and previous['algorithm'] == 'sha256' else {}
+    for path, digest in digests.items():
+        stat_result = os.stat(resolve(base_dir, path))
+        entries[path.replace(os.sep, '/')] = [stat_result.st_size, stat_result.st_mtime_ns,
+                                              digest]
+    item.filelist.manifest_blob = manifest.encode(manifest.make('sha256', entries))
+
+
+def _run_upload_job(item, operations, progress):
+    base_dir = backend.item_path(item.item_directory)
+    changes = []
+    digests = {}
+
+    try:
+        progress.write(total_count=len(operations))
+        for token, destination in operations:
+            upload = models.UploadSession.by_token(token)
+            if upload is None:
+                raise FileJobError('Upload {} is gone'.format(token))
+            dest = resolve(base_dir, destination)
+            temp_path, digest, size = chunked_uploads.claim(upload)
+            os.makedirs(os.path.dirname(dest), exist_ok=True)
+            blobstore.place(temp_path, digest, size, dest)
+            changes.append(('add', destination, size))
+            digests[destination] = digest
+            progress.add()
+    except (OSError, FileJobError, chunked_uploads.UploadError) as e:
+        db.session.rollback()
+        backend.handle_item_change(item.id)
+        progress.write(status=models.FileJobStatus.FAILED, error=str(e)[:255])
+        return False
+
+    _seed_manifest(item, base_dir, digests)
+    backend.handle_item_change(item.id, changes)
+    progress.write(status=models.FileJobStatus.DONE)
+    return True
+
+
+def run_job(job):
+    ''' Runs a claimed job and updates the item's file list afterwards.
+        Needs an app context. '''
+    item = models.Item.by_id(job.item_id)
+    progress = _Progress(job.id)
+    if job.action == 'manifest':
+        return _run_manifest_job(item, progress)
+
+    operations = json.loads(job.operations)
+    if job.action == 'upload':
+        return _run_upload_job(item, operations, progress)
+    elif job.action == 'batch':
+        return _run_batch_job(item, operations, progress)
+
+    base_dir = backend.item_path(item.item_directory)
+
+    try:
+        total = sum(count_files(resolve(base_dir, source)) for source, _ in operations)
+        progress.write(total_count=total)
+        changes = _run_operations(job.action, base_dir, operations, progress)
+    except (OSError, shutil.Error, FileJobError) as e:
+        db.session.rollback()
+        # Part of the job may have happened, so read the whole item directory again
+        backend.handle_item_change(item.id)
+        progress.write(status=models.FileJobStatus.FAILED, error=str(e)[:255])
+        return False
+
+    backend.handle_item_change(item.id, changes)
+    progress.write(status=models.FileJobStatus.DONE)
+    return True
+
+
+class JobRunner(object):
+    ''' Runs file jobs in FILE_JOB_WORKERS threads per process. Like the buffered writers
+        in counters, the threads are started lazily (and again after a fork). They are
+        OS threads even in a gevent worker, see _original. '''
+
+    def __init__(self, app=None):
+        self._lock = threading.Lock()
+        # Released to wake up a worker thread
+        self._wakeup = _allocate_lock(locked=True)
+        self._pid = None
+        self.app = None
+        self.workers = 1
+        self.poll_interval = 5
+        self.stale_timeout = 600
+        self.heartbeat_interval = 30
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.app = app
+        self.workers = app.config.get('FILE_JOB_WORKERS', self.workers)
+        self.poll_interval = app.config.get('FILE_JOB_POLL_INTERVAL', self.poll_interval)
+        self.stale_timeout = app.config.get('FILE_JOB_STALE_TIMEOUT', self.stale_timeout)
+        self.heartbeat_interval = app.config.get('FILE_JOB_HEARTBEAT_INTERVAL',
+                                                 self.heartbeat_interval)
+
+    def notify(self):
+        ''' Wakes up a worker thread of this process, starting them if needed '''
+        if not self.workers:
+            return
+        self._ensure_workers()
+        try:
+            self._wakeup.release()
+        except RuntimeError:
+            pass  # Woken up already
+
+    def _ensure_workers(self):
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            for i in range(self.workers):
+                _start_thread(self._run)
+
+    def _run(self):
+        while True:
+            self._wakeup.acquire(timeout=self.poll_interval)
+            try:
+                with self.app.app_context():
+                    while self.run_next():
+                        pass
+            except Exception:
+                self.app.logger.exception('File job worker failed')
+
+    def run_next(self):
+        ''' Claims and runs the oldest queued job. Returns False if there was none.
+            Needs an app context. '''
+        job = claim_next(self.stale_timeout)
+        if job is None:
+            return False
+        self.app.logger.info('Running file job #%d (%s on item #%d)',
+                             job.id, job.action, job.item_id)
+        with _Heartbeat(db.engine, job.id, self.heartbeat_interval, self.app.logger):
+            run_job(job)
+        return True
+
+    def run_forever(self):
+        ''' Runs jobs until interrupted, for a dedicated job process '''
+        while True:
+            with self.app.app_context():
+                while self.run_next():
+                    pass
+            time.sleep(self.poll_interval)
+
+
+job_runner = JobRunner()
@@ -0,0 +1,76 @@
+''' The listings table: a copy of what item listings show of every item.
+
+    Searches read only this table instead of joining the items with their statistics
+    and eager loading their categories, so a listing in any order is a range scan over
+    one of its (column, id) indexes. Rows are written by mapper events on Item and
+    Statistic, in the same transaction as the change they copy. Writes that bypass the
+    ORM have to update the listing themselves (see counters and
+    Item.update_comment_count_db). Fill the table on an existing database with
+    ./item_storage.py rebuild-listings. '''
+import sqlalchemy
+from sqlalchemy import event, inspect
+
+from tsuu import models
+from tsuu.extensions import db
+
+ITEM_COLUMNS = ('display_name', 'item_directory', 'filesize', 'flags', 'uploader_id',
+                'main_category_id', 'sub_category_id', 'comment_count', 'created_time',
+                'updated_time')
+STATISTIC_COLUMNS = ('seed_count', 'leech_count', 'download_count')
+
+
+def _item_values(item):
+    return {name: getattr(item, name) for name in ITEM_COLUMNS}
+
+
+def _statistic_values(statistic):
+    return {name: getattr(statistic, name) or 0 for name in STATISTIC_COLUMNS}
+
+
+@event.listens_for(models.Item, 'after_insert', propagate=True)
+def _item_inserted(mapper, connection, item):
+    # The statistics row is inserted after the item and fills in the counts
+    values = dict(_item_values(item), **dict.fromkeys(STATISTIC_COLUMNS, 0))
+    connection.execute(models.Listing.__table__.insert().values(id=item.id, **values))
+
+
+@event.listens_for(models.Item, 'after_update', propagate=True)
+def _item_updated(mapper, connection, item):
+    state = inspect(item)
+    if not any(state.attrs[name].history.has_changes() for name in ITEM_COLUMNS):
+        return
+    table = models.Listing.__table__
+    connection.execute(table.update().where(table.c.id == item.id)
+                       .values(**_item_values(item)))
+
+
+@event.listens_for(models.Item, 'after_delete', propagate=True)
+def _item_deleted(mapper, connection, item):
+    # The foreign key cascades too, but SQLite doesn't enforce it by default
+    table = models.Listing.__table__
+    connection.execute(table.delete().where(table.c.id == item.id))
+
+
+@event.listens_for(models.Statistic, 'after_insert', propagate=True)
+@event.listens_for(models.Statistic, 'after_update', propagate=True)
+def _statistic_written(mapper, connection, statistic):
+    table = models.Listing.__table__
+    connection.execute(table.update().where(table.c.id == statistic.item_id)
+                       .values(**_statistic_values(statistic)))
+
+
+def rebuild():
+    ''' Copies every item into the listings table again. Needs an app context. '''
+    table = models.Listing.__table__
+    items = models.Item.__table__
+    statistics = models.Statistic.__table__
+
+    columns = [items.c.id] + [items.c[name] for name in ITEM_COLUMNS]
+    columns += [sqlalchemy.func.coalesce(statistics.c[name], 0) for name in STATISTIC_COLUMNS]
+    source = items.outerjoin(statistics, statistics.c.item_id == items.c.id)
+
+    db.session.execute(table.delete())
+    db.session.execute(table.insert().from_select(
+        ['id'] + list(ITEM_COLUMNS) + list(STATISTIC_COLUMNS),
+        sqlalchemy.select(columns).select_from(source)))
+    db.session.commit()
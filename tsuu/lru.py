@@ -0,0 +1,49 @@
+''' A small thread-safe LRU cache with per-entry expiry. '''
+import threading
+import time
+from collections import OrderedDict
+
+
+class LRUCache(object):
+    ''' Keeps up to max_entries values for `expiry` seconds each, evicting the least
+        recently used entry when full. get and put are O(1). '''
+
+    def __init__(self, max_entries=128, expiry=60):
+        self.max_entries = max_entries
+        self.expiry = expiry
+
+        # Ordered from least to most recently used, values are (value, expires_at)
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return default
+
+            if entry[1] < time.monotonic():
+                del self._entries[key]
+                return default
+
+            self._entries.move_to_end(key)
+            return entry[0]
+
+    def put(self, key, value, expiry=None):
+        with self._lock:
+            self._entries[key] = (value, time.monotonic() + (expiry or self.expiry))
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def pop(self, key, default=None):
+        with self._lock:
+            entry = self._entries.pop(key, None)
+        return default if entry is None else entry[0]
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
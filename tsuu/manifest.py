@@ -0,0 +1,140 @@
+''' Per-file content hashes of items (ItemFilelist.manifest_blob).
+
+    A manifest maps every file's path inside the item directory to its size, mtime
+    and hash (MANIFEST_HASH_ALGORITHM, sha256 by default). It is computed by a file
+    job after the item's files change, with the hashing done in a process pool, so
+    hashing never blocks a request. Only files whose size or mtime changed since the
+    last manifest are hashed again.
+
+    An entry is only valid while the file's size and mtime still match it; lookup
+    checks that, so a manifest that lags behind the disk never hands out a wrong hash. '''
+import hashlib
+import json
+import os
+import threading
+import zlib
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+
+import flask
+
+app = flask.current_app
+
+ALGORITHMS = ('sha256', 'blake2b')
+
+HASH_CHUNK_SIZE = 1024 * 1024
+
+_executor = None
+_executor_pid = None
+_executor_lock = threading.Lock()
+
+
+def algorithm():
+    return app.config.get('MANIFEST_HASH_ALGORITHM', 'sha256')
+
+
+def hash_file(path, algorithm_name='sha256', chunk_size=HASH_CHUNK_SIZE):
+    ''' Returns the hex digest of a file. Runs in the process pool, so it doesn't use
+        the app. '''
+    h = hashlib.new(algorithm_name)
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def stat_files(root):
+    ''' Returns {path: (size, mtime_ns)} of every file below root, with
+        slash-separated paths relative to it '''
+    files = {}
+    for directory, _, names in os.walk(root):
+        relative_directory = os.path.relpath(directory, root)
+        for name in names:
+            stat_result = os.stat(os.path.join(directory, name))
+            path = name if relative_directory == '.' else os.path.join(relative_directory, name)
+            files[path.replace(os.sep, '/')] = (stat_result.st_size, stat_result.st_mtime_ns)
+    return files
+
+
+def plan(root, previous, algorithm_name):
+    ''' Compares the files below root with the previous manifest. Returns (the entries
+        that are still valid, {path: (size, mtime_ns)} of the files to hash). '''
+    old_entries = {}
+    if previous and previous.get('algorithm') == algorithm_name:
+        old_entries = previous['files']
+
+    entries = {}
+    stale = {}
+    for path, (size, mtime_ns) in stat_files(root).items():
+        entry = old_entries.get(path)
+        if entry and entry[0] == size and entry[1] == mtime_ns:
+            entries[path] = entry
+        else:
+            stale[path] = (size, mtime_ns)
+    return entries, stale
+
+
+def hash_files(root, stale, algorithm_name, executor=None, on_wait=None, wait_interval=1.0):
+    ''' Hashes the files planned by plan, in parallel in executor (a process pool) if
+        given. Yields (path, entry) as the hashes come in. While no file finished hashing
+        for wait_interval seconds, as with one big file, calls on_wait(). '''
+    paths = sorted(stale)
+    if executor is None:
+        for path in paths:
+            size, mtime_ns = stale[path]
+            digest = hash_file(os.path.join(root, *path.split('/')), algorithm_name)
+            yield path, [size, mtime_ns, digest]
+        return
+
+    futures = {executor.submit(hash_file, os.path.join(root, *path.split('/')),
+                               algorithm_name): path
+               for path in paths}
+    pending = set(futures)
+    while pending:
+        done, pending = wait(pending, timeout=wait_interval, return_when=FIRST_COMPLETED)
+        if not done and on_wait:
+            on_wait()
+        for future in done:
+            path = futures[future]
+            size, mtime_ns = stale[path]
+            yield path, [size, mtime_ns, future.result()]
+
+
+def executor():
+    ''' Returns the process pool of this process for hashing, or None if
+        MANIFEST_HASH_WORKERS is 0 '''
+    global _executor, _executor_pid
+    workers = app.config.get('MANIFEST_HASH_WORKERS', 2)
+    if not workers:
+        return None
+    # Pools don't survive forking workers either
+    if _executor_pid != os.getpid():
+        with _executor_lock:
+            if _executor_pid != os.getpid():
+                _executor = ProcessPoolExecutor(max_workers=workers)
+                _executor_pid = os.getpid()
+    return _executor
+
+
+def make(algorithm_name, entries):
+    return {'algorithm': algorithm_name, 'files': entries}
+
+
+def encode(item_manifest):
+    return zlib.compress(json.dumps(item_manifest, separators=(',', ':')).encode('utf-8'))
+
+
+def decode(blob):
+    if not blob:
+        return None
+    return json.loads(zlib.decompress(blob).decode('utf-8'))
+
+
+def lookup(item_manifest, path, size, mtime_ns):
+    ''' Returns the hash of the file at path if the manifest has it for this size and
+        mtime, None otherwise '''
+    if not item_manifest:
+        return None
+    entry = item_manifest['files'].get(path)
+    if entry and entry[0] == size and entry[1] == mtime_ns:
+        return entry[2]
+    return None
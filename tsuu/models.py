@@ -4,7 +4,7 @@ import re
 from datetime import datetime
 from enum import Enum, IntEnum
 from hashlib import md5, sha256
-from ipaddress import ip_address
+from ipaddress import ip_address, ip_network
 from urllib.parse import unquote as unquote_url
 from urllib.parse import urlencode
 
@@ -109,7 +109,7 @@ class ItemBase(DeclarativeHelperBase):
     id = db.Column(db.Integer, primary_key=True)
     display_name = db.Column(db.String(length=255, collation=COL_UTF8_GENERAL_CI),
                              nullable=False, index=True)
-    item_directory = db.Column(db.String(length=255), nullable=False)
+    item_directory = db.Column(db.String(length=255), nullable=False, unique=True)
     information = db.Column(db.String(length=255), nullable=False)
     description = db.Column(TextType(collation=COL_UTF8MB4_BIN), nullable=False)
 
@@ -195,8 +195,11 @@ class ItemBase(DeclarativeHelperBase):
 
     @classmethod
     def update_comment_count_db(cls, item_id):
-        cls.query.filter_by(id=item_id).update({'comment_count': db.session.query(
-            func.count(Comment.id)).filter_by(item_id=item_id).as_scalar()}, False)
+        comment_count = db.session.query(
+            func.count(Comment.id)).filter_by(item_id=item_id).as_scalar()
+        cls.query.filter_by(id=item_id).update({'comment_count': comment_count}, False)
+        # A bulk update skips the mapper events that keep the listing in sync
+        Listing.query.filter_by(id=item_id).update({'comment_count': comment_count}, False)
 
     @property
     def created_utc_timestamp(self):
@@ -266,6 +269,8 @@ class ItemFilelistBase(DeclarativeHelperBase):
         return db.Column(db.Integer, fk, primary_key=True)
 
     filelist_blob = db.Column(MediumBlobType, nullable=True)
+    # Hashes of the files, see manifest
+    manifest_blob = db.Column(MediumBlobType, nullable=True)
 
     @declarative.declared_attr
     def items(cls):
@@ -291,6 +296,93 @@ class StatisticBase(DeclarativeHelperBase):
         return db.relationship(cls._flavor_prefix('Item'), uselist=False,
                                back_populates='stats')
 
+class FileTermBase(DeclarativeHelperBase):
+    ''' Inverted index of the file and directory names in items, see file_index '''
+    __tablename_base__ = 'file_terms'
+
+    id = db.Column(db.Integer, primary_key=True)
+
+    @declarative.declared_attr
+    def item_id(cls):
+        fk = db.ForeignKey(cls._table_prefix('items.id'), ondelete="CASCADE")
+        return db.Column(db.Integer, fk, nullable=False, index=True)
+
+    term = db.Column(db.String(length=64, collation=COL_UTF8MB4_BIN), nullable=False)
+    # Paths in deep items easily get longer than any VARCHAR index limit
+    path = db.Column(TextType(collation=COL_UTF8MB4_BIN), nullable=False)
+
+    @declarative.declared_attr
+    def __table_args__(cls):
+        return (Index(cls._table_prefix('file_terms_term_item_idx'), 'term', 'item_id'),)
+
+
+class ItemCountBase(DeclarativeHelperBase):
+    ''' Number of items per uploader, category and flags, kept up to date by item_counts.
+        Rows with uploader_id 0 count the items of all uploaders. '''
+    __tablename_base__ = 'item_counts'
+
+    uploader_id = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    main_category_id = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    sub_category_id = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    flags = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    count = db.Column(db.Integer, default=0, nullable=False)
+
+
+class ListingBase(DeclarativeHelperBase):
+    ''' What item listings show of every item, copied from the items and statistics
+        tables and kept in sync by listings. Searches only read this table. '''
+    __tablename_base__ = 'listings'
+
+    @declarative.declared_attr
+    def id(cls):
+        fk = db.ForeignKey(cls._table_prefix('items.id'), ondelete="CASCADE")
+        return db.Column(db.Integer, fk, primary_key=True, autoincrement=False)
+
+    display_name = db.Column(db.String(length=255, collation=COL_UTF8_GENERAL_CI),
+                             nullable=False)
+    item_directory = db.Column(db.String(length=255), nullable=False)
+    filesize = db.Column(db.BIGINT, default=0, nullable=False)
+    flags = db.Column(db.Integer, default=0, nullable=False)
+    uploader_id = db.Column(db.Integer, nullable=True)
+    main_category_id = db.Column(db.Integer, nullable=False)
+    sub_category_id = db.Column(db.Integer, nullable=False)
+    comment_count = db.Column(db.Integer, default=0, nullable=False)
+    created_time = db.Column(db.DateTime(timezone=False), nullable=False)
+    updated_time = db.Column(db.DateTime(timezone=False), nullable=False)
+
+    seed_count = db.Column(db.Integer, default=0, nullable=False)
+    leech_count = db.Column(db.Integer, default=0, nullable=False)
+    download_count = db.Column(db.Integer, default=0, nullable=False)
+
+    @declarative.declared_attr
+    def __table_args__(cls):
+        # Listings are ordered by (column, id), so every ordering is one index range scan
+        sort_indexes = tuple(
+            Index(cls._table_prefix('listings_{}_idx'.format(column)), column, 'id')
+            for column in ('filesize', 'comment_count', 'seed_count', 'leech_count',
+                           'download_count'))
+        return sort_indexes + (
+            Index(cls._table_prefix('listings_uploader_idx'), 'uploader_id', 'id'),
+            Index(cls._table_prefix('listings_category_idx'),
+                  'main_category_id', 'sub_category_id', 'id'),
+        )
+
+    @property
+    def category_id_string(self):
+        return '{0}_{1}'.format(self.main_category_id, self.sub_category_id)
+
+    @property
+    def created_utc_timestamp(self):
+        ''' Returns a UTC POSIX timestamp, as seconds '''
+        return (self.created_time - UTC_EPOCH).total_seconds()
+
+    anonymous = FlagProperty(ItemFlags.ANONYMOUS)
+    hidden = FlagProperty(ItemFlags.HIDDEN)
+    deleted = FlagProperty(ItemFlags.DELETED)
+    trusted = FlagProperty(ItemFlags.TRUSTED)
+    remake = FlagProperty(ItemFlags.REMAKE)
+
+
 class MainCategoryBase(DeclarativeHelperBase):
     __tablename_base__ = 'main_categories'
 
@@ -756,14 +848,117 @@ class TrackerApiBase(DeclarativeHelperBase):
         self.method = method
 
 
+class FileJobStatus(IntEnum):
+    QUEUED = 0
+    RUNNING = 1
+    DONE = 2
+    FAILED = 3
+    # Finished, but some of the operations of a batch failed
+    PARTIAL = 4
+
+
+class FileJobBase(DeclarativeHelperBase):
+    ''' A copy, move or delete in an item directory (or a batch of them), or an update
+        of its manifest, run in the background by jobs '''
+    __tablename_base__ = 'file_jobs'
+
+    id = db.Column(db.Integer, primary_key=True)
+    action = db.Column(db.String(length=16), nullable=False)
+    # JSON list of [source, destination] paths, relative to the item directory
+    operations = db.Column(TextType(collation=COL_UTF8MB4_BIN), nullable=False)
+    status = db.Column(ChoiceType(FileJobStatus, impl=db.Integer()), nullable=False,
+                       default=FileJobStatus.QUEUED, index=True)
+    # Progress, in files
+    done_count = db.Column(db.Integer, default=0, nullable=False)
+    total_count = db.Column(db.Integer, default=0, nullable=False)
+    error = db.Column(db.String(length=255))
+    # Batch jobs: JSON list with the status (done or failed) of every operation
+    results = db.Column(TextType(collation=COL_UTF8MB4_BIN))
+    created_time = db.Column(db.DateTime(timezone=False), default=datetime.utcnow)
+    updated_time = db.Column(db.DateTime(timezone=False), default=datetime.utcnow,
+                             onupdate=datetime.utcnow, nullable=False)
+
+    @declarative.declared_attr
+    def item_id(cls):
+        return db.Column(db.Integer, db.ForeignKey(
+            cls._table_prefix('items.id'), ondelete='CASCADE'), nullable=False, index=True)
+
+    @declarative.declared_attr
+    def user_id(cls):
+        return db.Column(db.Integer, db.ForeignKey('users.id'))
+
+    def __repr__(self):
+        return '<FileJob %r>' % self.id
+
+    @property
+    def is_finished(self):
+        return self.status in (FileJobStatus.DONE, FileJobStatus.FAILED, FileJobStatus.PARTIAL)
+
+    @classmethod
+    def by_id(cls, id):
+        return cls.query.get(id)
+
+
+class UploadSessionBase(DeclarativeHelperBase):
+    ''' A resumable upload, sent in chunks, see chunked_uploads. The data received so
+        far is in a temporary file; its size is the offset of the next chunk. '''
+    __tablename_base__ = 'upload_sessions'
+
+    token = db.Column(db.String(length=32, collation=COL_ASCII_GENERAL_CI), primary_key=True)
+    filename = db.Column(db.String(length=255, collation=COL_UTF8MB4_BIN), nullable=False)
+    size = db.Column(db.BIGINT, nullable=False)
+    # Uploads into the file manager: the destination, relative to the item directory
+    path = db.Column(TextType(collation=COL_UTF8MB4_BIN))
+    created_time = db.Column(db.DateTime(timezone=False), default=datetime.utcnow,
+                             nullable=False)
+
+    @declarative.declared_attr
+    def item_id(cls):
+        return db.Column(db.Integer, db.ForeignKey(
+            cls._table_prefix('items.id'), ondelete='CASCADE'), index=True)
+
+    @declarative.declared_attr
+    def user_id(cls):
+        return db.Column(db.Integer, db.ForeignKey('users.id'))
+
+    def __repr__(self):
+        return '<UploadSession %r>' % self.token
+
+    @classmethod
+    def by_token(cls, token):
+        return cls.query.get(token)
+
+
+class Blob(db.Model):
+    ''' A file in the content-addressed blob store, see blobstore '''
+    __tablename__ = 'blobs'
+
+    # Hex SHA-256 of the content
+    digest = db.Column(db.String(length=64, collation=COL_ASCII_GENERAL_CI), primary_key=True)
+    size = db.Column(db.BIGINT, nullable=False)
+    # Links made to the blob from item directories, recounted by blobstore.prune
+    ref_count = db.Column(db.Integer, default=0, nullable=False)
+    created_time = db.Column(db.DateTime(timezone=False), default=datetime.utcnow,
+                             nullable=False)
+
+    def __repr__(self):
+        return '<Blob %r>' % self.digest
+
+    @classmethod
+    def by_digest(cls, digest):
+        return cls.query.get(digest)
+
+
 class RangeBan(db.Model):
     __tablename__ = 'rangebans'
 
     id = db.Column(db.Integer, primary_key=True)
-    _cidr_string = db.Column('cidr_string', db.String(length=18), nullable=False)
-    masked_cidr = db.Column(db.BigInteger, nullable=False,
+    # Long enough for IPv6 ranges (ffff:...:ffff/128)
+    _cidr_string = db.Column('cidr_string', db.String(length=43), nullable=False)
+    # Only set for IPv4 ranges. Lookups go through auth_cache.range_ban_cache.
+    masked_cidr = db.Column(db.BigInteger, nullable=True,
                             index=True)
-    mask = db.Column(db.BigInteger, nullable=False, index=True)
+    mask = db.Column(db.BigInteger, nullable=True, index=True)
     enabled = db.Column(db.Boolean, nullable=False, default=True)
     # If this rangeban may be automatically cleared once it becomes
     # out of date, set this column to the creation time of the ban.
@@ -776,22 +971,29 @@ class RangeBan(db.Model):
 
     @cidr_string.setter
     def cidr_string(self, s):
-        subnet, masked_bits = s.split('/')
-        subnet_b = ip_address(subnet).packed
-        self.mask = (1 << 32) - (1 << (32 - int(masked_bits)))
-        self.masked_cidr = int.from_bytes(subnet_b, 'big') & self.mask
+        network = ip_network(s, strict=False)
+        if network.version == 4:
+            self.mask = int(network.netmask)
+            self.masked_cidr = int(network.network_address)
+        else:
+            self.mask = self.masked_cidr = None
         self._cidr_string = s
 
+    @property
+    def network(self):
+        return ip_network(self._cidr_string, strict=False)
+
+    def expires(self, temp_duration):
+        ''' When a temporary ban stops applying, or None for permanent bans '''
+        if self.temp is None:
+            return None
+        return self.temp + temp_duration
+
     @classmethod
     def is_rangebanned(cls, ip):
-        if len(ip) > 4:
-            raise NotImplementedError("IPv6 is unsupported.")
-        elif len(ip) < 4:
-            raise ValueError("Not an IP address.")
-        ip_int = int.from_bytes(ip, 'big')
-        q = cls.query.filter(cls.mask.op('&')(ip_int) == cls.masked_cidr,
-                             cls.enabled)
-        return q.count() > 0
+        ''' Returns True if the packed IPv4 or IPv6 address is in an active range ban '''
+        from tsuu.auth_cache import range_ban_cache
+        return range_ban_cache.is_rangebanned(ip)
 
 
 class TrustedApplicationStatus(IntEnum):
@@ -893,6 +1095,20 @@ class NyaaStatistic(StatisticBase, db.Model):
     __flavor__ = 'Nyaa'
 
 
+# FileTerm
+class NyaaFileTerm(FileTermBase, db.Model):
+    __flavor__ = 'Nyaa'
+
+
+# ItemCount
+class NyaaItemCount(ItemCountBase, db.Model):
+    __flavor__ = 'Nyaa'
+
+
+class NyaaListing(ListingBase, db.Model):
+    __flavor__ = 'Nyaa'
+
+
 # MainCategory
 class NyaaMainCategory(MainCategoryBase, db.Model):
     __flavor__ = 'Nyaa'
@@ -922,10 +1138,23 @@ class NyaaTrackerApi(TrackerApiBase, db.Model):
     __flavor__ = 'Nyaa'
 
 
+# FileJob
+class NyaaFileJob(FileJobBase, db.Model):
+    __flavor__ = 'Nyaa'
+
+
+# UploadSession
+class NyaaUploadSession(UploadSessionBase, db.Model):
+    __flavor__ = 'Nyaa'
+
+
 # Defaults; site flavors are deprecated but this is a useful mechanic
 Item = NyaaItem
 Filelist = NyaaItemFilelist
 Statistic = NyaaStatistic
+ItemCount = NyaaItemCount
+Listing = NyaaListing
+FileTerm = NyaaFileTerm
 MainCategory = NyaaMainCategory
 SubCategory = NyaaSubCategory
 Comment = NyaaComment
@@ -933,3 +1162,5 @@ AdminLog = NyaaAdminLog
 Report = NyaaReport
 ItemNameSearch = NyaaItemNameSearch
 TrackerApi = NyaaTrackerApi
+FileJob = NyaaFileJob
+UploadSession = NyaaUploadSession
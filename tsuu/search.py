@@ -1,8 +1,11 @@
+import base64
+import json
 import math
+import operator
 import re
 import shlex
 import threading
-import time
+from collections import namedtuple
 
 import flask
 from flask_sqlalchemy import Pagination
@@ -12,8 +15,9 @@ import sqlalchemy_fulltext.modes as FullTextMode
 from sqlalchemy.ext import baked
 from sqlalchemy_fulltext import FullTextSearch
 
-from tsuu import models
-from tsuu.extensions import db
+from tsuu import file_index, fulltext, item_counts, models
+from tsuu.extensions import config, db
+from tsuu.lru import LRUCache
 
 app = flask.current_app
 
@@ -23,40 +27,6 @@ SERACH_PAGINATE_DISPLAY_MSG = ('Displaying results {start}-{end} out of {total}
                                'Please refine your search results if you can\'t find '
                                'what you were looking for.')
 
-# Table-column index name cache for _get_index_name
-# In format of {'table' : {'column_a':'ix_table_column_a'}}
-_index_name_cache = {}
-
-
-def _get_index_name(column):
-    ''' Returns an index name for a given column, or None.
-        Only considers single-column indexes.
-        Results are cached in memory (until app restart). '''
-    column_table_name = column.class_.__table__.name
-    table_indexes = _index_name_cache.get(column_table_name)
-    if table_indexes is None:
-        # Load the real table schema from the database
-        # Fresh MetaData used to skip SQA's cache and get the real indexes on the database
-        table_indexes = {}
-        try:
-            column_table = sqlalchemy.Table(column_table_name,
-                                            sqlalchemy.MetaData(),
-                                            autoload=True, autoload_with=db.engine)
-        except sqlalchemy.exc.NoSuchTableError:
-            # Trust the developer to notice this?
-            pass
-        else:
-            for index in column_table.indexes:
-                # Only consider indexes with one column
-                if len(index.expressions) > 1:
-                    continue
-
-                index_column = index.expressions[0]
-                table_indexes[index_column.name] = index.name
-        _index_name_cache[column_table_name] = table_indexes
-
-    return table_indexes.get(column.name)
-
 
 def _generate_query_string(term, category, filter, user):
     params = {}
@@ -71,6 +41,85 @@ def _generate_query_string(term, category, filter, user):
     return params
 
 
+# Keyset ("seek") pagination: instead of skipping OFFSET rows, a page starts right after
+# the (sort value, id) of the last item on the previous page. That's an index range scan,
+# so every page costs the same as the first and no COUNT is needed.
+# The position is passed around as an opaque after= token.
+
+def encode_cursor(sort, order, value, item_id):
+    ''' Returns an after= token for the position (value, item_id) in the given ordering '''
+    payload = json.dumps([sort, order, value, item_id], separators=(',', ':'))
+    return base64.urlsafe_b64encode(payload.encode('utf-8')).decode('ascii').rstrip('=')
+
+
+def decode_cursor(token, sort, order):
+    ''' Returns (value, item_id) from an after= token.
+        Raises ValueError if the token is malformed or for a different ordering. '''
+    try:
+        payload = base64.urlsafe_b64decode(token + '=' * (-len(token) % 4))
+        token_sort, token_order, value, item_id = json.loads(payload.decode('utf-8'))
+    except (TypeError, ValueError, UnicodeError, base64.binascii.Error):
+        raise ValueError('Malformed cursor')
+
+    if (token_sort, token_order) != (sort, order):
+        raise ValueError('Cursor is for a different ordering')
+    if not isinstance(item_id, int) or not isinstance(value, int):
+        raise ValueError('Malformed cursor')
+    return value, item_id
+
+
+def cursor_for(item, sort, order):
+    ''' Returns the after= token for the position right after a listing '''
+    return encode_cursor(sort, order, getattr(item, SORT_KEYS[sort].key), item.id)
+
+
+def _decode_cursor_or_abort(token, sort, order):
+    try:
+        return decode_cursor(token, sort, order)
+    except ValueError as e:
+        flask.abort(flask.Response('Invalid after= parameter: {}.'.format(e), 400))
+
+
+def _keyset_criterion(sort, order, value, item_id):
+    ''' Filters to the rows after (value, item_id), ties on the sort key broken by id '''
+    after = operator.lt if order == 'desc' else operator.gt
+    if sort == 'id':
+        return after(models.Listing.id, item_id)
+    column = SORT_KEYS[sort]
+    return after(column, value) | ((column == value) & after(models.Listing.id, item_id))
+
+
+class KeysetPage(object):
+    ''' A page of keyset-paginated results. Unlike Pagination, it doesn't know
+        the total number of results, only whether there is a next page. '''
+
+    keyset = True
+
+    def __init__(self, items, per_page, sort, order, after=None):
+        # The query fetches one row more than a page to tell if there's a next one
+        self.items = items[:per_page]
+        self.per_page = per_page
+        self.after = after
+        self.has_next = len(items) > per_page
+        self.next_after = None
+        if self.has_next:
+            self.next_after = cursor_for(self.items[-1], sort, order)
+
+    @property
+    def has_prev(self):
+        return self.after is not None
+
+
+def _continue_with_keyset(pagination, sort, order, max_page):
+    ''' Lets the last page allowed by MAX_PAGES link to the rest of the results
+        as keyset pages, which aren't limited '''
+    pagination.next_after = None
+    if (max_page and pagination.page >= max_page and
+            len(pagination.items) == pagination.per_page):
+        pagination.next_after = cursor_for(pagination.items[-1], sort, order)
+    return pagination
+
+
 # For preprocessing ES search terms in _parse_es_search_terms
 QUOTED_LITERAL_REGEX = re.compile(r'(?i)(-)?"(.+?)"')
 QUOTED_LITERAL_GROUP_REGEX = re.compile(r'''
@@ -97,132 +146,121 @@ def _es_name_exact_phrase(literal):
         }
     })
 
-class QueryPairCaller(object):
-    ''' Simple stupid class to filter one or more queries with the same args '''
-
-    def __init__(self, *items):
-        self.items = list(items)
-
-    def __getattr__(self, name):
-        # Create and return a wrapper that will call item.foobar(*args, **kwargs) for all items
-        def wrapper(*args, **kwargs):
-            for i in range(len(self.items)):
-                method = getattr(self.items[i], name)
-                if not callable(method):
-                    raise Exception('Attribute %r is not callable' % method)
-                self.items[i] = method(*args, **kwargs)
-            return self
-
-        return wrapper
-
-
-def search_db(term='', user=None, sort='id', order='desc', category='0_0',
-              quality_filter='0', page=1, rss=False, admin=False,
-              logged_in_user=None, per_page=75):
-    if page > 4294967295:
-        flask.abort(404)
-
-    MAX_PAGES = app.config.get("MAX_PAGES", 0)
-
-    same_user = False
-    if logged_in_user:
-        same_user = logged_in_user.id == user
 
-    # Logged in users should always be able to view their full listing.
-    if same_user or admin:
-        MAX_PAGES = 0
+# Quality filters as (flag, whether it must be set)
+FILTER_FLAGS = {
+    '0': None,
+    '1': (models.ItemFlags.REMAKE, False),
+    '2': (models.ItemFlags.TRUSTED, True),
+    '3': (models.ItemFlags.COMPLETE, True)
+}
 
-    if MAX_PAGES and page > MAX_PAGES:
-        flask.abort(flask.Response("You've exceeded the maximum number of pages. Please "
-                                   "make your search query less broad.", 403))
+# Result totals, see _counted_total and baked_paginate
+LRU_CACHE = LRUCache(config.get('COUNT_CACHE_SIZE', 256), 60)
 
-    sort_keys = {
-        'id': models.Item.id,
-        'size': models.Item.filesize,
-        # Disable this because we disabled this in search_elastic, for the sake of consistency:
-        # 'name': models.Item.display_name,
-        'comments': models.Item.comment_count,
-        'seeders': models.Statistic.seed_count,
-        'leechers': models.Statistic.leech_count,
-        'downloads': models.Statistic.download_count
-    }
-
-    sort_column = sort_keys.get(sort.lower())
-    if sort_column is None:
-        flask.abort(400)
 
-    order_keys = {
-        'desc': 'desc',
-        'asc': 'asc'
-    }
+def _counted_total(user, admin, same_user, rss, logged_in_user,
+                   main_cat_id, sub_cat_id, filter_tuple):
+    ''' Returns the number of results of a search without a term from the item counters.
+        Mirrors the visibility rules of search_db. '''
+    cache_key = ('counters', user, admin, same_user, rss,
+                 logged_in_user.id if logged_in_user else None,
+                 main_cat_id, sub_cat_id, filter_tuple)
+    total = LRU_CACHE.get(cache_key)
+    if total is not None:
+        return total
 
-    order_ = order.lower()
-    if order_ not in order_keys:
-        flask.abort(400)
+    conditions = [filter_tuple] if filter_tuple else []
+    if not admin:
+        conditions.append((models.ItemFlags.DELETED, False))
 
-    filter_keys = {
-        '0': None,
-        '1': (models.ItemFlags.REMAKE, False),
-        '2': (models.ItemFlags.TRUSTED, True),
-        '3': (models.ItemFlags.COMPLETE, True)
-    }
+    if user:
+        if not admin and (not same_user or rss):
+            conditions.append((models.ItemFlags.HIDDEN | models.ItemFlags.ANONYMOUS, False))
+        total = item_counts.count_items(conditions, main_cat_id, sub_cat_id, uploader_id=user)
+    elif not admin and logged_in_user and not rss:
+        # Everything that isn't hidden, plus your own hidden items
+        total = (item_counts.count_items(conditions + [(models.ItemFlags.HIDDEN, False)],
+                                         main_cat_id, sub_cat_id) +
+                 item_counts.count_items(conditions + [(models.ItemFlags.HIDDEN, True)],
+                                         main_cat_id, sub_cat_id,
+                                         uploader_id=logged_in_user.id))
+    else:
+        if not admin:
+            conditions.append((models.ItemFlags.HIDDEN, False))
+        total = item_counts.count_items(conditions, main_cat_id, sub_cat_id)
 
-    sentinel = object()
-    filter_tuple = filter_keys.get(quality_filter.lower(), sentinel)
-    if filter_tuple is sentinel:
-        flask.abort(400)
+    if app.config['COUNT_CACHE_DURATION']:
+        LRU_CACHE.put(cache_key, total, expiry=app.config['COUNT_CACHE_DURATION'])
+    return total
+
+
+# Search queries are baked (see sqlalchemy.ext.baked). The query for a search is built from
+# its shape alone: which filters, ordering and paging it uses, but none of their values,
+# which are bound parameters. The ORM compilation of every shape is cached in the plan
+# cache, so searching with a shape that was seen before skips building and compiling the
+# query. warm_plan_cache compiles the shapes of the common listings when the app starts.
+
+SearchShape = namedtuple('SearchShape', [
+    'user_view',       # /user/<name> listing
+    'admin',
+    'logged_in',       # a regular user on the general listing, who also sees their hidden items
+    'same_user',       # a regular user on their own listing
+    'category_level',  # 0 for all categories, 1 for a main category, 2 for a sub category
+    'quality_filter',  # a FILTER_FLAGS key
+    'sort',            # a SORT_KEYS key or 'relevance'
+    'order',
+    'rss',
+    'fts',             # whether there's an FTS5 search term
+    'mysql_words',     # number of words searched with MySQL FULLTEXT
+    'file_patterns',   # number of file: patterns
+    'paging',          # 'page', 'keyset', 'rss' or 'rss_keyset' (an RSS feed with after=)
+])
+
+SORT_KEYS = {
+    'id': models.Listing.id,
+    'size': models.Listing.filesize,
+    'comments': models.Listing.comment_count,
+    'seeders': models.Listing.seed_count,
+    'leechers': models.Listing.leech_count,
+    'downloads': models.Listing.download_count
+}
 
-    if user:
-        user = models.User.by_id(user)
-        if not user:
-            flask.abort(404)
-        user = user.id
+_plan_cache = sqlalchemy.util.LRUCache(config.get('SEARCH_PLAN_CACHE_SIZE', 1000))
+_plan_stats = {'hits': 0, 'misses': 0}
+_plan_stats_lock = threading.Lock()
 
-    main_category = None
-    sub_category = None
-    main_cat_id = 0
-    sub_cat_id = 0
-    if category:
-        cat_match = re.match(r'^(\d+)_(\d+)$', category)
-        if not cat_match:
-            flask.abort(400)
+bp = sqlalchemy.bindparam
 
-        main_cat_id = int(cat_match.group(1))
-        sub_cat_id = int(cat_match.group(2))
 
-        if main_cat_id > 0:
-            if sub_cat_id > 0:
-                sub_category = models.SubCategory.by_category_ids(main_cat_id, sub_cat_id)
-            else:
-                main_category = models.MainCategory.by_id(main_cat_id)
+def bakery(initial_fn, *args):
+    ''' Returns a BakedQuery cached in the search plan cache. Like every step of a baked
+        query, initial_fn is keyed on its code and args, not on the values it closes over. '''
+    return baked.BakedQuery(_plan_cache, initial_fn, args)
 
-            if not category:
-                flask.abort(400)
 
-    # Force sort by id desc if rss
-    if rss:
-        sort_column = sort_keys['id']
-        order = 'desc'
+def _flags_set(flags, is_set):
+    return models.Listing.flags.op('&')(int(flags)).is_(is_set)
 
-#    model_class = models.ItemNameSearch if term else models.Item
-    model_class = models.Item
 
-    query = db.session.query(model_class)
+def _mysql_match(index):
+    match = FullTextSearch('', models.ItemNameSearch, FullTextMode.NATURAL)
+    # FullTextSearch wraps its argument in a literal, bind the word instead
+    match.against = bp('word_{}'.format(index))
+    return match
 
-    # This is... eh. Optimize the COUNT() query since MySQL is bad at that.
-    # See http://docs.sqlalchemy.org/en/rel_1_1/orm/query.html#sqlalchemy.orm.query.Query.count
-    # Wrap the queries into the helper class to deduplicate code and apply filters to both in one go
-    count_query = db.session.query(sqlalchemy.func.count(model_class.id))
-    qpc = QueryPairCaller(query, count_query)
 
+def _filtered(query, shape):
+    ''' Applies the filters of a search shape to a query of the listings table, with
+        bound parameters for all of their values '''
+    Listing = models.Listing
     # User view (/user/username)
-    if user:
-        qpc.filter(models.Item.uploader_id == user)
+    if shape.user_view:
+        query = query.filter(Listing.uploader_id == bp('user'))
 
-        if not admin:
+        if not shape.admin:
             # Hide all DELETED items if regular user
-            qpc.filter(models.Item.flags.op('&')(
-                int(models.ItemFlags.DELETED)).is_(False))
+            query = query.filter(_flags_set(models.ItemFlags.DELETED, False))
             # If logged in user is not the same as the user being viewed,
             # show only items that aren't hidden or anonymous
             #
@@ -231,152 +269,187 @@ def search_db(term='', user=None, sort='id', order='desc', category='0_0',
             #
             # On RSS pages in user view,
             # show only items that aren't hidden or anonymous no matter what
-            if not same_user or rss:
-                qpc.filter(models.Item.flags.op('&')(
-                    int(models.ItemFlags.HIDDEN | models.ItemFlags.ANONYMOUS)).is_(False))
+            if not shape.same_user:
+                query = query.filter(_flags_set(
+                    models.ItemFlags.HIDDEN | models.ItemFlags.ANONYMOUS, False))
     # General view (homepage, general search view)
-    else:
-        if not admin:
-            # Hide all DELETED items if regular user
-            qpc.filter(models.Item.flags.op('&')(
-                int(models.ItemFlags.DELETED)).is_(False))
-            # If logged in, show all items that aren't hidden unless they belong to you
-            # On RSS pages, show all public items and nothing more.
-            if logged_in_user and not rss:
-                qpc.filter(
-                    (models.Item.flags.op('&')(int(models.ItemFlags.HIDDEN)).is_(False)) |
-                    (models.Item.uploader_id == logged_in_user.id))
-            # Otherwise, show all items that aren't hidden
-            else:
-                qpc.filter(models.Item.flags.op('&')(
-                    int(models.ItemFlags.HIDDEN)).is_(False))
-
-    if main_category:
-        qpc.filter(models.Item.main_category_id == main_cat_id)
-    elif sub_category:
-        qpc.filter((models.Item.main_category_id == main_cat_id) &
-                   (models.Item.sub_category_id == sub_cat_id))
-
-    if filter_tuple:
-        qpc.filter(models.Item.flags.op('&')(
-            int(filter_tuple[0])).is_(filter_tuple[1]))
-
-    if term:
-        for item in shlex.split(term, posix=False):
-            if len(item) >= 2:
-                if app.config.get('USE_MYSQL'):
-                    qpc.filter(FullTextSearch(
-                        item, models.ItemNameSearch, FullTextMode.NATURAL))
-    query, count_query = qpc.items
-    # Sort and order
-    if sort_column.class_ != models.Item:
-        index_name = _get_index_name(sort_column)
-        query = query.join(sort_column.class_)
-        query = query.with_hint(sort_column.class_, 'USE INDEX ({0})'.format(index_name))
-
-    query = query.order_by(getattr(sort_column, order)())
+    elif not shape.admin:
+        # Hide all DELETED items if regular user
+        query = query.filter(_flags_set(models.ItemFlags.DELETED, False))
+        # If logged in, show all items that aren't hidden unless they belong to you
+        # On RSS pages, show all public items and nothing more.
+        if shape.logged_in:
+            query = query.filter(_flags_set(models.ItemFlags.HIDDEN, False) |
+                                 (Listing.uploader_id == bp('logged_in_user')))
+        # Otherwise, show all items that aren't hidden
+        else:
+            query = query.filter(_flags_set(models.ItemFlags.HIDDEN, False))
 
-    if rss:
-        query = query.limit(per_page)
-    else:
-        query = query.paginate_faste(page, per_page=per_page, step=5, count_query=count_query,
-                                     max_page=MAX_PAGES)
+    if shape.category_level:
+        query = query.filter(Listing.main_category_id == bp('main_cat_id'))
+    if shape.category_level == 2:
+        query = query.filter(Listing.sub_category_id == bp('sub_cat_id'))
 
+    filter_tuple = FILTER_FLAGS[shape.quality_filter]
+    if filter_tuple:
+        query = query.filter(_flags_set(*filter_tuple))
+
+    for i in range(shape.file_patterns):
+        query = query.filter(file_index.item_criterion(
+            bp('file_terms_{}'.format(i), expanding=True), bp('file_term_count_{}'.format(i)),
+            Listing.id))
+
+    if shape.fts:
+        query = fulltext.join_fts(query, Listing.id).filter(
+            fulltext.match_criterion(bp('fts_expression')))
+    if shape.mysql_words:
+        # The FULLTEXT index is on the items table
+        query = query.join(models.Item, models.Item.id == Listing.id)
+    for i in range(shape.mysql_words):
+        query = query.filter(_mysql_match(i))
     return query
 
 
-# Baked queries follow
-
-class BakedPair(object):
-    def __init__(self, *items):
-        self.items = list(items)
-
-    def __iadd__(self, other):
-        for item in self.items:
-            item += other
-
-        return self
-
-
-bakery = baked.bakery()
+def _ordered(query, shape):
+    ''' Applies the ordering of a search shape, ties broken by id '''
+    order = shape.order
+    if shape.sort == 'relevance':
+        # Lower BM25 ranks are better matches
+        rank = fulltext.rank()
+        return query.order_by(rank.asc() if order == 'desc' else rank.desc(),
+                              getattr(models.Listing.id, order)())
+
+    column = SORT_KEYS[shape.sort]
+    query = query.order_by(getattr(column, order)())
+    if shape.sort != 'id':
+        # Break ties on id so that the order (and any after= token) is stable.
+        # Every sort column has a (column, id) index, see models.ListingBase
+        query = query.order_by(getattr(models.Listing.id, order)())
+    return query
 
 
-BAKED_SORT_KEYS = {
-    'id': models.Item.id,
-    'size': models.Item.filesize,
-    'comments': models.Item.comment_count,
-    'seeders': models.Statistic.seed_count,
-    'leechers': models.Statistic.leech_count,
-    'downloads': models.Statistic.download_count
-}
-
-BAKED_SORT_LAMBDAS = {
-    'id-asc': lambda q: q.order_by(models.Item.id.asc()),
-    'id-desc': lambda q: q.order_by(models.Item.id.desc()),
-
-    'size-asc': lambda q: q.order_by(models.Item.filesize.asc()),
-    'size-desc': lambda q: q.order_by(models.Item.filesize.desc()),
-
-    'comments-asc': lambda q: q.order_by(models.Item.comment_count.asc()),
-    'comments-desc': lambda q: q.order_by(models.Item.comment_count.desc()),
-
-    # This is a bit stupid, but programmatically generating these mixed up the baked keys, so deal.
-    'seeders-asc': lambda q: q.join(models.Statistic).with_hint(
-        models.Statistic, 'USE INDEX (idx_nyaa_statistics_seed_count)'
-    ).order_by(models.Statistic.seed_count.asc(),  models.Item.id.asc()),
-    'seeders-desc': lambda q: q.join(models.Statistic).with_hint(
-        models.Statistic, 'USE INDEX (idx_nyaa_statistics_seed_count)'
-    ).order_by(models.Statistic.seed_count.desc(), models.Item.id.desc()),
-
-    'leechers-asc': lambda q: q.join(models.Statistic).with_hint(
-        models.Statistic, 'USE INDEX (idx_nyaa_statistics_leech_count)'
-    ).order_by(models.Statistic.leech_count.asc(),  models.Item.id.asc()),
-    'leechers-desc': lambda q: q.join(models.Statistic).with_hint(
-        models.Statistic, 'USE INDEX (idx_nyaa_statistics_leech_count)'
-    ).order_by(models.Statistic.leech_count.desc(), models.Item.id.desc()),
-
-    'downloads-asc': lambda q: q.join(models.Statistic).with_hint(
-        models.Statistic, 'USE INDEX (idx_nyaa_statistics_download_count)'
-    ).order_by(models.Statistic.download_count.asc(),  models.Item.id.asc()),
-    'downloads-desc': lambda q: q.join(models.Statistic).with_hint(
-        models.Statistic, 'USE INDEX (idx_nyaa_statistics_download_count)'
-    ).order_by(models.Statistic.download_count.desc(), models.Item.id.desc()),
-}
+def _paged(query, shape):
+    if shape.paging in ('keyset', 'rss_keyset'):
+        query = query.filter(_keyset_criterion(shape.sort, shape.order,
+                                               bp('after_value'), bp('after_id')))
+    query = query.limit(bp('limit'))
+    if shape.paging == 'page':
+        query = query.offset(bp('offset'))
+    return query
 
 
-BAKED_FILTER_LAMBDAS = {
-    '0': None,
-    '1': lambda q: (
-        q.filter(models.Item.flags.op('&')(models.ItemFlags.REMAKE.value).is_(False))
-    ),
-    '2': lambda q: (
-        q.filter(models.Item.flags.op('&')(models.ItemFlags.TRUSTED.value).is_(True))
-    ),
-    '3': lambda q: (
-        q.filter(models.Item.flags.op('&')(models.ItemFlags.COMPLETE.value).is_(True))
-    ),
-}
+def _paging(rss, after):
+    ''' The paging of a search shape. RSS feeds have no page numbers, but follow their
+        rel="next" links with after= like any listing. '''
+    if rss:
+        return 'rss_keyset' if after else 'rss'
+    return 'keyset' if after else 'page'
+
+
+def _filter_shape(shape):
+    ''' The part of a shape that changes which items match '''
+    return shape._replace(sort=None, order=None, paging=None)
+
+
+def _plans(shape):
+    ''' Returns the baked queries for the items and the total count of a search shape '''
+    items = bakery(lambda session: _paged(_ordered(
+        _filtered(session.query(models.Listing), shape), shape), shape), shape)
+    count = bakery(lambda session: _filtered(
+        session.query(sqlalchemy.func.count(models.Listing.id)), shape), _filter_shape(shape))
+    return items, count
+
+
+def _rows_plan(shape):
+    ''' Returns a baked query for the ids of the matching items, for estimating totals '''
+    return bakery(lambda session: _filtered(session.query(models.Listing.id), shape),
+                  _filter_shape(shape))
+
+
+def _run(query, params):
+    ''' Returns the Result of a baked search query, counting plan cache hits and misses '''
+    session = db.session()
+    cached = query._effective_key(session) in _plan_cache
+    with _plan_stats_lock:
+        _plan_stats['hits' if cached else 'misses'] += 1
+    return query(session).params(**params)
+
+
+def plan_cache_info():
+    ''' Returns the hit and miss counts and the size of the search plan cache '''
+    with _plan_stats_lock:
+        info = dict(_plan_stats)
+    info['entries'] = len(_plan_cache)
+    info['capacity'] = _plan_cache.capacity
+    return info
+
+
+def common_shapes():
+    ''' Yields the shapes compiled by warm_plan_cache: every ordering of the general
+        listing without a search term, its RSS feed and the default listing of logged
+        in users, for every category level and quality filter '''
+    listing = SearchShape(user_view=False, admin=False, logged_in=False, same_user=False,
+                          category_level=0, quality_filter='0', sort='id', order='desc',
+                          rss=False, fts=False, mysql_words=0, file_patterns=0, paging='page')
+    for category_level in (0, 1, 2):
+        for quality_filter in sorted(FILTER_FLAGS):
+            shape = listing._replace(category_level=category_level,
+                                     quality_filter=quality_filter)
+            yield shape._replace(rss=True, paging='rss')
+            yield shape._replace(logged_in=True)
+            for sort in sorted(SORT_KEYS):
+                for order in ('desc', 'asc'):
+                    yield shape._replace(sort=sort, order=order)
+
+
+def warm_plan_cache(app):
+    ''' Compiles the query plans of common_shapes, so that the first searches don't pay
+        for it. The SQL string of a plan is still compiled on its first execution.
+        Database errors (say, on a database that isn't created yet) are only logged. '''
+    with app.app_context():
+        session = db.session()
+        try:
+            for shape in common_shapes():
+                for query in _plans(shape):
+                    if query._effective_key(session) not in _plan_cache:
+                        query._bake(session)
+        except sqlalchemy.exc.SQLAlchemyError as e:
+            app.logger.warning('Could not warm the search plan cache: %s', e)
+        finally:
+            db.session.remove()
 
 
-def search_db_baked(term='', user=None, sort='id', order='desc', category='0_0',
-                    quality_filter='0', page=1, rss=False, admin=False,
-                    logged_in_user=None, per_page=75):
+def search_db(term='', user=None, sort='id', order='desc', category='0_0',
+              quality_filter='0', page=1, rss=False, admin=False,
+              logged_in_user=None, per_page=75, after=None):
+    ''' Returns a Pagination of the matching listings (see models.ListingBase), a
+        KeysetPage if an after= token is given, or a plain list of listings for RSS '''
     if page > 4294967295:
         flask.abort(404)
 
     MAX_PAGES = app.config.get("MAX_PAGES", 0)
 
+    same_user = False
+    if logged_in_user:
+        same_user = logged_in_user.id == user
+
+    # Logged in users should always be able to view their full listing.
+    # Keyset pages cost the same however deep they are, so they aren't limited either.
+    if same_user or admin or after:
+        MAX_PAGES = 0
+
     if MAX_PAGES and page > MAX_PAGES:
         flask.abort(flask.Response("You've exceeded the maximum number of pages. Please "
                                    "make your search query less broad.", 403))
 
-    sort_lambda = BAKED_SORT_LAMBDAS.get('{}-{}'.format(sort, order).lower())
-    if not sort_lambda:
+    sort, order = sort.lower(), order.lower()
+    if sort != 'relevance' and sort not in SORT_KEYS:
+        flask.abort(400)
+    if order not in ('desc', 'asc'):
         flask.abort(400)
 
-    sentinel = object()
-    filter_lambda = BAKED_FILTER_LAMBDAS.get(quality_filter.lower(), sentinel)
-    if filter_lambda is sentinel:
+    quality_filter = quality_filter.lower()
+    if quality_filter not in FILTER_FLAGS:
         flask.abort(400)
 
     if user:
@@ -385,9 +458,10 @@ def search_db_baked(term='', user=None, sort='id', order='desc', category='0_0',
             flask.abort(404)
         user = user.id
 
+    params = {}
     main_cat_id = 0
     sub_cat_id = 0
-
+    category_level = 0
     if category:
         cat_match = re.match(r'^(\d+)_(\d+)$', category)
         if not cat_match:
@@ -396,191 +470,144 @@ def search_db_baked(term='', user=None, sort='id', order='desc', category='0_0',
         main_cat_id = int(cat_match.group(1))
         sub_cat_id = int(cat_match.group(2))
 
+        # Categories that don't exist don't filter anything
         if main_cat_id > 0:
             if sub_cat_id > 0:
-                sub_category = models.SubCategory.by_category_ids(main_cat_id, sub_cat_id)
-                if not sub_category:
-                    flask.abort(400)
-            else:
-                main_category = models.MainCategory.by_id(main_cat_id)
-                if not main_category:
-                    flask.abort(400)
+                if models.SubCategory.by_category_ids(main_cat_id, sub_cat_id):
+                    category_level = 2
+            elif models.MainCategory.by_id(main_cat_id):
+                category_level = 1
+
+    if category_level:
+        params['main_cat_id'] = main_cat_id
+    if category_level == 2:
+        params['sub_cat_id'] = sub_cat_id
+
+    # file: patterns search the file name index, the rest of the term the item names
+    term, file_patterns = file_index.split_file_patterns(term or '')
+    for i, terms in enumerate(file_patterns):
+        params['file_terms_{}'.format(i)] = sorted(terms)
+        params['file_term_count_{}'.format(i)] = len(terms)
+
+    fts_expression = None
+    mysql_words = []
+    if term and fulltext.enabled():
+        fts_expression = fulltext.match_expression(term)
+        if fts_expression:
+            params['fts_expression'] = fts_expression
+    elif term and app.config.get('USE_MYSQL'):
+        mysql_words = [word for word in shlex.split(term, posix=False) if len(word) >= 2]
+        for i, word in enumerate(mysql_words):
+            params['word_{}'.format(i)] = word
+
+    # Ranking by relevance needs a search term and the FTS5 index (see fulltext).
+    # Without them, relevance falls back to sorting by id.
+    if sort == 'relevance' and (fts_expression is None or rss):
+        sort = 'id'
 
     # Force sort by id desc if rss
     if rss:
-        sort_lambda = BAKED_SORT_LAMBDAS['id-desc']
-
-    same_user = False
-    if logged_in_user:
-        same_user = logged_in_user.id == user
-
-    if term:
-        query = bakery(lambda session: session.query(models.ItemNameSearch))
-        count_query = bakery(lambda session: session.query(
-            sqlalchemy.func.count(models.ItemNameSearch.id)))
-    else:
-        query = bakery(lambda session: session.query(models.ItemNameSearch))
-        # This is... eh. Optimize the COUNT() query since MySQL is bad at that.
-        # See http://docs.sqlalchemy.org/en/rel_1_1/orm/query.html#sqlalchemy.orm.query.Query.count
-        # Wrap the queries into the helper class to deduplicate code and
-        # apply filters to both in one go
-        count_query = bakery(lambda session: session.query(
-            sqlalchemy.func.count(models.Item.id)))
+        sort, order = 'id', 'desc'
+
+    if after:
+        if sort == 'relevance':
+            flask.abort(flask.Response('after= is not supported when sorting by relevance.',
+                                       400))
+        params['after_value'], params['after_id'] = _decode_cursor_or_abort(after, sort, order)
+
+    shape = SearchShape(
+        user_view=bool(user),
+        admin=bool(admin),
+        # These only change what regular users see, and never on RSS
+        logged_in=bool(logged_in_user) and not (user or admin or rss),
+        same_user=same_user and not (admin or rss),
+        category_level=category_level,
+        quality_filter=quality_filter,
+        sort=sort,
+        order=order,
+        rss=bool(rss),
+        fts=fts_expression is not None,
+        mysql_words=len(mysql_words),
+        file_patterns=len(file_patterns),
+        paging=_paging(rss, after))
 
-    qpc = BakedPair(query, count_query)
-    bp = sqlalchemy.bindparam
-
-    baked_params = {}
-
-    # User view (/user/username)
     if user:
-        qpc += lambda q: q.filter(models.Item.uploader_id == bp('user'))
-        baked_params['user'] = user
-
-        if not admin:
-            # Hide all DELETED items if regular user
-            qpc += lambda q: q.filter(models.Item.flags.op('&')
-                                      (int(models.ItemFlags.DELETED)).is_(False))
-            # If logged in user is not the same as the user being viewed,
-            # show only items that aren't hidden or anonymous
-            #
-            # If logged in user is the same as the user being viewed,
-            # show all items including hidden and anonymous ones
-            #
-            # On RSS pages in user view,
-            # show only items that aren't hidden or anonymous no matter what
-            if not same_user or rss:
-                qpc += lambda q: (
-                    q.filter(
-                        models.Item.flags.op('&')(
-                            int(models.ItemFlags.HIDDEN | models.ItemFlags.ANONYMOUS)
-                        ).is_(False)
-                    )
-                )
-    # General view (homepage, general search view)
-    else:
-        if not admin:
-            # Hide all DELETED items if regular user
-            qpc += lambda q: q.filter(models.Item.flags.op('&')
-                                      (int(models.ItemFlags.DELETED)).is_(False))
-            # If logged in, show all items that aren't hidden unless they belong to you
-            # On RSS pages, show all public items and nothing more.
-            if logged_in_user and not rss:
-                qpc += lambda q: q.filter(
-                    (models.Item.flags.op('&')(int(models.ItemFlags.HIDDEN)).is_(False)) |
-                    (models.Item.uploader_id == bp('logged_in_user'))
-                )
-                baked_params['logged_in_user'] = logged_in_user
-            # Otherwise, show all items that aren't hidden
-            else:
-                qpc += lambda q: q.filter(models.Item.flags.op('&')
-                                          (int(models.ItemFlags.HIDDEN)).is_(False))
-
-    if sub_cat_id:
-        qpc += lambda q: q.filter(
-            (models.Item.main_category_id == bp('main_cat_id')),
-            (models.Item.sub_category_id == bp('sub_cat_id'))
-        )
-        baked_params['main_cat_id'] = main_cat_id
-        baked_params['sub_cat_id'] = sub_cat_id
-    elif main_cat_id:
-        qpc += lambda q: q.filter(models.Item.main_category_id == bp('main_cat_id'))
-        baked_params['main_cat_id'] = main_cat_id
-
-    if filter_lambda:
-        qpc += filter_lambda
-
-    if term:
-        raise Exception('Baked search does not support search terms')
+        params['user'] = user
+    if shape.logged_in:
+        params['logged_in_user'] = logged_in_user.id
 
-    # Sort and order
-    query += sort_lambda
+    query, count_query = _plans(shape)
 
     if rss:
-        query += lambda q: q.limit(bp('per_page'))
-        baked_params['per_page'] = per_page
-
-        return query(db.session()).params(**baked_params).all()
-
-    return baked_paginate(query, count_query, baked_params,
-                          page, per_page=per_page, step=5, max_page=MAX_PAGES)
-
-
-class ShoddyLRU(object):
-    def __init__(self, max_entries=128, expiry=60):
-        self.max_entries = max_entries
-        self.expiry = expiry
-
-        # Contains [value, last_used, expires_at]
-        self.entries = {}
-        self._lock = threading.Lock()
-
-        self._sentinel = object()
-
-    def get(self, key, default=None):
-        entry = self.entries.get(key)
-        if entry is None:
-            return default
-
-        now = time.time()
-        if now > entry[2]:
-            with self._lock:
-                del self.entries[key]
-            return default
-
-        entry[1] = now
-        return entry[0]
-
-    def put(self, key, value, expiry=None):
-        with self._lock:
-            overflow = len(self.entries) - self.max_entries
-            if overflow > 0:
-                # Pick the least recently used keys
-                removed_keys = [key for key, value in sorted(
-                    self.entries.items(), key=lambda t:t[1][1])][:overflow]
-                for key in removed_keys:
-                    del self.entries[key]
-
-            now = time.time()
-            self.entries[key] = [value, now, now + (expiry or self.expiry)]
-
-
-LRU_CACHE = ShoddyLRU(256, 60)
-
-
-def baked_paginate(query, count_query, params, page=1, per_page=50, max_page=None, step=5):
+        params['limit'] = per_page
+        return _run(query, params).all()
+
+    if after:
+        # One row more than a page to tell if there's a next one
+        params['limit'] = per_page + 1
+        return KeysetPage(_run(query, params).all(), per_page, sort, order, after)
+
+    # Avoid the COUNT over the items table when possible, see config.example.py
+    total_count = None
+    count_mode = app.config.get('SEARCH_COUNT_MODE', 'exact')
+    if not term and not file_patterns and count_mode in ('counters', 'approximate'):
+        total_count = _counted_total(
+            user, admin, same_user, rss, logged_in_user,
+            main_cat_id if category_level else None,
+            sub_cat_id if category_level == 2 else None, FILTER_FLAGS[quality_filter])
+    elif count_mode == 'approximate':
+        rows_query = _rows_plan(shape)(db.session()).params(**params)
+        total_count = item_counts.estimate_rows(rows_query._as_query())
+
+    pagination = baked_paginate(query, count_query, params, page, per_page=per_page,
+                                max_page=MAX_PAGES, total_count=total_count)
+    if sort == 'relevance':
+        return pagination
+    return _continue_with_keyset(pagination, sort, order, MAX_PAGES)
+
+
+def file_matches(term, items):
+    ''' Returns {item_id: [path, ...]} of the files in items that match the file: patterns
+        in a search term, to show them with the results '''
+    file_patterns = file_index.split_file_patterns(term or '')[1]
+    if not file_patterns:
+        return {}
+    return file_index.matching_paths(file_patterns, [item.id for item in items])
+
+
+def baked_paginate(query, count_query, params, page=1, per_page=50, max_page=None, step=5,
+                   total_count=None):
+    ''' Returns a Pagination of a baked items query paged with limit and offset
+        parameters, counting all results with count_query unless total_count is given '''
     if page < 1:
         flask.abort(404)
 
     if max_page and page > max_page:
         flask.abort(404)
-    bp = sqlalchemy.bindparam
-
-    ses = db.session()
 
     # Count all items, use cache
-    if app.config['COUNT_CACHE_DURATION']:
-        query_key = (count_query._effective_key(ses), tuple(sorted(params.items())))
+    if total_count is not None:
+        total_query_count = total_count
+    elif app.config['COUNT_CACHE_DURATION']:
+        query_key = (count_query._effective_key(db.session()),
+                     tuple(sorted((name, tuple(value) if isinstance(value, list) else value)
+                                  for name, value in params.items())))
         total_query_count = LRU_CACHE.get(query_key)
         if total_query_count is None:
-            total_query_count = count_query(ses).params(**params).scalar()
+            total_query_count = _run(count_query, params).scalar()
             LRU_CACHE.put(query_key, total_query_count, expiry=app.config['COUNT_CACHE_DURATION'])
     else:
-        total_query_count = count_query(ses).params(**params).scalar()
+        total_query_count = _run(count_query, params).scalar()
 
     # Grab items on current page
-    query += lambda q: q.limit(bp('limit')).offset(bp('offset'))
-    params['limit'] = per_page
-    params['offset'] = (page - 1) * per_page
-
-    res = query(ses).params(**params)
-    items = res.all()
+    params = dict(params, limit=per_page, offset=(page - 1) * per_page)
+    items = _run(query, params).all()
 
     if max_page:
         total_query_count = min(total_query_count, max_page * per_page)
 
     # Handle case where we've had no results but then have some while in cache
-    total_query_count = max(total_query_count, len(items))
+    total_query_count = max(total_query_count, (page - 1) * per_page + len(items))
 
     if not items and page != 1:
         flask.abort(404)
@@ -0,0 +1,147 @@
+// Sends the file of the upload form in chunks before the form itself (see chunked_uploads),
+// so that a dropped connection costs one chunk instead of the whole file. Unfinished uploads
+// are resumed when the same file is chosen again, even after a reload.
+document.addEventListener("DOMContentLoaded", function(event) {
+	var input = document.getElementById('submission_file'),
+		tokenField = document.getElementById('upload_token');
+	if (!input || !tokenField || !window.FormData || !window.JSON || !Blob.prototype.slice) return;
+
+	var form = input.form,
+		submitButton = form.querySelector('input[type="submit"]'),
+		progress = document.createElement('div'),
+		progressBar = document.createElement('div'),
+		retryDelay = 2000,
+		maxRetries = 5;
+
+	progress.className = 'progress';
+	progress.style.display = 'none';
+	progressBar.className = 'progress-bar';
+	progress.appendChild(progressBar);
+	input.parentNode.parentNode.appendChild(progress);
+
+	var storage = {
+		get: function(key) {
+			try { return window.localStorage.getItem(key) || ''; } catch (e) { return ''; }
+		},
+		set: function(key, token) {
+			try { window.localStorage.setItem(key, token); } catch (e) {}
+		},
+		remove: function(key) {
+			try { window.localStorage.removeItem(key); } catch (e) {}
+		}
+	};
+
+	var request = function(method, url, body, headers, done) {
+		var xhr = new XMLHttpRequest();
+		xhr.open(method, url);
+		xhr.setRequestHeader('Accept', 'application/json');
+		for (var name in headers) xhr.setRequestHeader(name, headers[name]);
+		xhr.onload = function() {
+			var data = null;
+			try { data = JSON.parse(xhr.responseText); } catch (e) {}
+			done(xhr.status, data);
+		};
+		xhr.onerror = xhr.ontimeout = function() { done(0, null); };
+		xhr.send(body);
+	};
+
+	// Calls done with the "sha256 <hex digest>" of a chunk, or with null where the browser
+	// can't hash (WebCrypto only exists on HTTPS)
+	var checksum = function(blob, done) {
+		if (!window.crypto || !window.crypto.subtle || !window.FileReader) return done(null);
+		var reader = new FileReader();
+		reader.onload = function() {
+			window.crypto.subtle.digest('SHA-256', reader.result).then(function(digest) {
+				var hex = Array.prototype.map.call(new Uint8Array(digest), function(b) {
+					return ('0' + b.toString(16)).slice(-2);
+				}).join('');
+				done('sha256 ' + hex);
+			}, function() { done(null); });
+		};
+		reader.onerror = function() { done(null); };
+		reader.readAsArrayBuffer(blob);
+	};
+
+	var showProgress = function(offset, size, text) {
+		var percent = size ? Math.floor(offset / size * 100) : 100;
+		progress.style.display = '';
+		progressBar.style.width = percent + '%';
+		progressBar.textContent = text || percent + '%';
+	};
+
+	var fail = function(message) {
+		showProgress(0, 0, message);
+		progressBar.className = 'progress-bar progress-bar-danger';
+		submitButton.disabled = false;
+	};
+
+	var upload = function(file, done) {
+		var key = 'tsuu-upload:' + file.name + ':' + file.size + ':' + file.lastModified,
+			params = new FormData();
+		params.append('name', file.name);
+		params.append('size', file.size);
+		params.append('token', storage.get(key));
+
+		request('POST', '/upload/chunked', params, {}, function(status, session) {
+			if (!session || !session.success) return fail(session ? session.error : 'Server/Network error.');
+			storage.set(key, session.token);
+
+			var offset = session.offset,
+				retries = maxRetries;
+
+			var next = function() {
+				showProgress(offset, file.size);
+				if (offset >= file.size) {
+					storage.remove(key);
+					return done(session.token);
+				}
+
+				var blob = file.slice(offset, offset + session.chunk_size);
+				checksum(blob, function(sum) {
+					var headers = {'Upload-Offset': offset};
+					if (sum) headers['Upload-Checksum'] = sum;
+					request('PATCH', session.url, blob, headers, function(status, data) {
+						if (data && typeof data.offset === 'number') {
+							// Written, or sent for the wrong offset: carry on from where the server is
+							if (data.success || status == 409) {
+								offset = data.offset;
+								retries = maxRetries;
+								return next();
+							}
+						}
+						if (status == 404) return fail('The upload expired, please try again.');
+						if (!retries--) return fail((data && data.error) || 'Server/Network error.');
+						// Ask the server how far it got before trying again
+						setTimeout(function() {
+							request('GET', session.url, null, {}, function(status, data) {
+								if (data && data.success) offset = data.offset;
+								next();
+							});
+						}, retryDelay);
+					});
+				});
+			};
+			next();
+		});
+	};
+
+	input.addEventListener('change', function() {
+		tokenField.value = '';
+		progress.style.display = 'none';
+	});
+
+	form.addEventListener('submit', function(e) {
+		var file = input.files && input.files[0];
+		if (tokenField.value || !file || !file.size) return;
+
+		e.preventDefault();
+		submitButton.disabled = true;
+		progressBar.className = 'progress-bar';
+		upload(file, function(token) {
+			// The form only carries the token, the server already has the file
+			tokenField.value = token;
+			input.value = '';
+			form.submit();
+		});
+	});
+});
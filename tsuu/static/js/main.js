@@ -75,6 +75,58 @@ $(document).ready(function() {
 		$(this).next().stop().slideToggle(250);
 	});
 
+	// Lazily loaded file lists, fetched one directory page at a time
+	function loadFileListPage($list, page) {
+		var $status = $('<li/>').text('Loading...').appendTo($list);
+
+		$.getJSON($list.data('src'), { path: $list.data('path'), p: page }).done(function(data) {
+			$status.remove();
+			data.entries.forEach(function(entry) {
+				var $entry = $('<li/>');
+				if (entry.type === 'directory') {
+					$('<a href="" class="lazy-folder"/>').text(entry.name)
+						.prepend('<i class="fa fa-folder"></i>')
+						.append($('<span class="file-size"/>').text(' (' + _format_file_size(entry.size) + ')'))
+						.appendTo($entry);
+					$('<ul/>').data({ src: $list.data('src'), path: entry.path }).hide().appendTo($entry);
+				} else {
+					$entry.append('<i class="fa fa-file"></i>').append(document.createTextNode(entry.name + ' '));
+					$('<span class="file-size"/>').text('(' + _format_file_size(entry.size) + ') ')
+						.append($('<a/>').attr('href', entry.url).append('<i class="fa fa-download fa-fw"></i>'))
+						.appendTo($entry);
+				}
+				$entry.appendTo($list);
+			});
+
+			if (data.has_next) {
+				var remaining = data.total - data.page * data.per_page;
+				$('<li/>').append($('<a href=""/>').text('Show ' + remaining + ' more...').click(function(e) {
+					e.preventDefault();
+					$(this).parent().remove();
+					loadFileListPage($list, data.page + 1);
+				})).appendTo($list);
+			}
+		}).fail(function(xhr) {
+			var error = xhr.responseJSON && xhr.responseJSON.error || 'An unknown error occurred.';
+			$status.text(error);
+		});
+	}
+
+	$('.lazy-file-list').each(function() {
+		loadFileListPage($(this), 1);
+	});
+
+	$('.lazy-file-list').on('click', 'a.lazy-folder', function(e) {
+		e.preventDefault();
+		var $list = $(this).next();
+		$(this).blur().children('i').toggleClass('fa-folder-open fa-folder');
+		if (!$list.data('loaded')) {
+			$list.data('loaded', true);
+			loadFileListPage($list, 1);
+		}
+		$list.stop().slideToggle(250);
+	});
+
 	// Comment editing below
 	$('.edit-comment').click(function(e) {
 		e.preventDefault();
@@ -167,6 +219,16 @@ function _format_date(date, show_seconds) {
 	var s = show_seconds ? ":" + pad(date.getSeconds()) : ""
 	return ymd + " " + hm + s;
 }
+// Same output as Jinja's filesizeformat(binary=True)
+function _format_file_size(bytes) {
+	var units = ["KiB", "MiB", "GiB", "TiB", "PiB", "EiB", "ZiB", "YiB"];
+	if (bytes === 1) return "1 Byte";
+	if (bytes < 1024) return bytes + " Bytes";
+	for (var i = 0; i < units.length; i++) {
+		var unit = Math.pow(1024, i + 2);
+		if (bytes < unit || i === units.length - 1) return (1024 * bytes / unit).toFixed(1) + " " + units[i];
+	}
+}
 
 // Add title text to elements with data-timestamp attribute
 document.addEventListener("DOMContentLoaded", function(event) {
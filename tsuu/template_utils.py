@@ -8,6 +8,7 @@ import flask
 from werkzeug.urls import url_encode
 
 from tsuu.backend import get_category_id_map
+from tsuu.fragments import render_rows
 
 app = flask.current_app
 bp = flask.Blueprint('template-utils', __name__)
@@ -67,6 +68,8 @@ def modify_query(**new_values):
     args = flask.request.args.copy()
 
     args.pop('p', None)
+    # after= tokens are only valid for the ordering they were made for
+    args.pop('after', None)
 
     for key, value in new_values.items():
         args[key] = value
@@ -87,6 +90,12 @@ def category_name(cat_id):
     return ' - '.join(get_category_id_map().get(cat_id, ['???']))
 
 
+@bp.app_template_global()
+def render_result_rows(items, file_matches=None):
+    """ Renders the rows of search_results.html, cached per row (see fragments) """
+    return render_rows(items, file_matches)
+
+
 # ######################### TEMPLATE FILTERS #########################
 
 @bp.app_template_filter('utc_time')
@@ -9,6 +9,7 @@ from tsuu.views import (  # isort:skip
     users,
     download,
     files,
+    uploads,
 )
 
 
@@ -51,3 +52,4 @@ def register_views(flask_app):
     flask_app.register_blueprint(users.bp)
     flask_app.register_blueprint(download.bp)
     flask_app.register_blueprint(files.bp)
+    flask_app.register_blueprint(uploads.bp)
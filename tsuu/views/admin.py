@@ -3,7 +3,7 @@ from ipaddress import ip_address
 
 import flask
 
-from tsuu import email, forms, models
+from tsuu import email, forms, models, search
 from tsuu.extensions import db
 
 app = flask.current_app
@@ -187,6 +187,15 @@ def view_trusted_application(app_id):
                                  decision_form=decision_form)
 
 
+@bp.route('/search-plans', endpoint='search_plans', methods=['GET'])
+def view_search_plans():
+    if not flask.g.user or not flask.g.user.is_moderator:
+        flask.abort(403)
+
+    # Hit and miss counts of the compiled search queries, see search.plan_cache_info
+    return flask.jsonify(search.plan_cache_info())
+
+
 def _send_trusted_decision_email(user, is_accepted):
     email_msg = email.EmailHolder(
         subject='Your {} Trusted Application was {}.'.format(app.config['GLOBAL_SITE_NAME'],
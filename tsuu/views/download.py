@@ -2,14 +2,53 @@ import flask
 from flask.templating import render_template_string
 import werkzeug
 
+import hashlib
 import json
 import os
+import zlib
+from datetime import datetime
+from urllib.parse import quote
 
-from tsuu import models
+from tsuu import archive, backend, file_serving, filelist, filetree, manifest, models
+from tsuu.counters import download_counter
+from tsuu.extensions import cache
 
 app = flask.current_app
 bp = flask.Blueprint('download', __name__)
 
+
+def _get_downloadable_item(slug):
+    item = models.Item.by_slug(slug)
+
+    # slug doesnt exist.
+    if not item:
+        flask.abort(404)
+
+    # Only allow admins to download deleted or banned items
+    if (item.deleted or item.banned) and not (flask.g.user and flask.g.user.is_moderator):
+        flask.abort(404)
+
+    return item
+
+
+def _count_download(item, response):
+    ''' Counts a download once per transfer: revalidations (304s), HEAD requests
+        and resumed downloads (ranges not starting at 0) don't count again. '''
+    if flask.request.method != 'GET' or response.status_code not in (200, 206):
+        return response
+
+    byte_range = flask.request.range
+    if byte_range and byte_range.ranges[0][0] != 0:
+        return response
+
+    download_counter.record(item.id)
+    return response
+
+
+def _item_base_dir(item):
+    return os.path.abspath(backend.item_path(item.item_directory))
+
+
 @bp.route('/items/<string:slug>/', defaults={'path': None})
 @bp.route('/items/<string:slug>/<path:path>')
 def download(slug, path):
@@ -21,7 +60,8 @@ def download(slug, path):
     Note that you shouldn't do this in production. 
     In production, serve /items/ to the items directory 
     instead with directory listing enabled, thereby overriding
-    this endpoint.
+    this endpoint, or set DOWNLOAD_OFFLOAD so the web server
+    sends the files after this endpoint has checked the item.
 
     There is a special error page coded if you try to visit this path while the server is disabled.
     """
@@ -29,14 +69,8 @@ def download(slug, path):
     if not app.config["FLASK_SERVE_ITEMS"]:
         return flask.render_template("download_disabled.html")
 
-    item = models.Item.by_slug(slug)
-
-    # slug doesnt exist.
-    if not item:
-        flask.abort(404)
-
-    # THIS IS STUPID - TAKES CARE OF SEPARATORS
-    base_dir = f"{os.getcwd()}{os.sep}{app.config['ROOT_FOLDER']}{os.sep}{app.config['ITEM_FOLDER']}{os.sep}{item.item_directory}"
+    item = _get_downloadable_item(slug)
+    base_dir = _item_base_dir(item)
     if not path:
         path = base_dir
     else:
@@ -53,8 +87,170 @@ def download(slug, path):
 
     # Ok so it exists, next: is it a directory?
     if os.path.isdir(path):
-        return flask.render_template("download.html", files=os.listdir(path))
+        # Relative links in the listing need the trailing slash
+        if not flask.request.path.endswith('/'):
+            query = flask.request.query_string.decode('utf-8')
+            return flask.redirect(flask.request.path + '/' + ('?' + query if query else ''), 301)
+        return _directory_listing_response(item, base_dir, path)
+
+    # It's not. Either let the front-end server send it...
+    offload = app.config.get('DOWNLOAD_OFFLOAD')
+    if offload:
+        # Relative to the item storage folder, in whichever layout the item is stored
+        relative_path = os.path.relpath(path, os.path.abspath(backend.item_storage_root()))
+        accel_path = '{}/{}'.format(app.config['DOWNLOAD_ACCEL_PREFIX'].rstrip('/'),
+                                    relative_path.replace(os.sep, '/'))
+        return _count_download(item, file_serving.offload_file(
+            offload, path, accel_path, response_class=app.response_class))
+
+    # ...or send the file ourselves (with conditional GET and Range support).
+    return _count_download(item, file_serving.send_file(flask.request.environ, path,
+                                                        response_class=app.response_class))
+
+
+def _archive_etag(blob, root, tree, parts):
+    ''' A strong ETag for an archive of tree (stored at root on disk), from the file list,
+        the archive's path, format and mtime (parts) and the size and mtime of every
+        member: a file edited in place changes it, so If-Range never resumes a download
+        with bytes (or CRCs) of different contents. '''
+    etag = hashlib.sha1(blob)
+    etag.update('/'.join(parts).encode('utf-8', 'surrogateescape'))
+
+    if isinstance(tree, dict):
+        members = (os.path.join(root, *member_parts)
+                   for member_parts, node in filetree.walk_tree(tree)
+                   if not isinstance(node, dict))
+    else:
+        members = [root]
+    for path in members:
+        try:
+            stat_result = os.stat(path)
+        except OSError:
+            # Fails the download itself, see archive.ArchiveError
+            etag.update(b'\0-')
+            continue
+        etag.update('\0{}'.format(file_serving.file_etag(stat_result)).encode('ascii'))
+    return etag.hexdigest()
+
+
+@bp.route('/archive/<string:slug>.<any(zip, tar):archive_format>')
+def download_archive(slug, archive_format):
+    """
+    Streams an uncompressed ZIP or TAR of an item, or of ?path= inside of it.
+
+    The archive layout is computed from the stored file list, so its size is
+    known up front and interrupted downloads can be resumed with Range requests.
+    """
+    if not app.config['ALLOW_ARCHIVE_DOWNLOADS']:
+        flask.abort(404)
+
+    item = _get_downloadable_item(slug)
+    if not item.filelist or not item.filelist.filelist_blob:
+        flask.abort(404)
+
+    try:
+        path_parts = filetree.split_path(flask.request.args.get('path', ''))
+    except filetree.FileTreeError:
+        flask.abort(404)
+
+    blob = item.filelist.filelist_blob
+    tree = filelist.FilelistReader(blob).to_dict([item.item_directory] + path_parts)
+    if tree is None:
+        flask.abort(404)
+
+    name = path_parts[-1] if path_parts else item.item_directory
+    root = os.path.join(_item_base_dir(item), *path_parts)
+    build_archive = archive.zip_archive if archive_format == 'zip' else archive.tar_archive
+    item_archive = build_archive(root, tree, name, item.updated_time)
+
+    etag = _archive_etag(blob, root, tree,
+                         path_parts + [archive_format, str(item.updated_time)])
+
+    response = file_serving.make_response(flask.request.environ, item_archive.size,
+                                          etag, item.updated_time,
+                                          item_archive.iter_range,
+                                          mimetype=item_archive.mimetype,
+                                          response_class=app.response_class)
+    response.headers['Content-Disposition'] = "attachment; filename*=UTF-8''{}".format(
+        quote('{}.{}'.format(name, archive_format)))
+    return _count_download(item, response)
+
+
+def _get_directory_listing(item, relative_path, path):
+    ''' Returns the listing of a directory, cached per (item, path, directory mtime).
+        Adding, removing or renaming an entry bumps the directory mtime, which
+        makes the old cache entry unreachable. '''
+    mtime_ns = os.stat(path).st_mtime_ns
+    path_hash = hashlib.sha1(relative_path.encode('utf-8', 'surrogateescape')).hexdigest()
+    cache_key = 'dir_listing_{}_{}_{:x}'.format(item.item_directory, path_hash, mtime_ns)
+
+    listing = cache.get(cache_key)
+    if listing is None:
+        listing = filetree.list_directory(path)
+        cache.set(cache_key, listing, timeout=app.config['DIRECTORY_LISTING_CACHE_TIMEOUT'])
+    return mtime_ns, listing
+
+
+def _content_hashes(item_manifest, relative_path, listing):
+    ''' Returns {name: hash} for the files of a listing the item manifest has a current hash for '''
+    prefix = relative_path + '/' if relative_path else ''
+    hashes = {}
+    for name, is_dir, size, _, mtime_ns in listing:
+        content_hash = None if is_dir else manifest.lookup(item_manifest, prefix + name,
+                                                           size, mtime_ns)
+        if content_hash:
+            hashes[name] = content_hash
+    return hashes
+
+
+def _listing_json(relative_path, listing, hash_algorithm, hashes):
+    yield '{{"path":{},"hash_algorithm":{},"entries":['.format(json.dumps(relative_path),
+                                                               json.dumps(hash_algorithm))
+    for index, (name, is_dir, size, mtime, _) in enumerate(listing):
+        entry = {'name': name, 'type': 'directory' if is_dir else 'file', 'mtime': mtime}
+        if not is_dir:
+            entry['size'] = size
+            entry['content_hash'] = hashes.get(name)
+        yield (',' if index else '') + json.dumps(entry)
+    yield ']}'
+
+
+def _directory_listing_response(item, base_dir, path):
+    ''' A directory listing as HTML or, with ?format=json, as JSON.
+        Files list their content hash from the item manifest, if it has a current one.
+        Listings with more than DIRECTORY_LISTING_STREAM_THRESHOLD entries are streamed. '''
+    relative_path = os.path.relpath(path, base_dir).replace(os.sep, '/')
+    if relative_path == '.':
+        relative_path = ''
+    mtime_ns, listing = _get_directory_listing(item, relative_path, path)
+    stream = len(listing) > app.config['DIRECTORY_LISTING_STREAM_THRESHOLD']
+
+    manifest_blob = item.filelist.manifest_blob if item.filelist else None
+    item_manifest = manifest.decode(manifest_blob)
+    hash_algorithm = item_manifest['algorithm'] if item_manifest else None
+    hashes = _content_hashes(item_manifest, relative_path, listing)
+
+    response_format = flask.request.args.get('format')
+    if response_format == 'json':
+        body = _listing_json(relative_path, listing, hash_algorithm, hashes)
+        mimetype = 'application/json'
+    else:
+        response_format = 'html'
+        entries = ((name, is_dir, size, datetime.utcfromtimestamp(mtime), hashes.get(name))
+                   for name, is_dir, size, mtime, _ in listing)
+        context = dict(item=item, path=relative_path, entries=entries,
+                       hash_algorithm=hash_algorithm)
+        app.update_template_context(context)
+        body = app.jinja_env.get_template('download.html').generate(context)
+        mimetype = 'text/html'
+
+    if stream:
+        response = flask.Response(flask.stream_with_context(body), mimetype=mimetype)
+    else:
+        response = flask.Response(''.join(body), mimetype=mimetype)
 
-    # It's not, let's have flask deliver the rest.
-    print("Flask delivers: {}/{}".format(os.path.dirname(path), os.path.basename(path)))
-    return flask.send_from_directory(os.path.dirname(path), os.path.basename(path))
+    # Scrapers can revalidate instead of downloading the listing again
+    # Hashing a file updates the manifest but not the directory mtime
+    manifest_crc = zlib.crc32(manifest_blob) if manifest_blob else 0
+    response.set_etag('{:x}-{:x}-{}'.format(mtime_ns, manifest_crc, response_format), weak=True)
+    return response.make_conditional(flask.request)
@@ -1,13 +1,12 @@
 import hashlib
 import json
 import os
-import shutil
 
 import flask
 from sqlalchemy.sql import base
 import werkzeug
 
-from tsuu import models, backend
+from tsuu import backend, blobstore, chunked_uploads, jobs, manifest, models
 
 app = flask.current_app
 bp = flask.Blueprint('files', __name__)
@@ -50,6 +49,21 @@ def _get_path(base_dir, path_string):
     full_path = "/".join(filtered_path)
     return werkzeug.security.safe_join(base_dir, full_path)
 
+
+def _relative(base_dir, path):
+    """Returns a path relative to the item directory, for backend.handle_item_change."""
+    return os.path.relpath(path, base_dir)
+
+
+def _job_response(job):
+    """The response to a copy, move or delete, which the manager polls until it's done."""
+    return {
+        "success": True,
+        "job": job.id,
+        "job_url": flask.url_for('files.job_status', item_id=job.item_id, job_id=job.id),
+    }
+
+
 @bp.route('/view/<int:item_id>/edit/files/manager', methods=['POST'])
 def get_files_list(item_id):
     item = models.Item.by_id(item_id)
@@ -69,7 +83,7 @@ def get_files_list(item_id):
 
 
     action = flask.request.form.get('action')
-    base_dir = f"{app.config['ROOT_FOLDER']}/{app.config['ITEM_FOLDER']}/{item.item_directory}"
+    base_dir = backend.item_path(item.item_directory)
 
     if action == "refresh":
         # This ugly line gets the "proper" path from the function.
@@ -79,6 +93,8 @@ def get_files_list(item_id):
         path_string = flask.request.form.get("path")
         full_path = _get_path(base_dir, path_string)
 
+        item_manifest = manifest.decode(item.filelist.manifest_blob) if item.filelist else None
+
         entries = []
         for item in os.listdir(full_path):
             item_path = os.path.join(full_path, item)
@@ -89,14 +105,22 @@ def get_files_list(item_id):
                 entry["type"] = "folder"
                 entry["hash"] = _md5_string(item)
             else:
+                stat_result = os.stat(item_path)
                 entry["type"] = "file"
-                entry["size"] = os.path.getsize(item_path)
+                entry["size"] = stat_result.st_size
                 entry["hash"] = _hash_file(item_path, item)
+                # the real hash, once the manifest has caught up with this file
+                relative_path = _relative(base_dir, item_path).replace(os.sep, "/")
+                content_hash = manifest.lookup(item_manifest, relative_path,
+                                               stat_result.st_size, stat_result.st_mtime_ns)
+                if content_hash:
+                    entry["content_hash"] = content_hash
             entries.append(entry)
 
         response = {
             "success": True,
-            "entries": entries
+            "entries": entries,
+            "hash_algorithm": item_manifest["algorithm"] if item_manifest else None
         }
 
         return json.dumps(response)
@@ -132,7 +156,8 @@ def get_files_list(item_id):
             "entry": entry
         }
 
-        backend.handle_item_change(item.id)
+        backend.handle_item_change(item.id, [
+            ("rename", _relative(base_dir, original_path), _relative(base_dir, new_path))])
 
         return json.dumps(response)
     elif action == "newfolder":
@@ -174,7 +199,7 @@ def get_files_list(item_id):
             "entry": entry
         }
 
-        backend.handle_item_change(item.id)
+        backend.handle_item_change(item.id, [("add", _relative(base_dir, new_path), {})])
 
         return json.dumps(response)
     elif action == "delete":
@@ -190,19 +215,10 @@ def get_files_list(item_id):
         if not all(full_paths_to_delete):
             flask.abort(422)
 
-        for path in full_paths_to_delete:
-            if os.path.isdir(path):
-                shutil.rmtree(path)
-            else:
-                os.remove(path)
-
-        response = {
-            "success": True,
-        }
-
-        backend.handle_item_change(item.id)
+        job = jobs.enqueue(item, editor, "remove",
+                           [(_relative(base_dir, path), None) for path in full_paths_to_delete])
 
-        return json.dumps(response)
+        return json.dumps(_job_response(job))
     elif action == "upload":
         # get all relevant data
         path_string = flask.request.form.get('path')
@@ -225,14 +241,16 @@ def get_files_list(item_id):
 
         # write the file
         os.makedirs(os.path.dirname(write_path), exist_ok=True)
-        file_data.save(write_path)
+        temp_path, digest, actual_size = backend.stream_to_storage(file_data.stream)
 
         # check the filesize
-        actual_size = str(os.path.getsize(write_path))
-        if actual_size != size:
-            os.remove(write_path)
+        if str(actual_size) != size:
+            os.remove(temp_path)
             return {"success": False, "error": f"Wrong filesize submitted, received size {actual_size} but param says {size}."}
 
+        # replaces an existing file instead of writing into it, it may be linked to a blob
+        blobstore.place(temp_path, digest, actual_size, write_path)
+
         # build response
         entry = {
             "id": filename,
@@ -246,9 +264,35 @@ def get_files_list(item_id):
             "entry": entry
         }
 
-        backend.handle_item_change(item.id)
+        backend.handle_item_change(
+            item.id, [("add", _relative(base_dir, write_path), int(actual_size))])
 
         return json.dumps(response)
+    elif action == "upload_start":
+        # starts a resumable upload (or carries on with the one in token), whose chunks
+        # go to the uploads blueprint. Once it's complete, a job moves it into place.
+        path_string = flask.request.form.get('path')
+        full_path = _get_path(base_dir, path_string)
+
+        filename = flask.request.form.get('name')
+        size = flask.request.form.get('size', type=int)
+
+        if not all([path_string, full_path, filename]) or size is None:
+            flask.abort(400)
+        if size < 1:
+            return {"success": False, "error": "Empty files are uploaded in one go."}
+
+        write_path = werkzeug.security.safe_join(full_path, filename.strip("/"))
+        if not write_path:
+            flask.abort(422)
+
+        destination = _relative(base_dir, write_path)
+        name = os.path.basename(write_path)
+        upload = (chunked_uploads.resume(flask.request.form.get('token'), editor, name, size,
+                                         item, destination)
+                  or chunked_uploads.create(editor, name, size, item, destination))
+
+        return json.dumps(chunked_uploads.describe(upload))
     elif action == "copy":
         srcpath = flask.request.form.get("srcpath")
         srcids = json.loads(flask.request.form.get("srcids")) # source filenames
@@ -268,7 +312,7 @@ def get_files_list(item_id):
             src = werkzeug.security.safe_join(full_srcpath, sourcefile)
             dest = werkzeug.security.safe_join(full_destpath, sourcefile)
             if not all([src, dest]):
-                flask.abort(422) # quit on malicious nonsense
+                flask.abort(422)  # quit on malicious nonsense
             if dest == src: # are these the same?
                 safe_file_name_not_found = True
                 attempts = 0
@@ -277,7 +321,7 @@ def get_files_list(item_id):
                     filename = f"{basename}_{attempts}{ext}"
                     dest = werkzeug.security.safe_join(full_destpath, filename)
                     if not sourcefile:
-                        flask.abort(422) # quit on malicious nonsense
+                        flask.abort(422)  # quit on malicious nonsense
                     if not os.path.exists(dest):
                         safe_file_name_not_found = False
                     else:
@@ -285,11 +329,13 @@ def get_files_list(item_id):
 
             if os.path.exists(dest): # does it exist
                 overwrite += 1
-                if any([os.path.isfile(src) and os.path.isdir(dest), os.path.isdir(src) and os.path.isfile(dest)]):
+                if any([os.path.isfile(src) and os.path.isdir(dest),
+                        os.path.isdir(src) and os.path.isfile(dest)]):
                     # We can't copy a file into a folder which has a directory of the same name!
                     response = {
                         "success": False,
-                        "error": "Attempted copy of a file/folder into a folder containing a folder/file of the same name."
+                        "error": ("Attempted copy of a file/folder into a folder containing "
+                                  "a folder/file of the same name.")
                     }
                     return json.dumps(response)
 
@@ -305,23 +351,11 @@ def get_files_list(item_id):
             }
             return json.dumps(response)
         else:
-            if len(destfiles) != 1: 
-                # our frontend is coded to send the copy jobs 1 at a time.
-                # we don't want multiple copy jobs.
-                flask.abort(422)
-
-            if os.path.isdir(srcfiles[0]):
-                shutil.copytree(srcfiles[0], destfiles[0], dirs_exist_ok=True)
-            else:
-                shutil.copyfile(srcfiles[0], destfiles[0])
+            job = jobs.enqueue(item, editor, "copy", [
+                (_relative(base_dir, src), _relative(base_dir, dest))
+                for src, dest in zip(srcfiles, destfiles)])
 
-            response = {
-                "success": True,
-            }
-
-            backend.handle_item_change(item.id)
-
-            return json.dumps(response)
+            return json.dumps(_job_response(job))
     elif action == "move":
         # get form data
         srcpath = flask.request.form.get("srcpath")
@@ -347,11 +381,13 @@ def get_files_list(item_id):
 
             if os.path.exists(dest):
                 overwrite += 1
-                if any([os.path.isfile(src) and os.path.isdir(dest), os.path.isdir(src) and os.path.isfile(dest)]):
+                if any([os.path.isfile(src) and os.path.isdir(dest),
+                        os.path.isdir(src) and os.path.isfile(dest)]):
                     # We can't move a file into a folder which has a directory of the same name!
                     response = {
                         "success": False,
-                        "error": "Attempted move of a file/folder into a folder containing a folder/file of the same name."
+                        "error": ("Attempted move of a file/folder into a folder containing "
+                                  "a folder/file of the same name.")
                     }
                     return json.dumps(response)
             operations.append({
@@ -367,17 +403,51 @@ def get_files_list(item_id):
 
             return json.dumps(response)
 
-        for operation in operations:
-            shutil.move(operation["src"], operation["dest"])
-
-        backend.handle_item_change(item.id)
-
-        response = {
-            "success": True,
-            "error": "Not implemented."
-        }
+        job = jobs.enqueue(item, editor, "move", [
+            (_relative(base_dir, operation["src"]), _relative(base_dir, operation["dest"]))
+            for operation in operations])
+
+        return json.dumps(_job_response(job))
+    elif action == "batch":
+        # A list of {"action": copy/move/delete/rename, "src": path, "dest": path}, with
+        # paths relative to the item directory. They run as one job, which updates the
+        # file index once; the job's status has the outcome of every operation.
+        try:
+            batch = json.loads(flask.request.form.get("operations", ""))
+        except ValueError:
+            flask.abort(400)
+        if not isinstance(batch, list) or not batch:
+            flask.abort(400)
 
-        return json.dumps(response)
+        operations = []
+        for index, operation in enumerate(batch):
+            if not isinstance(operation, dict):
+                flask.abort(400)
+            operation_action = operation.get("action")
+            if operation_action == "delete":
+                operation_action = "remove"
+            if operation_action not in jobs.BATCH_ACTIONS:
+                return {"success": False, "error": f"Invalid action in operation {index}."}
+
+            paths = [operation.get("src")]
+            if operation_action != "remove":
+                paths.append(operation.get("dest"))
+            full_paths = [werkzeug.security.safe_join(base_dir, path)
+                          if isinstance(path, str) and path.strip("/") else None
+                          for path in paths]
+            if not all(full_paths):
+                flask.abort(422)  # quit on malicious nonsense
+
+            relative_paths = [_relative(base_dir, path) for path in full_paths]
+            if os.curdir in relative_paths:
+                flask.abort(422)  # the item directory itself
+            if operation_action == "remove":
+                relative_paths.append(None)
+            operations.append((operation_action, *relative_paths))
+
+        job = jobs.enqueue(item, editor, "batch", operations)
+
+        return json.dumps(_job_response(job))
     else:
         response = {
             "success": False,
@@ -385,6 +455,47 @@ def get_files_list(item_id):
         }
 
 
+@bp.route('/view/<int:item_id>/edit/files/jobs/<int:job_id>')
+def job_status(item_id, job_id):
+    item = models.Item.by_id(item_id)
+
+    editor = flask.g.user
+
+    if not item:
+        flask.abort(404)
+
+    # Only allow admins edit deleted items
+    if item.deleted and not (editor and editor.is_moderator):
+        flask.abort(404)
+
+    # Only allow item owners or admins edit items
+    if not editor or not (editor is item.user or editor.is_moderator):
+        flask.abort(403)
+
+    job = models.FileJob.by_id(job_id)
+    if not job or job.item_id != item.id:
+        flask.abort(404)
+
+    if not job.is_finished:
+        # In case the job was queued by a process that has gone away since
+        jobs.job_runner.notify()
+
+    response = {
+        "success": job.status not in (models.FileJobStatus.FAILED,
+                                      models.FileJobStatus.PARTIAL),
+        "status": job.status.name.lower(),
+        "finished": job.is_finished,
+        "done": job.done_count,
+        "total": job.total_count,
+    }
+    if job.error:
+        response["error"] = job.error
+    if job.results:
+        response["results"] = json.loads(job.results)
+
+    return json.dumps(response)
+
+
 @bp.route('/view/<int:item_id>/edit/refresh_index')
 def refresh(item_id):
     item = models.Item.by_id(item_id)
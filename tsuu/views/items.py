@@ -1,4 +1,3 @@
-import json
 from ipaddress import ip_address
 from urllib.parse import quote
 
@@ -7,7 +6,7 @@ from werkzeug.datastructures import CombinedMultiDict
 
 from sqlalchemy.orm import joinedload
 
-from tsuu import backend, forms, models
+from tsuu import backend, filelist, filetree, forms, models
 from tsuu.extensions import db
 from tsuu.utils import cached_function
 
@@ -63,9 +62,14 @@ def view_item(item_id):
     # Only allow owners and admins to edit items
     can_edit = flask.g.user and (flask.g.user is item.user or flask.g.user.is_moderator)
 
+    # Only decode the file list if it's small enough to be displayed
     files = None
-    if item.filelist:
-        files = json.loads(item.filelist.filelist_blob.decode('utf-8'))
+    file_count = 0
+    if item.filelist and item.filelist.filelist_blob:
+        reader = filelist.FilelistReader(item.filelist.filelist_blob)
+        file_count = len(reader)
+        if file_count <= app.config['MAX_FILES_VIEW']:
+            files = reader.to_dict()
 
     item_comments = models.Comment.query.filter_by(
         item_id=item_id
@@ -74,12 +78,72 @@ def view_item(item_id):
     report_form = forms.ReportForm()
     return flask.render_template('view.html', item=item,
                                  files=files,
+                                 file_count=file_count,
                                  comment_form=comment_form,
                                  comments=item_comments,
                                  can_edit=can_edit,
                                  report_form=report_form)
 
 
+@bp.route('/view/<int:item_id>/files', endpoint='files', methods=['GET'])
+def view_item_files(item_id):
+    ''' Returns one page of a single directory level of an item's file list as JSON.
+        Entries are sorted like utils.sorted_pathdict: directories first, then by name. '''
+    item = models.Item.query \
+        .options(joinedload('filelist')) \
+        .filter_by(id=item_id) \
+        .first()
+
+    if not item:
+        flask.abort(404)
+
+    # Only allow admins see deleted items
+    if item.deleted and not (flask.g.user and flask.g.user.is_moderator):
+        flask.abort(404)
+
+    if not item.filelist or not item.filelist.filelist_blob:
+        flask.abort(flask.make_response(flask.jsonify(
+            {'error': 'File list is not available for this item.'}), 404))
+
+    try:
+        path_parts = filetree.split_path(flask.request.args.get('path', ''))
+    except filetree.FileTreeError:
+        flask.abort(flask.make_response(flask.jsonify({'error': 'Invalid path.'}), 400))
+
+    page = max(flask.request.args.get('p', 1, type=int), 1)
+    per_page = app.config['FILELIST_PAGE_SIZE']
+
+    # The stored tree is rooted at the item directory
+    reader = filelist.FilelistReader(item.filelist.filelist_blob)
+    directory_parts = [item.item_directory] + path_parts
+    total = reader.count_children(directory_parts)
+    if total is None:
+        flask.abort(flask.make_response(flask.jsonify({'error': 'No such directory.'}), 404))
+
+    entries = []
+    for name, is_dir, size in reader.listdir(directory_parts, (page - 1) * per_page, per_page):
+        entry_path = '/'.join(path_parts + [name])
+        entry = {
+            'name': name,
+            'path': entry_path,
+            'type': 'directory' if is_dir else 'file',
+            'size': size,
+        }
+        if not is_dir:
+            entry['url'] = flask.url_for('download.download',
+                                         slug=item.item_directory, path=entry_path)
+        entries.append(entry)
+
+    return flask.jsonify({
+        'path': '/'.join(path_parts),
+        'page': page,
+        'per_page': per_page,
+        'total': total,
+        'has_next': page * per_page < total,
+        'entries': entries,
+    })
+
+
 @bp.route('/view/<int:item_id>/edit', endpoint='edit', methods=['GET', 'POST'])
 def edit_torrent(item_id):
     item = models.Item.by_id(item_id)
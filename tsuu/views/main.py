@@ -7,10 +7,11 @@ from ipaddress import ip_address
 import flask
 from flask_paginate import Pagination
 
-from tsuu import models
-from tsuu.extensions import db
+from tsuu import fragments, models
+from tsuu.auth_cache import ban_cache, user_cache
+from tsuu.counters import login_ip_writer
 from tsuu.search import (DEFAULT_MAX_SEARCH_RESULT, DEFAULT_PER_PAGE, SERACH_PAGINATE_DISPLAY_MSG,
-                         _generate_query_string, search_db, search_db_baked)
+                         _generate_query_string, cursor_for, file_matches, search_db)
 from tsuu.utils import chain_get
 from tsuu.views.account import logout
 
@@ -27,7 +28,7 @@ def not_found(error):
 def before_request():
     flask.g.user = None
     if 'user_id' in flask.session:
-        user = models.User.by_id(flask.session['user_id'])
+        user = user_cache.get(flask.session['user_id'])
         if not user:
             return logout()
 
@@ -43,17 +44,16 @@ def before_request():
             flask.session.modified = True
 
         if not app.config['MAINTENANCE_MODE']:
-            ip = ip_address(flask.request.remote_addr)
+            ip = ip_address(flask.request.remote_addr).packed
             if user.last_login_ip != ip:
-                user.last_login_ip = ip.packed
-                db.session.add(user)
-                db.session.commit()
+                # Written in batches in the background
+                login_ip_writer.record(user.id, ip)
+                user_cache.set_last_login_ip(user.id, ip)
 
     # Check if user is banned on POST
     if flask.request.method == 'POST':
         ip = ip_address(flask.request.remote_addr).packed
-        banned = models.Ban.banned(None, ip).first()
-        if banned:
+        if ban_cache.is_banned(ip):
             if flask.g.user:
                 return logout()
 
@@ -83,6 +83,18 @@ def home(rss):
     except (ValueError, TypeError):
         page_number = 1
 
+    # Opaque keyset pagination token, see search.encode_cursor
+    after = req_args.get('after') or None
+
+    # Feeds and first pages look the same to every anonymous visitor, see fragments
+    response_key = None
+    if render_as_rss or (page_number == 1 and not after):
+        response_key = fragments.response_key()
+    if response_key:
+        response = fragments.cached_response(response_key)
+        if response is not None:
+            return response
+
     # Check simply if the key exists
     use_magnet_links = 'magnets' in req_args or 'm' in req_args
 
@@ -123,11 +135,13 @@ def home(rss):
 
     query_args = {
         'user': user_id,
-        'sort': sort_key or 'id',
+        # Best matches first when searching, see search.search_db
+        'sort': sort_key or ('relevance' if search_term else 'id'),
         'order': sort_order or 'desc',
         'category': category or '0_0',
         'quality_filter': quality_filter or '0',
         'page': page_number,
+        'after': after,
         'rss': render_as_rss,
         'per_page': results_per_page
     }
@@ -147,34 +161,45 @@ def home(rss):
 
     query_args['term'] = search_term or ''
 
-    if app.config['USE_BAKED_SEARCH']:
-        query = search_db_baked(**query_args)
-    else:
-        query = search_db(**query_args)
+    query = search_db(**query_args)
 
     if render_as_rss:
-        return render_rss('Home', query, use_elastic=False, magnet_links=use_magnet_links)
+        next_url = None
+        if len(query) == results_per_page:
+            # Lets feed readers and crawlers page through everything (RFC 5005 style)
+            next_args = req_args.to_dict()
+            next_args['after'] = cursor_for(query[-1], 'id', 'desc')
+            next_url = flask.url_for('main.home', _external=True, **next_args)
+        response = render_rss('Home', query, use_elastic=False, magnet_links=use_magnet_links,
+                              next_url=next_url)
     else:
         rss_query_string = _generate_query_string(
             search_term, category, quality_filter, user_name)
         # Use elastic is always false here because we only hit this section
         # if we're browsing without a search term (which means we default to DB)
         # or if ES is disabled
-        return flask.render_template('home.html',
-                                        use_elastic=False,
-                                        item_query=query,
-                                        search=query_args,
-                                        rss_filter=rss_query_string,
-                                        special_results=special_results)
+        response = flask.make_response(flask.render_template(
+            'home.html',
+            use_elastic=False,
+            item_query=query,
+            search=query_args,
+            rss_filter=rss_query_string,
+            special_results=special_results,
+            file_matches=file_matches(search_term, query.items)))
+
+    if response_key:
+        response = fragments.cache_response(response_key, response)
+    return response
 
 
-def render_rss(label, query, use_elastic, magnet_links=False):
+def render_rss(label, query, use_elastic, magnet_links=False, next_url=None):
     rss_xml = flask.render_template('rss.xml',
                                     use_elastic=use_elastic,
                                     magnet_links=magnet_links,
                                     term=label,
                                     site_url=flask.request.url_root,
-                                    item_query=query)
+                                    item_query=query,
+                                    next_url=next_url)
     response = flask.make_response(rss_xml)
     response.headers['Content-Type'] = 'application/xml'
     # Cache for an hour
@@ -0,0 +1,98 @@
+import json
+
+import flask
+
+from tsuu import chunked_uploads, jobs, models
+
+app = flask.current_app
+bp = flask.Blueprint('uploads', __name__)
+
+
+def _response(values, status=200, offset=None):
+    response = flask.make_response(json.dumps(values), status)
+    response.headers['Content-Type'] = 'application/json'
+    response.headers['Cache-Control'] = 'no-store'
+    if offset is not None:
+        response.headers['Upload-Offset'] = str(offset)
+    return response
+
+
+@bp.route('/upload/chunked', methods=['POST'])
+def start():
+    ''' Starts a resumable upload for the /upload form, or carries on with the one in token.
+        The file manager starts its uploads with the files.get_files_list upload_start
+        action instead. '''
+    if not flask.g.user and app.config['RAID_MODE_LIMIT_UPLOADS']:
+        return _response({"success": False, "error": app.config['RAID_MODE_UPLOADS_MESSAGE']},
+                         403)
+
+    filename = flask.request.form.get('name', '').strip()
+    size = flask.request.form.get('size', type=int)
+    if not filename or size is None:
+        flask.abort(400)
+    if size < 1:
+        return _response({"success": False, "error": "Empty files are uploaded in one go."},
+                         422)
+
+    upload = (chunked_uploads.resume(flask.request.form.get('token'), flask.g.user,
+                                     filename, size)
+              or chunked_uploads.create(flask.g.user, filename, size))
+
+    return _response(chunked_uploads.describe(upload), offset=chunked_uploads.offset(upload))
+
+
+@bp.route('/upload/chunked/<token>', methods=['GET', 'PATCH', 'POST', 'DELETE'])
+def chunk(token):
+    ''' GET (or HEAD) returns the offset the next chunk has to start at. PATCH writes the
+        request body at the Upload-Offset header, POST writes the "file" of a multipart
+        form at its Content-Range (js-fileexplorer's chunks) plus the "offset" field.
+        Either may carry an Upload-Checksum header. DELETE cancels the upload. '''
+    upload = chunked_uploads.get(token, flask.g.user)
+    if upload is None:
+        flask.abort(404)
+
+    if flask.request.method == 'GET':
+        offset = chunked_uploads.offset(upload)
+        return _response({"success": True, "offset": offset, "size": upload.size,
+                          "complete": offset == upload.size}, offset=offset)
+    elif flask.request.method == 'DELETE':
+        chunked_uploads.cancel(upload)
+        return _response({"success": True})
+
+    try:
+        checksum = chunked_uploads.parse_checksum(flask.request.headers.get('Upload-Checksum'))
+        if flask.request.method == 'PATCH':
+            offset = flask.request.headers.get('Upload-Offset', type=int)
+            stream = flask.request.stream
+        else:
+            offset = (flask.request.form.get('offset', 0, type=int) +
+                      chunked_uploads.parse_content_range(
+                          flask.request.headers.get('Content-Range')))
+            file_data = flask.request.files.get('file')
+            stream = file_data.stream if file_data else None
+        if offset is None or stream is None:
+            flask.abort(400)
+
+        offset, finished = chunked_uploads.write_chunk(
+            chunked_uploads.upload_path(upload.token), offset, stream, upload.size, checksum,
+            app.config.get('UPLOAD_CHUNK_SIZE'))
+    except chunked_uploads.OffsetMismatch as e:
+        return _response({"success": False, "error": str(e), "offset": e.offset}, 409,
+                         offset=e.offset)
+    except chunked_uploads.UploadBusy as e:
+        return _response({"success": False, "error": str(e)}, 409)
+    except chunked_uploads.ChecksumMismatch as e:
+        return _response({"success": False, "error": str(e)}, 422)
+    except chunked_uploads.UploadError as e:
+        return _response({"success": False, "error": str(e)}, 400)
+
+    response = {"success": True, "offset": offset, "complete": offset == upload.size}
+
+    # File manager uploads are moved into place (and indexed) by a job, once
+    if finished and upload.item_id is not None:
+        item = models.Item.by_id(upload.item_id)
+        job = jobs.enqueue(item, flask.g.user, 'upload', [(upload.token, upload.path)])
+        response["job"] = job.id
+        response["job_url"] = flask.url_for('files.job_status', item_id=item.id, job_id=job.id)
+
+    return _response(response, offset=offset)
@@ -12,7 +12,7 @@ from itsdangerous import BadSignature, URLSafeSerializer
 from tsuu import forms, models
 from tsuu.extensions import db
 from tsuu.search import (DEFAULT_MAX_SEARCH_RESULT, DEFAULT_PER_PAGE, SERACH_PAGINATE_DISPLAY_MSG,
-                         _generate_query_string, search_db, search_db_baked)
+                         _generate_query_string, file_matches, search_db)
 from tsuu.utils import admin_only, chain_get, sha1_hash
 
 app = flask.current_app
@@ -126,16 +126,21 @@ def view_user(user_name):
     except (ValueError, TypeError):
         page_number = 1
 
+    # Opaque keyset pagination token, see search.encode_cursor
+    after = req_args.get('after') or None
+
     results_per_page = app.config.get('RESULTS_PER_PAGE', DEFAULT_PER_PAGE)
 
     query_args = {
         'term': search_term or '',
         'user': user.id,
-        'sort': sort_key or 'id',
+        # Best matches first when searching, see search.search_db
+        'sort': sort_key or ('relevance' if search_term else 'id'),
         'order': sort_order or 'desc',
         'category': category or '0_0',
         'quality_filter': quality_filter or '0',
         'page': page_number,
+        'after': after,
         'rss': False,
         'per_page': results_per_page
     }
@@ -147,10 +152,7 @@ def view_user(user_name):
 
     # Use elastic search for term searching
     rss_query_string = _generate_query_string(search_term, category, quality_filter, user_name)
-    if app.config['USE_BAKED_SEARCH']:
-        query = search_db_baked(**query_args)
-    else:
-        query = search_db(**query_args)
+    query = search_db(**query_args)
     return flask.render_template('user.html',
                                     use_elastic=False,
                                     item_query=query,
@@ -162,7 +164,8 @@ def view_user(user_name):
                                     ban_form=ban_form,
                                     nuke_form=nuke_form,
                                     bans=bans,
-                                    ipbanned=ipbanned)
+                                    ipbanned=ipbanned,
+                                    file_matches=file_matches(search_term, query.items))
 
 
 @bp.route('/user/<user_name>/comments')